@@ -4,8 +4,13 @@ from app import prompts
 from app.general_utils import get_melbourne_time_str, format_conversation_history, clean_and_dedupe_history
 from app.ai_handler import get_ai_response
 from utilities import process_conversation_for_media
+from services.intent_detector import detect_intents
+from services.request_context import AdVerdict, RequestContext
+from services.prompt_budget import build_prompt
+from services.conversation_summary import CONVERSATION_SUMMARY_MODEL, conversation_summaries
+from webhook_handlers import a_call_gemini_with_retry
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
 # Import from the main webhook_handlers (not the app one)
 import sys
@@ -21,43 +26,42 @@ class AdResponseHandler:
     @staticmethod
     async def is_ad_response(ig_username: str, message_text: str, metrics: Dict) -> tuple[bool, int, int]:
         """Determine if a message is a response to an ad. Returns (is_ad, scenario, confidence)."""
-        logger.info(
-            f"[AdResponse] Analyzing message from {ig_username}: '{message_text}' for ad intent")
-        text = message_text.lower()
-        scenario = 3  # Default to plant_based
-        confidence = 0
+        return AdResponseHandler.classify_ad_response(ig_username, message_text, metrics).as_tuple()
 
-        ad_keywords = ["challenge", "vegan challenge",
-                       "vegetarian challenge", "learn more", "get started"]
+    @staticmethod
+    async def summarize_history(summary_prompt: str) -> Optional[str]:
+        """Rolling conversation summary call (see services.conversation_summary), on the cheap model."""
+        return await a_call_gemini_with_retry(summary_prompt, CONVERSATION_SUMMARY_MODEL)
 
-        # Check for vegan challenge (with typo tolerance)
-        if ("vegan" in text and "challeng" in text) or "vegan challenge" in text:
-            logger.info(
-                f"[AdResponse] Found vegan challenge reference in text")
-            scenario = 1
-            confidence = 90
-        elif ("vegetarian" in text and "challeng" in text) or "vegetarian challenge" in text:
-            logger.info(
-                f"[AdResponse] Found vegetarian challenge reference in text")
-            scenario = 2
-            confidence = 90
-        # Check for vegan + program/join/weight loss combinations
-        elif "vegan" in text and any(program_word in text for program_word in ["program", "join", "weight loss", "weightloss", "fitness", "training"]):
-            logger.info(
-                f"[AdResponse] Found vegan + program/join/weight loss reference in text")
-            scenario = 1
-            confidence = 85
-        elif "vegetarian" in text and any(program_word in text for program_word in ["program", "join", "weight loss", "weightloss", "fitness", "training"]):
+    @staticmethod
+    def classify_ad_response(ig_username: str, message_text: str, metrics: Dict,
+                             ctx: Optional[RequestContext] = None, stage: str = "") -> AdVerdict:
+        """Ad-intent verdict for a message.
+
+        With ctx, the keyword verdict is computed once per message and reused
+        by later routing stages, and the verdict used (and whether it was
+        reused) is appended to ctx.decision_trace under stage.
+        """
+        keyword_verdict = ctx.ad_verdicts.get(message_text) if ctx is not None else None
+        if keyword_verdict is None:
             logger.info(
-                f"[AdResponse] Found vegetarian + program/join/weight loss reference in text")
-            scenario = 2
-            confidence = 85
-        elif any(keyword in text for keyword in ad_keywords):
-            matched_keywords = [kw for kw in ad_keywords if kw in text]
-            logger.info(f"[AdResponse] Found ad keywords: {matched_keywords}")
-            scenario = 3
-            confidence = 80
-
+                f"[AdResponse] Analyzing message from {ig_username}: '{message_text}' for ad intent")
+            # Vegan/vegetarian challenge (typo tolerant), vegan/vegetarian + program words,
+            # then generic ad keywords; scored by the shared intent detector
+            intents = detect_intents(message_text)
+            confidence = intents.confidence("ad_response")
+            if confidence:
+                matched_keywords = [kw for group in ("ad_vegan", "ad_vegetarian", "ad_challenge", "ad_program", "ad_keyword")
+                                    for kw in intents.matched(group)]
+                logger.info(
+                    f"[AdResponse] Found ad keywords: {matched_keywords} (scenario {intents.ad_scenario})")
+            keyword_verdict = AdVerdict(
+                confidence >= 50, intents.ad_scenario, confidence)
+            if ctx is not None:
+                ctx.ad_verdicts[message_text] = AdVerdict(
+                    keyword_verdict.is_ad, keyword_verdict.scenario, confidence, cached=True)
+
+        confidence = keyword_verdict.confidence
         # Check for short first messages (common for ad responses)
         conv_history_len = len(metrics.get('conversation_history', []))
         if confidence == 0 and conv_history_len <= 1 and len(message_text.split()) < 10:
@@ -65,12 +69,14 @@ class AdResponseHandler:
                 f"[AdResponse] Short first message detected (history: {conv_history_len}, words: {len(message_text.split())})")
             confidence = 40
 
-        is_ad = confidence >= 50
-
+        verdict = AdVerdict(confidence >= 50, keyword_verdict.scenario,
+                            confidence, cached=keyword_verdict.cached)
         logger.info(
-            f"[AdResponse] Final result: is_ad={is_ad}, scenario={scenario}, confidence={confidence}%")
-
-        return is_ad, scenario, confidence
+            f"[AdResponse] Final result: is_ad={verdict.is_ad}, scenario={verdict.scenario}, confidence={confidence}%"
+            f"{' (cached)' if verdict.cached else ''}")
+        if ctx is not None:
+            ctx.decision_trace.append(verdict.trace_entry(stage))
+        return verdict
 
     @staticmethod
     async def handle_ad_response(ig_username: str, message_text: str, subscriber_id: str,
@@ -111,23 +117,29 @@ class AdResponseHandler:
             conversation_history = clean_and_dedupe_history(
                 conversation_history_raw, max_items=40)
 
-            full_conversation = format_conversation_history(
-                conversation_history) + f"\\nUser: {processed_message_text}"
-            logger.info(
-                f"[AdResponse] Formatted conversation: {full_conversation[:200]}...")
+            # Long conversations: rolling summary + the recent messages
+            history_summary, conversation_history = conversation_summaries.prompt_history(
+                ig_username, conversation_history, AdResponseHandler.summarize_history)
 
             script_state = metrics.get('ad_script_state', 'step1')
 
             challenge_types = {1: 'vegan', 2: 'vegetarian', 3: 'plant_based'}
             challenge_type = challenge_types.get(scenario, 'plant_based')
 
-            # Build prompt using ad response template
-            prompt = prompts.COMBINED_AD_RESPONSE_PROMPT_TEMPLATE.format(
-                current_melbourne_time_str=current_time,
-                ig_username=ig_username,
-                script_state=script_state,
-                ad_scenario=scenario,
-                full_conversation=full_conversation
+            # Build prompt using ad response template, history trimmed to the token budget
+            prompt = build_prompt(
+                "facebook_ad_response", prompts.COMBINED_AD_RESPONSE_PROMPT_TEMPLATE,
+                {
+                    "current_melbourne_time_str": current_time,
+                    "ig_username": ig_username,
+                    "script_state": script_state,
+                    "ad_scenario": scenario,
+                },
+                history=conversation_history,
+                format_history=format_conversation_history,
+                history_suffix=f"\\nUser: {processed_message_text}",
+                history_summary=history_summary,
+                bio=bio_context
             )
 
             # Generate AI response
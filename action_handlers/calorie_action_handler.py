@@ -22,7 +22,10 @@ from app.dashboard_modules.dashboard_sqlite_utils import (
     set_user_in_calorie_flow,
     upsert_user_nutrition_profile,
 )
-from webhook_handlers import get_user_data, update_analytics_data, call_gemini_with_retry
+from webhook_handlers import get_user_data, update_analytics_data, call_gemini_with_retry, a_call_gemini_with_retry
+from services.request_context import RequestContext
+from services.intent_detector import detect_intents
+from services.llm_cache import llm_cache
 from webhook_utils import calculate_targets
 import json
 import logging
@@ -41,24 +44,58 @@ logger = logging.getLogger("shanbot_calories")
 class CalorieActionHandler:
     """Handles calorie tracking and food analysis."""
 
+    name = "calorie"
+
+    @staticmethod
+    async def can_handle(ig_username: str, message_text: str, ctx: Optional[RequestContext] = None) -> bool:
+        """Side-effect-free probe: could handle_calorie_actions take this message?
+
+        True whenever any of its branches might apply (tracking phrase, pending
+        setup or meal, calorie flow, rename window); handle_calorie_actions
+        still makes the final call and returns False to decline.
+        """
+        if detect_intents(message_text).confidence("calorie_tracking"):
+            return True
+        if ctx is None:
+            ctx = await asyncio.to_thread(RequestContext.load, ig_username)
+        metrics_json = ctx.metrics_json
+        nutrition = metrics_json.get('nutrition') or {}
+        if ctx.is_in_calorie_flow or metrics_json.get('pending_calorie_setup'):
+            return True
+        if nutrition.get('pending_meal') and 'http' not in (message_text or '').lower():
+            return True
+        rename_until = nutrition.get('meal_rename_until')
+        if rename_until:
+            from datetime import datetime
+            try:
+                return datetime.fromisoformat(rename_until) > datetime.now()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    @staticmethod
+    async def handle(ig_username: str, message_text: str, subscriber_id: str, first_name: str, last_name: str,
+                     user_message_timestamp_iso: str, ctx: Optional[RequestContext] = None) -> bool:
+        return await CalorieActionHandler.handle_calorie_actions(
+            ig_username, message_text, subscriber_id, first_name, last_name, ctx=ctx
+        )
+
     @staticmethod
     async def handle_calorie_actions(ig_username: str, message_text: str, subscriber_id: str,
-                                     first_name: str, last_name: str) -> bool:
-        """Handle calorie-related actions."""
+                                     first_name: str, last_name: str,
+                                     ctx: Optional[RequestContext] = None) -> bool:
+        """Handle calorie-related actions.
+
+        The checks below read the user's state as it was when the message
+        arrived (ctx); anything that writes re-reads the row before updating.
+        """
         try:
+            if ctx is None:
+                ctx = RequestContext.load(ig_username, subscriber_id)
             # If there is a pending meal (15–30s buffer), capture user's text as description and finalize immediately
             try:
-                from app.dashboard_modules.dashboard_sqlite_utils import get_db_connection
-                conn_chk = get_db_connection()
-                cur_chk = conn_chk.cursor()
-                cur_chk.execute(
-                    'SELECT metrics_json FROM users WHERE ig_username = ? LIMIT 1', (ig_username,))
-                row_chk = cur_chk.fetchone()
-                current_chk = json.loads(
-                    row_chk[0]) if row_chk and row_chk[0] else {}
-                nutrition_chk = current_chk.get('nutrition') or {}
+                nutrition_chk = ctx.metrics_json.get('nutrition') or {}
                 pending_meal = nutrition_chk.get('pending_meal') or {}
-                conn_chk.close()
 
                 if pending_meal and isinstance(message_text, str) and 'http' not in message_text.lower():
                     # Save description and finalize now
@@ -99,13 +136,7 @@ class CalorieActionHandler:
                     }
                     if 0 < len(candidate_desc) <= 60 and normalized_cmd not in known_cmds:
                         # Guard: only capture if user is in calorie flow; otherwise don't swallow general chat
-                        in_flow_ok = False
-                        try:
-                            from app.dashboard_modules.dashboard_sqlite_utils import is_user_in_calorie_flow as _is_in_flow
-                            in_flow_ok = bool(_is_in_flow(ig_username))
-                        except Exception:
-                            in_flow_ok = False
-                        if not in_flow_ok:
+                        if not ctx.is_in_calorie_flow:
                             return False
                         from app.dashboard_modules.dashboard_sqlite_utils import get_db_connection
                         from datetime import datetime, timedelta
@@ -135,9 +166,7 @@ class CalorieActionHandler:
                 pass
             # If within rename grace window and user sends a short text, treat it as meal rename
             try:
-                _, m, _ = get_user_data(ig_username, subscriber_id)
-                metrics_json = m.get('metrics_json') or {}
-                nutrition = metrics_json.get('nutrition') or {}
+                nutrition = ctx.metrics_json.get('nutrition') or {}
                 rename_until = nutrition.get('meal_rename_until')
                 if rename_until and message_text and len(message_text.strip()) <= 40 and 'http' not in message_text.lower():
                     from datetime import datetime
@@ -155,17 +184,14 @@ class CalorieActionHandler:
             except Exception:
                 pass
             # STRICT calorie tracking phrase gate: only exact phrase should trigger tracking flow
-            if isinstance(message_text, str):
-                normalized = ' '.join(message_text.strip().lower().split())
-                if normalized in ('track my cals', 'track my cals plz'):
-                    return await CalorieActionHandler._handle_macro_tracking(
-                        ig_username, message_text, subscriber_id, first_name, last_name
-                    )
+            if detect_intents(message_text).confidence("calorie_tracking"):
+                return await CalorieActionHandler._handle_macro_tracking(
+                    ig_username, message_text, subscriber_id, first_name, last_name
+                )
 
             # If we're waiting on nutrition profile details, try to complete setup from this message
             try:
-                metrics_json = get_user_metrics_json(ig_username)
-                if isinstance(metrics_json, dict) and metrics_json.get('pending_calorie_setup'):
+                if ctx.metrics_json.get('pending_calorie_setup'):
                     completed = await CalorieActionHandler._try_complete_calorie_setup(
                         ig_username, subscriber_id, message_text, first_name, last_name
                     )
@@ -187,14 +213,8 @@ class CalorieActionHandler:
             if await CalorieActionHandler._is_food_log(message_text):
                 try:
                     # Gate by flow flags to avoid unsolicited analysis on random food pics
-                    in_flow_flag = False
-                    try:
-                        from app.dashboard_modules.dashboard_sqlite_utils import is_user_in_calorie_flow as _is_in_flow
-                        in_flow_flag = bool(_is_in_flow(ig_username))
-                    except Exception:
-                        in_flow_flag = False
-
-                    metrics_json = get_user_metrics_json(ig_username) or {}
+                    in_flow_flag = ctx.is_in_calorie_flow
+                    metrics_json = ctx.metrics_json
                     pending_setup = bool(
                         metrics_json.get('pending_calorie_setup'))
                     nutrition = metrics_json.get('nutrition') or {}
@@ -246,43 +266,18 @@ class CalorieActionHandler:
     @staticmethod
     async def _is_food_log(message_text: str) -> bool:
         """Detect if message is a food log entry."""
-        # Check for food image URL
-        if CalorieActionHandler._has_media_url(message_text):
-            return True
-
-        food_indicators = [
-            'ate', 'had', 'breakfast', 'lunch', 'dinner', 'snack',
-            'meal', 'food', 'calories', 'protein', 'carbs'
-        ]
-
-        quantity_patterns = [
-            r'\d+\s*(g|grams|oz|ounces|cups?|tbsp|tsp)',
-            r'\d+\s*(calories|cal|kcal)',
-            r'\d+\s*(servings?|portions?)'
-        ]
-
-        message_lower = message_text.lower()
-
-        # Must have food indicator and quantity/measurement
-        has_food_indicator = any(
-            indicator in message_lower for indicator in food_indicators)
-        has_quantity = any(re.search(pattern, message_lower)
-                           for pattern in quantity_patterns)
-
-        return has_food_indicator and (has_quantity or len(message_text.split()) > 3)
+        # Food image URL, or a food indicator with a quantity/measurement (or some detail)
+        return detect_intents(message_text).confidence("food_log") > 0
 
     @staticmethod
     def _has_media_url(message_text: str) -> bool:
         """Check if message contains media URLs."""
-        url_pattern = r"(https?://lookaside\.fbsbx\.com/ig_messaging_cdn/\?asset_id=[\w-]+&signature=[\w\-_.~]+)"
-        return bool(re.search(url_pattern, message_text))
+        return detect_intents(message_text).has_media_url
 
     @staticmethod
     def _extract_media_url(message_text: str) -> Optional[str]:
         """Extract media URL from message."""
-        url_pattern = r"(https?://lookaside\.fbsbx\.com/ig_messaging_cdn/\?asset_id=[\w-]+&signature=[\w\-_.~]+)"
-        match = re.search(url_pattern, message_text)
-        return match.group(1) if match else None
+        return detect_intents(message_text).media_url
 
     @staticmethod
     async def _is_calorie_question(message_text: str) -> bool:
@@ -835,7 +830,10 @@ class CalorieActionHandler:
             Analysis:
             {analysis_text}
             """
-            name = await call_gemini_with_retry("gemini-2.5-flash-lite", prompt)
+            name = await llm_cache.get_or_call(
+                "gemini-2.5-flash-lite", prompt,
+                lambda: a_call_gemini_with_retry(prompt, "gemini-2.5-flash-lite"),
+                site="meal_name")
             name = (name or "").strip()
             name = re.sub(r"[^A-Za-z\s\-']", "", name).strip()
             words = name.split()
@@ -12,6 +12,8 @@ from webhook_handlers import (
     get_ai_response, get_user_data, update_analytics_data,
     call_gemini_with_retry, update_manychat_fields, build_member_chat_prompt
 )
+from services.request_context import RequestContext
+from services.prompt_budget import estimate_tokens
 import json
 import logging
 import asyncio
@@ -25,14 +27,30 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 logger = logging.getLogger("shanbot_core")
 
+# Specific action handlers, highest priority first. Each exposes a
+# side-effect-free can_handle() probe and a handle() that acts.
+ACTION_HANDLER_PRIORITY = (
+    TrainerizeActionHandler,
+    CalorieActionHandler,
+    FormCheckHandler,
+)
+
+# "probe": run all can_handle() probes concurrently, then handle in priority order.
+# "sequential": call each handler's handle() in turn.
+CORE_DISPATCH_MODE = os.getenv("CORE_DISPATCH_MODE", "probe").lower()
+
 
 class CoreActionHandler:
     """Central handler for all webhook actions and message processing."""
 
     @staticmethod
     async def detect_and_handle_action(ig_username: str, message_text: str, subscriber_id: str,
-                                       first_name: str, last_name: str, user_message_timestamp_iso: str, fb_ad: bool = False) -> bool:
-        """Main action detection and handling logic."""
+                                       first_name: str, last_name: str, user_message_timestamp_iso: str, fb_ad: bool = False,
+                                       ctx: Optional[RequestContext] = None) -> bool:
+        """Main action detection and handling logic.
+
+        ctx is the router's per-message snapshot; loaded here if not given.
+        """
         try:
             logger.info(
                 f"[CoreAction] Processing message from {ig_username}: '{message_text[:100]}...'")
@@ -42,18 +60,24 @@ class CoreActionHandler:
                 from app.dashboard_modules.dashboard_sqlite_utils import add_message_to_history
                 add_message_to_history(ig_username=ig_username, message_type='user',
                                        message_text=message_text or '', message_timestamp=user_message_timestamp_iso)
+                if ctx is not None:
+                    ctx.record_user_message(
+                        message_text, user_message_timestamp_iso)
             except Exception as persist_e:
                 logger.warning(
                     f"[CoreAction] Could not append user message to messages for {ig_username}: {persist_e}")
 
-            # Get user data and current state
-            _, metrics, _ = get_user_data(ig_username, subscriber_id)
+            # Get user data and current state (loaded after the insert above, so it includes this message)
+            if ctx is None:
+                ctx = RequestContext.load(ig_username, subscriber_id)
+            metrics = ctx.metrics
             conversation_history = metrics.get('conversation_history', [])
 
             # Check for ad response first
-            is_ad_response, scenario, confidence = await AdResponseHandler.is_ad_response(
-                ig_username, message_text, metrics
-            )
+            is_ad_response, scenario, confidence = AdResponseHandler.classify_ad_response(
+                ig_username, message_text, metrics,
+                ctx=ctx, stage="core_action"
+            ).as_tuple()
 
             logger.info(
                 f"[CoreAction] Ad detection result for {ig_username}: is_ad={is_ad_response}, scenario={scenario}, confidence={confidence}%")
@@ -80,41 +104,21 @@ class CoreActionHandler:
                     logger.warning(
                         f"[CoreAction] Ad response handling failed for {ig_username}")
 
-            # Check for Trainerize actions
-            trainerize_handled = await TrainerizeActionHandler.handle_trainerize_actions(
-                ig_username, message_text, subscriber_id, first_name, last_name
-            )
-
-            if trainerize_handled:
-                logger.info(
-                    f"[CoreAction] Handled Trainerize action for {ig_username}")
-                return True
-
-            # Check for calorie tracking
-            calorie_handled = await CalorieActionHandler.handle_calorie_actions(
-                ig_username, message_text, subscriber_id, first_name, last_name
-            )
-
-            if calorie_handled:
-                logger.info(
-                    f"[CoreAction] Handled calorie action for {ig_username}")
-                return True
-
-            # Check for form check videos
-            form_check_handled = await FormCheckHandler.handle_form_check(
-                ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso
+            # Trainerize, calorie and form-check handlers, in ACTION_HANDLER_PRIORITY order
+            handled_by = await CoreActionHandler._dispatch_action_handlers(
+                ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso, ctx
             )
-
-            if form_check_handled:
+            if handled_by:
                 logger.info(
-                    f"[CoreAction] Handled form check for {ig_username}")
+                    f"[CoreAction] Handled {handled_by} action for {ig_username}")
                 return True
 
             # No specific action detected, handle as general conversation
             logger.info(
                 f"[CoreAction] No specific action detected for {ig_username}, processing as general conversation")
             return await CoreActionHandler._handle_general_conversation(
-                ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso, fb_ad
+                ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso, fb_ad,
+                ctx=ctx
             )
 
         except Exception as e:
@@ -122,6 +126,45 @@ class CoreActionHandler:
                 f"[CoreAction] Error processing action for {ig_username}: {e}")
             return False
 
+    @staticmethod
+    async def _dispatch_action_handlers(ig_username: str, message_text: str, subscriber_id: str, first_name: str,
+                                        last_name: str, user_message_timestamp_iso: str,
+                                        ctx: Optional[RequestContext] = None) -> Optional[str]:
+        """Offer the message to the specific action handlers. Returns the name of the one that handled it.
+
+        In "probe" mode every handler's side-effect-free can_handle() runs
+        concurrently, then only the handlers that claimed the message run,
+        highest priority first; if one declines, the next claimant gets it.
+        "sequential" mode calls each handler's handle() in turn, as before.
+        """
+        handlers = ACTION_HANDLER_PRIORITY
+        if CORE_DISPATCH_MODE == "probe":
+            probes = await asyncio.gather(
+                *(handler.can_handle(ig_username, message_text, ctx) for handler in handlers),
+                return_exceptions=True
+            )
+            candidates = []
+            for handler, probe in zip(handlers, probes):
+                if isinstance(probe, Exception):
+                    # Let the handler decide for itself if its probe failed
+                    logger.warning(
+                        f"[CoreAction] {handler.name} probe failed for {ig_username}: {probe}")
+                    candidates.append(handler)
+                elif probe:
+                    candidates.append(handler)
+            logger.info(
+                f"[CoreAction] Probe results for {ig_username}: {[handler.name for handler in candidates] or 'none'}")
+            handlers = candidates
+
+        for handler in handlers:
+            if await handler.handle(ig_username, message_text, subscriber_id, first_name, last_name,
+                                    user_message_timestamp_iso, ctx):
+                return handler.name
+            if CORE_DISPATCH_MODE == "probe":
+                logger.info(
+                    f"[CoreAction] {handler.name} declined message from {ig_username}, trying next handler")
+        return None
+
     @staticmethod
     async def run_core_processing_after_buffer(ig_username: str, message_text: str, subscriber_id: str,
                                                first_name: str, last_name: str, user_message_timestamp_iso: str) -> None:
@@ -130,8 +173,9 @@ class CoreActionHandler:
             logger.info(
                 f"[CoreBuffer] Running buffered processing for {ig_username}")
 
-            # Get user data to check if they're already in ad flow
-            _, metrics, _ = get_user_data(ig_username, subscriber_id)
+            # One snapshot for the whole burst, so its decision trace covers every stage
+            ctx = RequestContext.load(ig_username, subscriber_id)
+            metrics = ctx.metrics
             is_in_ad_flow = metrics.get('is_in_ad_flow', False)
 
             logger.info(
@@ -158,12 +202,15 @@ class CoreActionHandler:
 
             # Otherwise, run the main action detection
             handled = await CoreActionHandler.detect_and_handle_action(
-                ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso
+                ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso,
+                ctx=ctx
             )
 
             if not handled:
                 logger.warning(
                     f"[CoreBuffer] No handler processed message for {ig_username}")
+            logger.info(
+                f"[CoreBuffer] Decision trace for {ig_username}: {ctx.decision_trace}")
 
         except Exception as e:
             logger.error(
@@ -171,7 +218,8 @@ class CoreActionHandler:
 
     @staticmethod
     async def _handle_general_conversation(ig_username: str, message_text: str, subscriber_id: str,
-                                           first_name: str, last_name: str, user_message_timestamp_iso: str, fb_ad: bool = False) -> bool:
+                                           first_name: str, last_name: str, user_message_timestamp_iso: str, fb_ad: bool = False,
+                                           ctx: Optional[RequestContext] = None) -> bool:
         """Handle general conversation that doesn't match specific actions."""
         try:
             # Debug logging to see what we received
@@ -193,7 +241,8 @@ class CoreActionHandler:
                 processed_message_text = message_text  # Fallback to original
 
             # Get user data for context
-            _, metrics, _ = get_user_data(ig_username, subscriber_id)
+            _, metrics, _ = ctx.user_data() if ctx is not None else get_user_data(
+                ig_username, subscriber_id)
 
             # Fetch appropriate few-shot examples (vegan or general)
             few_shot_examples = []
@@ -219,6 +268,8 @@ class CoreActionHandler:
                 full_name=f"{first_name} {last_name}".strip(),
                 few_shot_examples=few_shot_examples
             )
+            logger.info(
+                f"[CoreGeneral] {prompt_type} prompt for {ig_username}: ~{estimate_tokens(prompt)} tokens")
 
             response = await get_ai_response(prompt)
 
@@ -7,6 +7,8 @@ Handles form check video analysis and exercise technique feedback.
 from techniqueanalysis import get_video_analysis
 from app.dashboard_modules.dashboard_sqlite_utils import add_response_to_review_queue
 from webhook_handlers import get_user_data, update_analytics_data, call_gemini_with_retry
+from services.request_context import RequestContext
+from services.intent_detector import detect_intents
 import logging
 import subprocess
 import os
@@ -23,9 +25,24 @@ logger = logging.getLogger("shanbot_formcheck")
 class FormCheckHandler:
     """Handles form check video analysis."""
 
+    name = "form_check"
+
+    @staticmethod
+    async def can_handle(ig_username: str, message_text: str, ctx: Optional[RequestContext] = None) -> bool:
+        """Side-effect-free probe: is this a form check request?"""
+        return await FormCheckHandler._is_form_check_request(message_text)
+
+    @staticmethod
+    async def handle(ig_username: str, message_text: str, subscriber_id: str, first_name: str, last_name: str,
+                     user_message_timestamp_iso: str, ctx: Optional[RequestContext] = None) -> bool:
+        return await FormCheckHandler.handle_form_check(
+            ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso, ctx=ctx
+        )
+
     @staticmethod
     async def handle_form_check(ig_username: str, message_text: str, subscriber_id: str,
-                                first_name: str, last_name: str, user_message_timestamp_iso: str) -> bool:
+                                first_name: str, last_name: str, user_message_timestamp_iso: str,
+                                ctx: Optional[RequestContext] = None) -> bool:
         """Handle form check video analysis."""
         try:
             # Check if message contains video or form check request
@@ -37,7 +54,8 @@ class FormCheckHandler:
             logger.info(f"[FormCheck] Handling form check for {ig_username}")
 
             # Get user data
-            _, metrics, _ = get_user_data(ig_username, subscriber_id)
+            _, metrics, _ = ctx.user_data() if ctx is not None else get_user_data(
+                ig_username, subscriber_id)
             client_analysis = metrics.get('client_analysis', {})
 
             # Check if video URL is present in the message
@@ -85,46 +103,18 @@ class FormCheckHandler:
     @staticmethod
     async def _is_form_check_request(message_text: str) -> bool:
         """Detect if message is a form check request."""
-        # Check for video URL first - if there's a video, likely a form check
-        if FormCheckHandler._has_video_url(message_text):
-            return True
-
-        form_check_keywords = [
-            'form check', 'check my form', 'form', 'technique',
-            'how did i do', 'how does this look', 'feedback on',
-            'critique', 'analyze', 'video', 'movement'
-        ]
-
-        exercise_keywords = [
-            'squat', 'deadlift', 'bench', 'press', 'curl',
-            'row', 'pull', 'push', 'lift', 'exercise'
-        ]
-
-        message_lower = message_text.lower()
-
-        # Must have form check indicator OR exercise + request for feedback
-        has_form_check = any(
-            keyword in message_lower for keyword in form_check_keywords)
-        has_exercise = any(
-            keyword in message_lower for keyword in exercise_keywords)
-        has_question = '?' in message_text or 'how' in message_lower
-
-        return has_form_check or (has_exercise and has_question)
+        # Video URL, form check indicator, or exercise + request for feedback
+        return detect_intents(message_text).confidence("form_check") > 0
 
     @staticmethod
     def _has_video_url(message_text: str) -> bool:
         """Check if message contains video URLs."""
-        import re
-        url_pattern = r"(https?://lookaside\.fbsbx\.com/ig_messaging_cdn/\?asset_id=[\w-]+&signature=[\w\-_.~]+)"
-        return bool(re.search(url_pattern, message_text))
+        return detect_intents(message_text).has_media_url
 
     @staticmethod
     def _extract_video_url(message_text: str) -> Optional[str]:
         """Extract video URL from message."""
-        import re
-        url_pattern = r"(https?://lookaside\.fbsbx\.com/ig_messaging_cdn/\?asset_id=[\w-]+&signature=[\w\-_.~]+)"
-        match = re.search(url_pattern, message_text)
-        return match.group(1) if match else None
+        return detect_intents(message_text).media_url
 
     @staticmethod
     async def _check_video_availability(ig_username: str, timestamp: str) -> bool:
@@ -21,6 +21,7 @@ from utilities import (
 )
 from app.dashboard_modules.dashboard_sqlite_utils import add_response_to_review_queue
 from app import prompts
+from services.llm_cache import llm_cache
 
 logger = logging.getLogger("shanbot_onboarding")
 
@@ -111,7 +112,10 @@ class OnboardingHandler:
             Reply with just the request type.
             """
 
-            response = await call_gemini_with_retry("gemini-2.0-flash", analysis_prompt)
+            response = await llm_cache.get_or_call(
+                "gemini-2.0-flash", analysis_prompt,
+                lambda: call_gemini_with_retry("gemini-2.0-flash", analysis_prompt),
+                site="onboarding_request_type")
             request_type = response.strip().lower()
 
             valid_types = ["program_inquiry", "pricing_question", "trial_interest",
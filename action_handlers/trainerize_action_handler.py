@@ -6,6 +6,8 @@ Handles all Trainerize-related actions including workout requests and automation
 
 from app.dashboard_modules.dashboard_sqlite_utils import add_response_to_review_queue
 from webhook_handlers import get_user_data, update_analytics_data, call_gemini_with_retry
+from services.request_context import RequestContext
+from services.intent_detector import detect_intents
 import json
 import logging
 import re
@@ -22,21 +24,37 @@ logger = logging.getLogger("shanbot_trainerize")
 class TrainerizeActionHandler:
     """Handles Trainerize-related actions and automation."""
 
+    name = "trainerize"
+
+    @staticmethod
+    async def can_handle(ig_username: str, message_text: str, ctx: Optional[RequestContext] = None) -> bool:
+        """Side-effect-free probe: is this a workout or program build request?"""
+        return (await TrainerizeActionHandler._is_workout_request(message_text)
+                or await TrainerizeActionHandler._is_program_build_request(message_text))
+
+    @staticmethod
+    async def handle(ig_username: str, message_text: str, subscriber_id: str, first_name: str, last_name: str,
+                     user_message_timestamp_iso: str, ctx: Optional[RequestContext] = None) -> bool:
+        return await TrainerizeActionHandler.handle_trainerize_actions(
+            ig_username, message_text, subscriber_id, first_name, last_name, ctx=ctx
+        )
+
     @staticmethod
     async def handle_trainerize_actions(ig_username: str, message_text: str, subscriber_id: str,
-                                        first_name: str, last_name: str) -> bool:
+                                        first_name: str, last_name: str,
+                                        ctx: Optional[RequestContext] = None) -> bool:
         """Handle Trainerize-related actions."""
         try:
             # Check for workout requests
             if await TrainerizeActionHandler._is_workout_request(message_text):
                 return await TrainerizeActionHandler._handle_workout_request(
-                    ig_username, message_text, subscriber_id, first_name, last_name
+                    ig_username, message_text, subscriber_id, first_name, last_name, ctx=ctx
                 )
 
             # Check for program building requests
             if await TrainerizeActionHandler._is_program_build_request(message_text):
                 return await TrainerizeActionHandler._handle_program_build_request(
-                    ig_username, message_text, subscriber_id, first_name, last_name
+                    ig_username, message_text, subscriber_id, first_name, last_name, ctx=ctx
                 )
 
             return False
@@ -51,33 +69,25 @@ class TrainerizeActionHandler:
         """Detect if message is a workout request.
         STRICT: Only trigger when the message is exactly 'adjust my workout plz' (case-insensitive, ignoring whitespace).
         """
-        if not isinstance(message_text, str):
-            return False
-        normalized = ' '.join(message_text.strip().lower().split())
-        return normalized == 'adjust my workout plz'
+        return detect_intents(message_text).confidence("workout_request") > 0
 
     @staticmethod
     async def _is_program_build_request(message_text: str) -> bool:
         """Detect if message is a program building request."""
-        build_keywords = [
-            'build program', 'create program', 'make program',
-            'design program', 'set up program', 'program me',
-            'trainerize program', 'workout program'
-        ]
-
-        message_lower = message_text.lower()
-        return any(keyword in message_lower for keyword in build_keywords)
+        return detect_intents(message_text).confidence("program_build") > 0
 
     @staticmethod
     async def _handle_workout_request(ig_username: str, message_text: str, subscriber_id: str,
-                                      first_name: str, last_name: str) -> bool:
+                                      first_name: str, last_name: str,
+                                      ctx: Optional[RequestContext] = None) -> bool:
         """Handle workout request."""
         try:
             logger.info(
                 f"[TrainerizeWorkout] Handling workout request for {ig_username}")
 
             # Get user data for context
-            _, metrics, _ = get_user_data(ig_username, subscriber_id)
+            _, metrics, _ = ctx.user_data() if ctx is not None else get_user_data(
+                ig_username, subscriber_id)
             conversation_history = metrics.get('conversation_history', [])
             client_analysis = metrics.get('client_analysis', {})
 
@@ -121,7 +131,8 @@ class TrainerizeActionHandler:
 
     @staticmethod
     async def _handle_program_build_request(ig_username: str, message_text: str, subscriber_id: str,
-                                            first_name: str, last_name: str) -> bool:
+                                            first_name: str, last_name: str,
+                                            ctx: Optional[RequestContext] = None) -> bool:
         """Handle program building request."""
         try:
             logger.info(
@@ -131,7 +142,8 @@ class TrainerizeActionHandler:
             from trainerize_automation import TrainerizeAutomation
 
             # Get user data
-            _, metrics, _ = get_user_data(ig_username, subscriber_id)
+            _, metrics, _ = ctx.user_data() if ctx is not None else get_user_data(
+                ig_username, subscriber_id)
             client_analysis = metrics.get('client_analysis', {})
 
             # Check if user is a client
@@ -22,6 +22,7 @@ from utilities import (
 )
 from app.dashboard_modules.dashboard_sqlite_utils import add_response_to_review_queue
 from app import prompts
+from services.llm_cache import llm_cache
 
 logger = logging.getLogger("shanbot_workout")
 
@@ -110,7 +111,10 @@ class WorkoutHandler:
             Reply with just the request type.
             """
 
-            response = await call_gemini_with_retry("gemini-2.0-flash", analysis_prompt)
+            response = await llm_cache.get_or_call(
+                "gemini-2.0-flash", analysis_prompt,
+                lambda: call_gemini_with_retry("gemini-2.0-flash", analysis_prompt),
+                site="workout_request_type")
             request_type = response.strip().lower()
 
             if request_type not in ["trainerize_needed", "program_modification", "exercise_question",
@@ -8,10 +8,15 @@ from action_handlers.ad_response_handler import AdResponseHandler
 from action_handlers.core_action_handler import CoreActionHandler
 from action_handlers.calorie_action_handler import CalorieActionHandler
 from services.message_buffer import MessageBuffer
-from webhook_handlers import get_user_data
-from app.dashboard_modules.dashboard_sqlite_utils import get_user_metrics_json, is_user_in_calorie_flow
+from services.worker_pool import message_worker_pool
+from services.admission_control import admission_controller, MODE_BUFFER_ONLY
+from services.metrics import router_branch_total, router_seconds, db_queries_per_message, count_db_queries
+from services.request_context import RequestContext
+from services.intent_detector import detect_intents
 import logging
 from typing import Dict, Any, Optional, Tuple
+from datetime import datetime, timedelta
+from functools import partial
 import sys
 import os
 
@@ -27,26 +32,50 @@ class ActionRouter:
     @staticmethod
     async def route_webhook_message(ig_username: str, message_text: str, subscriber_id: str,
                                     first_name: str, last_name: str, user_message_timestamp_iso: str, fb_ad: bool = False) -> Dict[str, Any]:
+        """Route incoming webhook message to appropriate handlers, recording the branch taken."""
+        with router_seconds.time(branch="exception") as labels, count_db_queries() as db_queries:
+            try:
+                # One query for the user's row and recent history, shared by every branch and handler
+                ctx = RequestContext.load(ig_username, subscriber_id)
+                result = await ActionRouter._route_webhook_message(
+                    ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso, fb_ad,
+                    ctx)
+                labels["branch"] = result.get("status", "unknown") if isinstance(
+                    result, dict) else "unknown"
+                if isinstance(result, dict):
+                    result["decision_trace"] = ctx.decision_trace
+            finally:
+                router_branch_total.inc(branch=labels["branch"])
+                db_queries_per_message.observe(
+                    db_queries.count, branch=labels["branch"])
+        return result
+
+    @staticmethod
+    async def _route_webhook_message(ig_username: str, message_text: str, subscriber_id: str,
+                                     first_name: str, last_name: str, user_message_timestamp_iso: str, fb_ad: bool = False,
+                                     ctx: Optional[RequestContext] = None) -> Dict[str, Any]:
         """Route incoming webhook message to appropriate handlers."""
         try:
             logger.info(
                 f"[Router] Routing message from {ig_username}: '{message_text[:50]}...'")
 
+            if ctx is None:
+                ctx = RequestContext.load(ig_username, subscriber_id)
+
             # --- Early Ad Response Override ---
             # If this looks like a high-confidence ad response (e.g., "vegan challenge"),
             # handle it immediately before any calorie-flow overrides.
             try:
-                is_ad_response, scenario, ad_confidence = await AdResponseHandler.is_ad_response(
-                    ig_username, message_text, {"conversation_history": []}
-                )
+                is_ad_response, scenario, ad_confidence = AdResponseHandler.classify_ad_response(
+                    ig_username, message_text, {"conversation_history": []},
+                    ctx=ctx, stage="early_override"
+                ).as_tuple()
                 if is_ad_response and ad_confidence >= 85:
                     logger.info(
                         f"[Router] High-confidence ad response detected for {ig_username} (confidence: {ad_confidence}%) - overriding calorie flow checks")
-                    # Fetch metrics to pass along if available
-                    _, metrics_override, _ = get_user_data(ig_username, subscriber_id)
                     success = await AdResponseHandler.handle_ad_response(
                         ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso,
-                        scenario, metrics_override, fb_ad
+                        scenario, ctx.metrics, fb_ad
                     )
                     return {
                         "status": "processed_ad_response_override",
@@ -57,9 +86,9 @@ class ActionRouter:
 
             # --- Calorie Flow Override ---
             # If user is in the calorie flow, all messages go to the calorie handler first.
-            if is_user_in_calorie_flow(ig_username):
+            if ctx.is_in_calorie_flow:
                 handled = await CalorieActionHandler.handle_calorie_actions(
-                    ig_username, message_text, subscriber_id, first_name, last_name
+                    ig_username, message_text, subscriber_id, first_name, last_name, ctx=ctx
                 )
                 return {
                     "status": "processed_in_calorie_flow",
@@ -68,15 +97,12 @@ class ActionRouter:
 
             # Strict override: calorie tracking trigger must bypass ad flow
             try:
-                normalized = ' '.join(
-                    (message_text or '').strip().lower().split())
-                if normalized in ('track my cals', 'track my cals plz'):
+                if detect_intents(message_text).confidence("calorie_tracking"):
                     # If calorie setup is pending, process directly and skip buffering entirely
                     try:
-                        metrics_json = get_user_metrics_json(ig_username)
-                        if isinstance(metrics_json, dict) and metrics_json.get('pending_calorie_setup'):
+                        if ctx.metrics_json.get('pending_calorie_setup'):
                             handled = await CalorieActionHandler.handle_calorie_actions(
-                                ig_username, message_text, subscriber_id, first_name, last_name
+                                ig_username, message_text, subscriber_id, first_name, last_name, ctx=ctx
                             )
                             return {
                                 "status": "processed_calorie_pending_direct",
@@ -85,7 +111,7 @@ class ActionRouter:
                     except Exception:
                         pass
                     handled = await CalorieActionHandler.handle_calorie_actions(
-                        ig_username, message_text, subscriber_id, first_name, last_name
+                        ig_username, message_text, subscriber_id, first_name, last_name, ctx=ctx
                     )
                     return {
                         "status": "processed_calorie_trigger",
@@ -94,10 +120,9 @@ class ActionRouter:
 
                 # If the user is in pending calorie setup, route ALL messages to calorie handler to complete setup
                 try:
-                    metrics_json = get_user_metrics_json(ig_username)
-                    if isinstance(metrics_json, dict) and metrics_json.get('pending_calorie_setup'):
+                    if ctx.metrics_json.get('pending_calorie_setup'):
                         handled = await CalorieActionHandler.handle_calorie_actions(
-                            ig_username, message_text, subscriber_id, first_name, last_name
+                            ig_username, message_text, subscriber_id, first_name, last_name, ctx=ctx
                         )
                         return {
                             "status": "processed_calorie_pending",
@@ -108,33 +133,12 @@ class ActionRouter:
                 # Bypass ad flow for media URL only if user is already in calorie flow (pending or active)
                 if isinstance(message_text, str) and 'lookaside.fbsbx.com/ig_messaging_cdn/' in message_text:
                     try:
-                        _, m, _ = get_user_data(ig_username, subscriber_id)
-                        in_flow = False
-                        metrics_json = m.get('metrics_json') or {}
-                        if isinstance(metrics_json, dict):
-                            in_flow = bool(metrics_json.get(
-                                'pending_calorie_setup', False))
-                        if not in_flow:
-                            # Also check DB flag if present
-                            try:
-                                from app.dashboard_modules.dashboard_sqlite_utils import get_db_connection
-                                conn = get_db_connection()
-                                cur = conn.cursor()
-                                cur.execute(
-                                    'SELECT is_in_calorie_flow FROM users WHERE ig_username = ? LIMIT 1', (ig_username,))
-                                row = cur.fetchone()
-                                if row and (row[0] == 1 or row[0] == True):
-                                    in_flow = True
-                            except Exception:
-                                pass
-                            finally:
-                                try:
-                                    conn.close()
-                                except Exception:
-                                    pass
+                        # In flow if calorie setup is pending or the DB flag is set
+                        in_flow = bool(ctx.metrics_json.get(
+                            'pending_calorie_setup', False)) or ctx.is_in_calorie_flow
                         if in_flow:
                             handled = await CalorieActionHandler.handle_calorie_actions(
-                                ig_username, message_text, subscriber_id, first_name, last_name
+                                ig_username, message_text, subscriber_id, first_name, last_name, ctx=ctx
                             )
                             return {
                                 "status": "processed_food_media",
@@ -145,8 +149,8 @@ class ActionRouter:
             except Exception:
                 pass
 
-            # Get user data to determine routing strategy
-            _, metrics, _ = get_user_data(ig_username, subscriber_id)
+            # User data to determine routing strategy
+            metrics = ctx.metrics
 
             # --- Check if user is already in ad flow ---
             is_in_ad_flow = metrics.get('is_in_ad_flow', False)
@@ -170,9 +174,10 @@ class ActionRouter:
 
             # --- Ad Response Detection (for new ad responses) ---
             try:
-                is_ad_response, scenario, ad_confidence = await AdResponseHandler.is_ad_response(
-                    ig_username, message_text, metrics
-                )
+                is_ad_response, scenario, ad_confidence = AdResponseHandler.classify_ad_response(
+                    ig_username, message_text, metrics,
+                    ctx=ctx, stage="ad_detection"
+                ).as_tuple()
 
                 logger.info(
                     f"[Router] Ad detection complete for {ig_username}: is_ad={is_ad_response}, confidence={ad_confidence}%")
@@ -193,8 +198,8 @@ class ActionRouter:
                     f"[Router] Error in ad detection for {ig_username}: {e}")
                 # Continue to buffering if ad detection fails
 
-            # Check if user should use message buffering
-            if ActionRouter._should_use_buffering(metrics, message_text):
+            # Check if user should use message buffering (always, when shedding load)
+            if admission_controller.mode == MODE_BUFFER_ONLY or ActionRouter._should_use_buffering(metrics, message_text):
                 logger.info(
                     f"[Router] Using message buffering for {ig_username}")
 
@@ -225,7 +230,8 @@ class ActionRouter:
                     f"[Router] Processing immediately for {ig_username}")
 
                 success = await CoreActionHandler.detect_and_handle_action(
-                    ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso, fb_ad
+                    ig_username, message_text, subscriber_id, first_name, last_name, user_message_timestamp_iso, fb_ad,
+                    ctx=ctx
                 )
 
                 return {
@@ -242,6 +248,14 @@ class ActionRouter:
                 "message": f"Error processing message: {str(e)}"
             }
 
+    @staticmethod
+    async def route_webhook_message_ordered(**route_kwargs) -> Dict[str, Any]:
+        """Route a message on its subscriber's worker shard (in order per subscriber)."""
+        return await message_worker_pool.run(
+            route_kwargs.get("subscriber_id", ""),
+            partial(ActionRouter.route_webhook_message, **route_kwargs)
+        )
+
     @staticmethod
     def _should_use_buffering(metrics: Dict, message_text: str) -> bool:
         """Determine if message should use buffering."""
@@ -271,11 +285,10 @@ class ActionRouter:
                 last_timestamp = last_message.get('timestamp')
 
                 if last_timestamp:
-                    from datetime import datetime, timedelta
-                    import dateutil.parser
-
                     try:
-                        last_time = dateutil.parser.parse(last_timestamp)
+                        # ISO-8601 timestamps from the messages table / ManyChat
+                        last_time = datetime.fromisoformat(
+                            str(last_timestamp).strip().replace("Z", "+00:00"))
                         now = datetime.now(last_time.tzinfo)
 
                         # Use buffering if messages are close together (within 2 minutes)
@@ -321,18 +334,9 @@ class ActionRouter:
         """Get routing statistics."""
         try:
             # Get buffer stats for all active users
-            from services.message_buffer import manychat_message_buffer, user_buffer_task_scheduled
-
-            total_buffered = sum(len(buffer)
-                                 for buffer in manychat_message_buffer.values())
-            active_buffers = len(
-                [uid for uid, scheduled in user_buffer_task_scheduled.items() if scheduled])
-
-            return {
-                "total_buffered_messages": total_buffered,
-                "active_buffers": active_buffers,
-                "total_users_with_buffers": len(manychat_message_buffer)
-            }
+            stats = MessageBuffer.get_totals()
+            stats["worker_pool"] = message_worker_pool.get_stats()
+            return stats
 
         except Exception as e:
             logger.error(f"[Router] Error getting routing stats: {e}")
@@ -1,6 +1,12 @@
 import asyncio
+from typing import Optional
 
-async def get_ai_response(prompt: str) -> str:
+from services.admission_control import admission_controller
+from services.metrics import observe_gemini_call
+
+async def get_ai_response(prompt: str, site: str = "interactive",
+                          hedge_after: Optional[float] = None) -> str:
     # Simple deterministic fallback for cloud stub
-    await asyncio.sleep(0)
-    return "Heya! Appreciate the message — keen to help. What are your goals?"
+    with admission_controller.track_llm_call(), observe_gemini_call("default"):
+        await asyncio.sleep(0)
+        return "Heya! Appreciate the message — keen to help. What are your goals?"
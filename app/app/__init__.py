@@ -2,58 +2,42 @@
 Shanbot - A webhook-based chatbot with analytics dashboard
 """
 
+import importlib
 import logging
 
-# Try to import core components, but don't fail if they're missing
-try:
-    from .core import app, create_app, run_app
-except ImportError:
-    app = None
-    create_app = None
-    run_app = None
-
-try:
-    from .main import process_manychat_webhook
-except ImportError:
-    process_manychat_webhook = None
-except AttributeError:
-    # Handle attribute errors in module imports
-    process_manychat_webhook = None
-
-# Import modules that are known to exist and work
-# Comment out problematic imports for now
-try:
-    from .models import (
-        ExerciseDefinition,
-        WorkoutDefinition,
-        BuildProgramRequest,
-        MacroTracking,
-        MacrosData,
-        MealEntry,
-        CalorieTracking
-    )
-except ImportError:
-    # Define empty classes as fallbacks
-    class ExerciseDefinition:
-        pass
-
-    class WorkoutDefinition:
-        pass
-
-    class BuildProgramRequest:
-        pass
-
-    class MacroTracking:
-        pass
+# Core components and models are resolved lazily (PEP 562) so that importing a
+# light submodule such as app.schemas doesn't build the FastAPI app, load
+# uvicorn or build every pydantic model. Missing or broken modules resolve to
+# None (core) or an empty placeholder class (models), as before.
+_LAZY_ATTRIBUTES = {
+    "app": (".core", "app"),
+    "create_app": (".core", "create_app"),
+    "run_app": (".core", "run_app"),
+    "process_manychat_webhook": (".main", "process_manychat_webhook"),
+}
+_LAZY_MODELS = [
+    "ExerciseDefinition",
+    "WorkoutDefinition",
+    "BuildProgramRequest",
+    "MacroTracking",
+    "MacrosData",
+    "MealEntry",
+    "CalorieTracking",
+]
+_LAZY_ATTRIBUTES.update({name: (".models", name) for name in _LAZY_MODELS})
 
-    class MacrosData:
-        pass
 
-    class MealEntry:
-        pass
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attribute = _LAZY_ATTRIBUTES[name]
+    try:
+        value = getattr(importlib.import_module(module_name, __name__), attribute)
+    except (ImportError, AttributeError):
+        value = type(name, (), {}) if name in _LAZY_MODELS else None
+    globals()[name] = value
+    return value
 
-    class CalorieTracking:
-        pass
 
 # Import what's available from prompts module only
 try:
@@ -1,7 +1,11 @@
 import google.generativeai as genai
+import asyncio
 import logging
+import os
+import random
 import time
-from typing import Optional
+from contextlib import nullcontext
+from typing import Dict, Optional, Tuple
 from .config import (
     GEMINI_API_KEY,
     GEMINI_MODEL_PRO,
@@ -11,73 +15,241 @@ from .config import (
     MAX_RETRIES
 )
 
+try:
+    from services.metrics import (gemini_call_outcome, gemini_call_seconds, gemini_hedge_total,
+                                  gemini_hedge_saved_seconds)
+except ImportError:  # dashboard run without the webhook's services package
+    gemini_call_seconds = gemini_hedge_total = gemini_hedge_saved_seconds = None
+
+try:
+    from services.gemini_limiter import gemini_limiter
+    from services.model_registry import model_registry
+except ImportError:
+    gemini_limiter = model_registry = None
+
 logger = logging.getLogger(__name__)
 
-# Configure Gemini
+# Seconds a single generate_content call may take before it counts as failed
+GEMINI_CALL_TIMEOUT = float(os.getenv("GEMINI_CALL_TIMEOUT", "60"))
+
+# get_ai_response asks these in turn, hedging to the next when one is slow
+GEMINI_CASCADE = (GEMINI_MODEL_PRO, GEMINI_MODEL_FLASH,
+                  GEMINI_MODEL_FLASH_STANDARD)
+# Seconds to wait on the running models before also asking the next one, by call site
+HEDGE_AFTER_SECONDS = {
+    "interactive": float(os.getenv("GEMINI_HEDGE_INTERACTIVE", "8")),
+    "background": float(os.getenv("GEMINI_HEDGE_BACKGROUND", "45")),
+}
+
+# Configure Gemini (the registry defers it to the first call)
 try:
-    genai.configure(api_key=GEMINI_API_KEY)
+    if model_registry:
+        model_registry.configure(GEMINI_API_KEY)
+    else:
+        genai.configure(api_key=GEMINI_API_KEY)
 except Exception as e:
     logger.error(f"Failed to configure Gemini API: {e}", exc_info=True)
 
 
+def _get_model(model_name: str):
+    """Shared GenerativeModel from the registry, or a new one without it."""
+    if model_registry:
+        return model_registry.get(model_name)
+    return genai.GenerativeModel(model_name)
+
+
+def _backoff_delay(base: float) -> float:
+    """Jittered delay in [base/2, base], so callers rate-limited together don't retry together."""
+    return base / 2 + random.uniform(0, base / 2)
+
+
+def _next_attempt(model_name: str, error: Exception, retry_count: int,
+                  fallback: bool = True) -> Optional[Tuple[str, float]]:
+    """After a failed call, the (model, delay) to try next, or None to give up.
+
+    Rate limits retry the same model with a growing delay (PRO drops to FLASH);
+    other errors step down PRO -> FLASH -> FLASH_STANDARD. Without fallback
+    only same-model retries are allowed.
+    """
+    if retry_count >= MAX_RETRIES:
+        return None
+    if "429" in str(error):
+        if model_name == GEMINI_MODEL_PRO:
+            if not fallback:
+                return None
+            logger.warning(
+                f"Rate limit hit for {model_name}. Falling back to flash-thinking model after delay.")
+            return GEMINI_MODEL_FLASH, _backoff_delay(RETRY_DELAY)
+        wait_time = _backoff_delay(RETRY_DELAY * (retry_count + 1))
+        logger.warning(
+            f"Rate limit hit. Waiting {wait_time:.1f} seconds before retry {retry_count + 1} on {model_name}")
+        return model_name, wait_time
+    if not fallback:
+        return None
+    if model_name == GEMINI_MODEL_PRO:
+        logger.warning(
+            f"Main model failed: {error}. Trying first fallback model after delay.")
+        return GEMINI_MODEL_FLASH, _backoff_delay(RETRY_DELAY)
+    if model_name == GEMINI_MODEL_FLASH:
+        logger.warning(
+            f"First fallback model failed: {error}. Trying second fallback model after delay.")
+        return GEMINI_MODEL_FLASH_STANDARD, _backoff_delay(RETRY_DELAY)
+    return None
+
+
+def _observe_call(model_name: str, started: float, error: Optional[Exception] = None) -> None:
+    if not gemini_call_seconds:
+        return
+    gemini_call_seconds.observe(
+        time.perf_counter() - started, model=model_name, outcome=gemini_call_outcome(error))
+
+
 def call_gemini_with_retry(model_name: str, prompt: str, retry_count: int = 0) -> Optional[str]:
     """
     Call Gemini API with retry logic and multiple fallback models.
+
+    Blocks while it waits; code running on the event loop should await
+    a_call_gemini_with_retry instead.
+    """
+    while True:
+        started = time.perf_counter()
+        try:
+            with gemini_limiter.limit(model_name) if gemini_limiter else nullcontext():
+                model = _get_model(model_name)
+                response = model.generate_content(prompt)
+            _observe_call(model_name, started)
+            return response.text.strip()
+        except Exception as e:
+            _observe_call(model_name, started, e)
+            next_attempt = _next_attempt(model_name, e, retry_count)
+            if next_attempt is None:
+                logger.error(f"All Gemini attempts failed: {e}")
+                return None
+            model_name, delay = next_attempt
+            time.sleep(delay)
+            retry_count += 1
+
+
+async def a_call_gemini_with_retry(model_name: str, prompt: str, retry_count: int = 0,
+                                   timeout: float = GEMINI_CALL_TIMEOUT, fallback: bool = True) -> Optional[str]:
+    """
+    Async call_gemini_with_retry: same fallback chain, but the call and the
+    backoff never block the event loop. Each attempt is cut off after timeout
+    seconds and treated as a failed call. With fallback=False the call stays
+    on model_name (the hedged cascade runs the other models itself).
     """
+    while True:
+        started = time.perf_counter()
+        try:
+            async with gemini_limiter.limit_async(model_name) if gemini_limiter else nullcontext():
+                model = _get_model(model_name)
+                response = await asyncio.wait_for(model.generate_content_async(prompt), timeout)
+            _observe_call(model_name, started)
+            return response.text.strip()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = asyncio.TimeoutError(
+                    f"{model_name} did not respond within {timeout:g}s")
+            _observe_call(model_name, started, e)
+            next_attempt = _next_attempt(
+                model_name, e, retry_count, fallback)
+            if next_attempt is None:
+                logger.error(f"All Gemini attempts failed: {e}")
+                return None
+            model_name, delay = next_attempt
+            await asyncio.sleep(delay)
+            retry_count += 1
+
+
+async def _hedged_cascade(prompt: str, hedge_after: float, site: str) -> Optional[str]:
+    """Run the model cascade, starting the next model whenever the running ones
+    have been quiet for hedge_after seconds or have all failed. The first
+    non-empty answer wins and the other calls are cancelled."""
+    started = time.perf_counter()
+    models = list(GEMINI_CASCADE)
+    running: Dict[asyncio.Task, Tuple[str, float]] = {}
+    # When each model finished without an answer (for the saved-latency estimate)
+    failed_at: Dict[str, float] = {}
+
+    def launch() -> None:
+        model_name = models.pop(0)
+        task = asyncio.create_task(
+            a_call_gemini_with_retry(model_name, prompt, fallback=False))
+        running[task] = (model_name, time.perf_counter())
+        if len(running) > 1 or failed_at:
+            logger.info(
+                f"[Hedge] {site}: starting {model_name} after {time.perf_counter() - started:.1f}s")
+
     try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(prompt)
-        return response.text.strip()
-    except Exception as e:
-        if "429" in str(e) and retry_count < MAX_RETRIES:
-            if model_name == GEMINI_MODEL_PRO:
-                logger.warning(
-                    f"Rate limit hit for {model_name}. Falling back to flash-thinking model after delay.")
-                time.sleep(RETRY_DELAY)
-                return call_gemini_with_retry(GEMINI_MODEL_FLASH, prompt, retry_count + 1)
-            else:
-                wait_time = RETRY_DELAY * (retry_count + 1)
-                logger.warning(
-                    f"Rate limit hit. Waiting {wait_time} seconds before retry {retry_count + 1} on {model_name}")
-                time.sleep(wait_time)
-                return call_gemini_with_retry(model_name, prompt, retry_count + 1)
-        elif retry_count < MAX_RETRIES:
-            if model_name == GEMINI_MODEL_PRO:
-                logger.warning(
-                    f"Main model failed: {e}. Trying first fallback model after delay.")
-                time.sleep(RETRY_DELAY)
-                return call_gemini_with_retry(GEMINI_MODEL_FLASH, prompt, retry_count + 1)
-            elif model_name == GEMINI_MODEL_FLASH:
-                logger.warning(
-                    f"First fallback model failed: {e}. Trying second fallback model after delay.")
-                time.sleep(RETRY_DELAY)
-                return call_gemini_with_retry(GEMINI_MODEL_FLASH_STANDARD, prompt, retry_count + 1)
-        logger.error(f"All Gemini attempts failed: {e}")
+        launch()
+        while running:
+            done, _ = await asyncio.wait(
+                running, timeout=hedge_after if models else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Nobody answered within the budget: hedge with the next model
+                launch()
+                continue
+            for task in done:
+                model_name, model_started = running.pop(task)
+                response = None if task.cancelled() or task.exception() else task.result()
+                if response:
+                    _report_hedge_win(site, model_name, model_started,
+                                      started, failed_at, running)
+                    return response
+                failed_at[model_name] = time.perf_counter()
+            if not running and models:
+                launch()
+        logger.error(
+            f"[Hedge] {site}: all Gemini models failed after {time.perf_counter() - started:.1f}s")
+        if gemini_hedge_total:
+            gemini_hedge_total.inc(site=site, winner="none")
         return None
+    finally:
+        for task in running:
+            task.cancel()
+
+
+def _report_hedge_win(site: str, model_name: str, model_started: float, started: float,
+                      failed_at: Dict[str, float], still_running: Dict[asyncio.Task, Tuple[str, float]]) -> None:
+    """Log and record which model won and roughly how much waiting the hedge saved.
+
+    A plain cascade only starts a model once the one before it has given up,
+    so for a non-primary winner the saving is at least: when the primary
+    gave up (or now, if it's still running) + the winner's own latency -
+    the total we actually took.
+    """
+    now = time.perf_counter()
+    elapsed = now - started
+    primary = GEMINI_CASCADE[0]
+    saved = 0.0
+    if model_name != primary:
+        primary_done = failed_at.get(primary, now)
+        saved = max(0.0, (primary_done - started) +
+                    (now - model_started) - elapsed)
+    logger.info(
+        f"[Hedge] {site}: {model_name} answered in {elapsed:.1f}s "
+        f"(saved ~{saved:.1f}s, cancelled {len(still_running)} slower calls)")
+    if gemini_hedge_total:
+        gemini_hedge_total.inc(site=site, winner=model_name)
+        gemini_hedge_saved_seconds.observe(saved, site=site)
+
 
+async def get_ai_response(prompt: str, site: str = "interactive",
+                          hedge_after: Optional[float] = None) -> Optional[str]:
+    """Get AI response using Gemini models with fallbacks.
 
-async def get_ai_response(prompt: str) -> Optional[str]:
-    """Get AI response using Gemini models with fallbacks."""
+    PRO is asked first; if it hasn't answered within the call site's hedge
+    budget (HEDGE_AFTER_SECONDS[site], or hedge_after) FLASH is asked as well,
+    then FLASH_STANDARD, and the first answer wins.
+    """
     try:
-        # First try with GEMINI_MODEL_PRO
-        response = call_gemini_with_retry(GEMINI_MODEL_PRO, prompt)
-        if response:
-            return response
-
-        # If that fails, try GEMINI_MODEL_FLASH
-        logger.warning("Primary model failed, trying FLASH model...")
-        response = call_gemini_with_retry(GEMINI_MODEL_FLASH, prompt)
-        if response:
-            return response
-
-        # Last resort, try GEMINI_MODEL_FLASH_STANDARD
-        logger.warning("FLASH model failed, trying FLASH_STANDARD model...")
-        response = call_gemini_with_retry(GEMINI_MODEL_FLASH_STANDARD, prompt)
-        if response:
-            return response
-
-        logger.error("All Gemini models failed to generate response")
-        return None
+        if hedge_after is None:
+            hedge_after = HEDGE_AFTER_SECONDS.get(
+                site, HEDGE_AFTER_SECONDS["interactive"])
+        return await _hedged_cascade(prompt, hedge_after, site)
 
     except Exception as e:
         logger.error(f"Error getting AI response: {str(e)}")
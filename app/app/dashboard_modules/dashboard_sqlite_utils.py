@@ -20,6 +20,11 @@ import random
 import re  # Added for column type manipulation
 import json  # Added for JSON parsing
 
+try:
+    from services.metrics import InstrumentedConnection
+except ImportError:  # dashboard run without the webhook's services package
+    InstrumentedConnection = sqlite3.Connection
+
 logger = logging.getLogger(__name__)
 
 # Define the absolute path to the Instagram analyzer script
@@ -104,7 +109,7 @@ def get_db_connection():
     # The schema check should be done once at startup, not per-connection.
     # ensure_db_schema()
     conn = sqlite3.connect(
-        SQLITE_DB_PATH, check_same_thread=False, timeout=5.0)
+        SQLITE_DB_PATH, check_same_thread=False, timeout=5.0, factory=InstrumentedConnection)
     conn.row_factory = sqlite3.Row
     try:
         # Pragmas to improve read performance for dashboard workloads
@@ -1234,6 +1239,54 @@ def get_user_metrics_json(ig_username: str) -> dict:
             conn.close()
 
 
+def load_user_context(ig_username: str, subscriber_id: Optional[str] = None, history_limit: int = 40) -> Optional[dict]:
+    """Load a user's row and their most recent messages in a single query.
+
+    Used by the webhook's per-message RequestContext. Returns
+    {"user": {column: value}, "history": [{timestamp, type, text}]} with the
+    history in chronological order, or None if the user doesn't exist.
+    """
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            WITH u AS (
+                SELECT * FROM users
+                WHERE ig_username = ? OR (? != '' AND subscriber_id = ?)
+                ORDER BY ig_username = ? DESC
+                LIMIT 1
+            ),
+            recent AS (
+                SELECT m.timestamp,
+                       COALESCE(m.message_type, m.type, m.sender) AS msg_type,
+                       COALESCE(m.message_text, m.text, m.message) AS msg_text
+                FROM messages m JOIN u ON m.ig_username = u.ig_username
+                ORDER BY m.timestamp DESC
+                LIMIT ?
+            )
+            SELECT u.*, recent.timestamp AS msg_timestamp, recent.msg_type, recent.msg_text
+            FROM u LEFT JOIN recent ON 1 = 1
+            ORDER BY recent.timestamp ASC
+        """, (ig_username, subscriber_id or '', subscriber_id or '', ig_username, history_limit))
+        rows = cur.fetchall()
+        if not rows:
+            return None
+        message_columns = {'msg_timestamp', 'msg_type', 'msg_text'}
+        user = {key: rows[0][key]
+                for key in rows[0].keys() if key not in message_columns}
+        history = [{'timestamp': row['msg_timestamp'] or '',
+                    'type': row['msg_type'] or 'unknown',
+                    'text': row['msg_text']}
+                   for row in rows if row['msg_text'] and str(row['msg_text']).strip()]
+        return {'user': user, 'history': history}
+    except sqlite3.Error as e:
+        logger.error(f"Failed to load user context for {ig_username}: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+
 def set_user_metrics_json_field(ig_username: str, key: str, value: Any) -> bool:
     conn = get_db_connection()
     try:
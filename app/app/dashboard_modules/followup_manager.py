@@ -5,8 +5,9 @@ Handles follow-up scheduling, recent interactions, and bulk messaging tools
 
 import streamlit as st
 import logging
+from contextlib import nullcontext
 from datetime import datetime, timedelta
-from shared_utils import call_gemini_with_retry_sync, GEMINI_MODEL_PRO, GEMINI_API_KEY
+from shared_utils import call_gemini_with_retry_sync, generate_background_text, GEMINI_MODEL_PRO, GEMINI_API_KEY
 # Import specific functions we need - avoiding potential circular imports
 try:
     from followup_utils import (
@@ -28,6 +29,12 @@ from scheduled_followups import get_user_category, get_topic_for_category
 # Configure logging
 logger = logging.getLogger(__name__)
 
+try:
+    from services.gemini_limiter import gemini_limiter
+    from services.model_registry import model_registry
+except ImportError:  # dashboard run without the webhook's services package
+    gemini_limiter = model_registry = None
+
 # Local Gemini configuration to avoid circular imports
 try:
     import google.generativeai as genai
@@ -46,7 +53,10 @@ try:
 
     # Configure genai
     if GEMINI_API_KEY and GEMINI_API_KEY != "YOUR_GEMINI_API_KEY":
-        genai.configure(api_key=GEMINI_API_KEY)
+        if model_registry:
+            model_registry.configure(GEMINI_API_KEY)
+        else:
+            genai.configure(api_key=GEMINI_API_KEY)
         AI_AVAILABLE = True
     else:
         AI_AVAILABLE = False
@@ -82,8 +92,10 @@ def call_gemini_with_retry_sync(model_name: str, prompt: str) -> str:
     for attempt_model in unique_models:
         try:
             logger.info(f"Trying Gemini model: {attempt_model}")
-            model = genai.GenerativeModel(attempt_model)
-            response = model.generate_content(prompt)
+            model = model_registry.get(
+                attempt_model) if model_registry else genai.GenerativeModel(attempt_model)
+            with gemini_limiter.limit(attempt_model) if gemini_limiter else nullcontext():
+                response = model.generate_content(prompt)
             logger.info(f"✅ Success with model: {attempt_model}")
             return response.text.strip()
         except Exception as e:
@@ -267,7 +279,7 @@ if generate_follow_up_message is None:
 
             Generate ONLY the message, no other text:"""
 
-            return call_gemini_with_retry_sync(GEMINI_MODEL_PRO, prompt)
+            return generate_background_text(prompt, GEMINI_MODEL_PRO)
         except Exception as e:
             logger.error(f"Error generating message: {e}")
             return None
@@ -413,7 +425,7 @@ Example format:
 🤖 Share a cool fitness tech tip related to their Microsoft interest
 """
 
-        response = call_gemini_with_retry_sync(GEMINI_MODEL_PRO, prompt)
+        response = generate_background_text(prompt, GEMINI_MODEL_PRO)
         if response:
             # Split response into topics and clean up
             topics = [topic.strip()
@@ -11,7 +11,7 @@ import json
 import os
 
 # Assuming these imports are correct based on dashboard.py structure
-from shared_utils import get_user_topics, call_gemini_with_retry_sync, GEMINI_MODEL_PRO, GEMINI_API_KEY
+from shared_utils import get_user_topics, call_gemini_with_retry_sync, generate_background_text, GEMINI_MODEL_PRO, GEMINI_API_KEY
 from scheduled_followups import get_user_category, get_topic_for_category
 from dashboard_sqlite_utils import add_message_to_history
 
@@ -142,7 +142,7 @@ def generate_follow_up_message(conversation_history, topic, days_since_last=None
 
         Generate ONLY the message, no other text:"""
 
-        response_text = call_gemini_with_retry_sync(GEMINI_MODEL_PRO, prompt)
+        response_text = generate_background_text(prompt, GEMINI_MODEL_PRO)
         return response_text
     except Exception as e:
         st.error(f"Error generating message: {e}")
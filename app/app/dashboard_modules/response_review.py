@@ -27,6 +27,7 @@ import os
 from pathlib import Path
 import streamlit as st
 import logging
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 
 # Import prompts module
@@ -45,6 +46,15 @@ except ImportError:
 
 # Set up logger
 logger = logging.getLogger(__name__)
+try:
+    from services.gemini_limiter import llm_lane, LANE_REVIEW
+except ImportError:  # dashboard run without the webhook's services package
+    llm_lane, LANE_REVIEW = None, "review"
+try:
+    from services.prompt_budget import build_prompt
+    from services.conversation_summary import conversation_summaries
+except ImportError:  # dashboard run without the webhook's services package
+    build_prompt = conversation_summaries = None
 try:
     from shared_utils import call_gemini_with_retry_sync, GEMINI_MODEL_PRO, GEMINI_MODEL_FLASH
 except ImportError:
@@ -3296,12 +3306,10 @@ def regenerate_with_enhanced_context(user_ig_username: str, incoming_message: st
             # If cleaner not available, proceed with original list
             pass
 
-        # Format conversation history (now includes the combined user message block)
-        formatted_history_for_prompt_str = format_conversation_history(
-            enhanced_conversation_history)
-
         # Get few-shot examples based on prompt type
         few_shot_examples = get_few_shot_examples_for_prompt_type(prompt_type)
+        bio_context = ""
+        budget_type = prompt_type
 
         # Build prompt based on prompt type
         if prompt_type == 'facebook_ad_response':
@@ -3362,11 +3370,9 @@ def regenerate_with_enhanced_context(user_ig_username: str, incoming_message: st
                 "current_melbourne_time_str": get_melbourne_time_str(),
                 "ig_username": user_ig_username,
                 "script_state": chosen_state,
-                "ad_scenario": scenario_str,
-                "full_conversation": formatted_history_for_prompt_str
+                "ad_scenario": scenario_str
             }
-            enhanced_prompt_str = prompts.COMBINED_AD_RESPONSE_PROMPT_TEMPLATE.format_map(
-                prompt_data)
+            template = prompts.COMBINED_AD_RESPONSE_PROMPT_TEMPLATE
 
         elif prompt_type == 'member_chat':
             # Use member conversation template
@@ -3374,58 +3380,68 @@ def regenerate_with_enhanced_context(user_ig_username: str, incoming_message: st
                 "current_melbourne_time_str": get_melbourne_time_str(),
                 "ig_username": user_ig_username,
                 "first_name": calculated_full_name.split()[0] if calculated_full_name else user_ig_username,
-                "full_conversation": formatted_history_for_prompt_str,
                 "fitness_goals": metrics_dict_from_db.get('client_goals', ''),
                 "dietary_requirements": metrics_dict_from_db.get('dietary_requirements', ''),
-                "current_program": metrics_dict_from_db.get('current_program', ''),
-                "few_shot_examples": few_shot_examples
+                "current_program": metrics_dict_from_db.get('current_program', '')
             }
-            enhanced_prompt_str = prompts.MEMBER_CONVERSATION_PROMPT_TEMPLATE.format_map(
-                prompt_data)
+            template = prompts.MEMBER_CONVERSATION_PROMPT_TEMPLATE
 
         elif prompt_type == 'monday_morning_text':
             # Use Monday morning check-in template
             prompt_data = {
                 "current_melbourne_time_str": get_melbourne_time_str(),
                 "ig_username": user_ig_username,
-                "first_name": calculated_full_name.split()[0] if calculated_full_name else user_ig_username,
-                "full_conversation": formatted_history_for_prompt_str,
-                "few_shot_examples": few_shot_examples
+                "first_name": calculated_full_name.split()[0] if calculated_full_name else user_ig_username
             }
-            enhanced_prompt_str = prompts.MONDAY_MORNING_TEXT_PROMPT_TEMPLATE.format_map(
-                prompt_data)
+            template = prompts.MONDAY_MORNING_TEXT_PROMPT_TEMPLATE
 
         elif prompt_type == 'checkins':
             # Use general check-ins template
             prompt_data = {
                 "current_melbourne_time_str": get_melbourne_time_str(),
                 "ig_username": user_ig_username,
-                "first_name": calculated_full_name.split()[0] if calculated_full_name else user_ig_username,
-                "full_conversation": formatted_history_for_prompt_str,
-                "few_shot_examples": few_shot_examples
+                "first_name": calculated_full_name.split()[0] if calculated_full_name else user_ig_username
             }
-            enhanced_prompt_str = prompts.CHECKINS_PROMPT_TEMPLATE.format_map(
-                prompt_data)
+            template = prompts.CHECKINS_PROMPT_TEMPLATE
 
         else:  # general_chat (default)
             # Use the general chat and onboarding template
             prompt_data = {
                 "current_melbourne_time_str": get_melbourne_time_str(),
                 "ig_username": user_ig_username,
-                "bio_context": metrics_dict_from_db.get('bio_context', ''),
                 "weekly_workout_summary": metrics_dict_from_db.get('weekly_workout_summary', ''),
                 "meal_plan_summary": metrics_dict_from_db.get('meal_plan_summary', ''),
                 "current_stage": current_stage,
-                "trial_status": trial_status,
-                "full_conversation": formatted_history_for_prompt_str,
-                "few_shot_examples": few_shot_examples
+                "trial_status": trial_status
             }
-            enhanced_prompt_str = prompts.COMBINED_CHAT_AND_ONBOARDING_PROMPT_TEMPLATE.format_map(
-                prompt_data)
+            bio_context = metrics_dict_from_db.get('bio_context', '')
+            template = prompts.COMBINED_CHAT_AND_ONBOARDING_PROMPT_TEMPLATE
+            budget_type = "general_chat"
+
+        # Fill in history, examples and bio, trimmed to the prompt type's token budget
+        if build_prompt:
+            # Summary + recent tail when the user has a rolling summary (refreshed by the webhook)
+            history_summary, history_tail = conversation_summaries.prompt_history(
+                user_ig_username, enhanced_conversation_history)
+            enhanced_prompt_str = build_prompt(
+                budget_type, template, prompt_data,
+                history=history_tail,
+                history_summary=history_summary,
+                format_history=format_conversation_history,
+                few_shot_examples=few_shot_examples,
+                bio=bio_context)
+        else:
+            enhanced_prompt_str = template.format_map({
+                **prompt_data,
+                "full_conversation": format_conversation_history(enhanced_conversation_history),
+                "few_shot_examples": few_shot_examples,
+                "bio_context": bio_context
+            })
 
-        # Call Gemini with the appropriate prompt
-        generated_response = call_gemini_with_retry_sync(
-            GEMINI_MODEL_PRO, enhanced_prompt_str)
+        # Call Gemini with the appropriate prompt (queued behind live DMs)
+        with llm_lane(LANE_REVIEW) if llm_lane else nullcontext():
+            generated_response = call_gemini_with_retry_sync(
+                GEMINI_MODEL_PRO, enhanced_prompt_str)
 
         if not generated_response:
             logger.warning(
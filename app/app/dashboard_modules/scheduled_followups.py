@@ -7,6 +7,7 @@ import json
 import google.oauth2.service_account
 import googleapiclient.discovery
 import logging
+from contextlib import nullcontext
 from googleapiclient.discovery import build
 
 # Configure Gemini
@@ -23,6 +24,11 @@ ONBOARDING_RANGE_NAME = "Sheet1!A:AAF"
 # Set up logging
 logger = logging.getLogger(__name__)
 
+try:
+    from services.gemini_limiter import gemini_limiter, llm_lane, LANE_BULK
+except ImportError:  # dashboard run without the webhook's services package
+    gemini_limiter, llm_lane, LANE_BULK = None, None, "bulk"
+
 
 def get_user_category(user_data: Dict[str, Any]) -> str:
     """Determine the user's current category/stage"""
@@ -210,8 +216,9 @@ def generate_follow_up_message(conversation_history: List[Dict[str, Any]], topic
 
     for model_name in models:
         try:
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content(prompt)
+            with gemini_limiter.limit(model_name) if gemini_limiter else nullcontext():
+                model = genai.GenerativeModel(model_name)
+                response = model.generate_content(prompt)
             return response.text.strip()
         except Exception as e:
             if '429' in str(e):
@@ -262,6 +269,12 @@ def get_user_bio(user_data: Dict[str, Any]) -> str:
 
 def bulk_generate_followups(analytics_data: Dict[str, Any], followup_data: Dict[str, Any]):
     """Generate follow-ups for all users ready and store in session state."""
+    # Bulk generation yields the Gemini quota to live DMs
+    with llm_lane(LANE_BULK) if llm_lane else nullcontext():
+        _bulk_generate_followups(analytics_data, followup_data)
+
+
+def _bulk_generate_followups(analytics_data: Dict[str, Any], followup_data: Dict[str, Any]):
     bulk = []
     # To avoid issues if a user is in followup_data but somehow not in analytics_data main/conversations keys as expected
     processed_usernames = set()
@@ -4,11 +4,24 @@ Contains common functions used across multiple dashboard modules
 """
 
 import streamlit as st
+import asyncio
 import json
 import logging
+import threading
+from contextlib import nullcontext
 from datetime import datetime
 import google.generativeai as genai
 
+try:
+    from services.gemini_limiter import gemini_limiter
+except ImportError:  # dashboard run without the webhook's services package
+    gemini_limiter = None
+
+try:
+    from app.ai_handler import get_ai_response
+except ImportError:  # dashboard run without the webhook's app package
+    get_ai_response = None
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
@@ -34,6 +47,46 @@ if GEMINI_API_KEY and GEMINI_API_KEY != "YOUR_GEMINI_API_KEY" and GEMINI_API_KEY
         logger.error(f"Error configuring Gemini: {e}")
 
 
+# Event loop for background generation, shared by every dashboard rerun.
+# The registry's cached models keep their async client on the loop they first
+# ran on, so all hedged calls from the dashboard go through this one loop.
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def _get_background_loop() -> asyncio.AbstractEventLoop:
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever,
+                             name="background-generation", daemon=True).start()
+    return _background_loop
+
+
+def generate_background_text(prompt: str, model_name: str = GEMINI_MODEL_PRO) -> str:
+    """
+    Text for a message nobody is waiting on (follow-ups, topic suggestions).
+
+    Uses the webhook's hedged model cascade with its background budget, so a
+    slow primary model is given longer before the next one is asked. Falls
+    back to call_gemini_with_retry_sync(model_name, prompt) when that isn't
+    available or returns nothing.
+    """
+    if get_ai_response:
+        try:
+            response = asyncio.run_coroutine_threadsafe(
+                get_ai_response(prompt, site="background"), _get_background_loop()).result()
+            if response and response.strip():
+                return response.strip()
+            logger.warning(
+                f"Hedged background generation returned nothing, falling back to {model_name}")
+        except Exception as e:
+            logger.warning(
+                f"Hedged background generation failed, falling back to {model_name}: {e}")
+    return call_gemini_with_retry_sync(model_name, prompt)
+
+
 def call_gemini_with_retry_sync(model_name: str, prompt: str, retry_count: int = 0) -> str:
     """
     Synchronous version of call_gemini_with_retry with 5-model fallback system.
@@ -47,8 +100,9 @@ def call_gemini_with_retry_sync(model_name: str, prompt: str, retry_count: int =
         str: Generated response text
     """
     try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(prompt)
+        with gemini_limiter.limit(model_name) if gemini_limiter else nullcontext():
+            model = genai.GenerativeModel(model_name)
+            response = model.generate_content(prompt)
         return response.text.strip()
 
     except Exception as e:
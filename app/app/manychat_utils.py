@@ -3,8 +3,14 @@ import json
 import logging
 from typing import Dict, Any  # Added Any for field_value flexibility
 import os
+import time
 from datetime import datetime
 
+try:
+    from services.metrics import manychat_update_seconds
+except ImportError:  # dashboard run without the webhook's services package
+    manychat_update_seconds = None
+
 # Configure logging - assuming a logger might be set up globally in the app
 # If not, you might want to configure a specific logger here.
 logger = logging.getLogger(__name__)  # Use __name__ for module-specific logger
@@ -62,6 +68,8 @@ def update_manychat_fields(subscriber_id: str, field_updates: Dict[str, Any]) ->
         f"Attempting to update ManyChat fields for subscriber {subscriber_id}: {list(filtered_updates.keys())}")
     logger.debug(f"ManyChat API Request Payload: {json.dumps(data, indent=2)}")
 
+    started = time.perf_counter()
+    outcome = "error"
     try:
         response = requests.post(
             "https://api.manychat.com/fb/subscriber/setCustomFields",
@@ -73,10 +81,12 @@ def update_manychat_fields(subscriber_id: str, field_updates: Dict[str, Any]) ->
 
         response_data = response.json()
         if response_data.get("status") == "success":
+            outcome = "ok"
             logger.info(
                 f"Successfully updated ManyChat fields for subscriber {subscriber_id}. Response: {response_data}")
             return True
         else:
+            outcome = "failed"
             logger.error(
                 f"ManyChat API reported failure for subscriber {subscriber_id}. Status: {response_data.get('status')}, Message: {response_data.get('message')}, Details: {response_data.get('details')}")
             return False
@@ -93,6 +103,10 @@ def update_manychat_fields(subscriber_id: str, field_updates: Dict[str, Any]) ->
         logger.error(
             f"Unexpected error during ManyChat field update for {subscriber_id}: {e}", exc_info=True)
         return False
+    finally:
+        if manychat_update_seconds:
+            manychat_update_seconds.observe(
+                time.perf_counter() - started, outcome=outcome)
 
 
 if __name__ == '__main__':
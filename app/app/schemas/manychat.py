@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Dict, Any, Optional, List, Union
 from enum import Enum
 
@@ -31,6 +31,33 @@ class WebhookPayload(BaseModel):
     first_name: Optional[str] = None
 
 
+class InstagramMessagePayload(BaseModel):
+    """Flat subscriber payload posted by the ManyChat Instagram DM flow"""
+    id: str
+    ig_username: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    last_input_text: str = ""
+    ig_last_interaction: Optional[str] = None
+    custom_fields: Dict[str, Any] = Field(default_factory=dict)
+
+    @field_validator("id", mode="before")
+    @classmethod
+    def _coerce_id(cls, value):
+        # ManyChat sends the subscriber id as a number in some flows
+        return str(value) if isinstance(value, int) else value
+
+    @field_validator("last_input_text", mode="before")
+    @classmethod
+    def _none_text_to_empty(cls, value):
+        return "" if value is None else value
+
+    @field_validator("custom_fields", mode="before")
+    @classmethod
+    def _none_fields_to_empty(cls, value):
+        return {} if value is None else value
+
+
 class WebhookResponse(BaseModel):
     """Response structure for ManyChat webhooks"""
     success: bool = True
@@ -1,6 +1,8 @@
 import logging, json
 from typing import Dict, Optional
 
+from services.metrics import observe_db_query
+
 logger = logging.getLogger("dashboard_sqlite_utils_stub")
 
 # very lightweight in-memory store for cloud runtime
@@ -42,6 +44,21 @@ def get_user_metrics_json(ig_username: str) -> Dict:
     return __USER_METRICS.get(ig_username, {}).copy()
 
 
+def load_user_context(ig_username: str, subscriber_id: Optional[str] = None, history_limit: int = 40) -> Optional[Dict]:
+    metrics = __USER_METRICS.get(ig_username)
+    if metrics is None:
+        return None
+    return {
+        "user": {
+            "ig_username": ig_username,
+            "subscriber_id": subscriber_id,
+            "metrics_json": json.dumps(metrics),
+            "is_in_calorie_flow": int(bool(metrics.get("in_calorie_flow"))),
+        },
+        "history": [],
+    }
+
+
 def set_user_metrics_json_field(ig_username: str, key: str, value) -> None:
     m = __USER_METRICS.setdefault(ig_username, {})
     m[key] = value
@@ -80,6 +97,9 @@ class _Cursor:
         self.user = user
         self._row = None
     def execute(self, sql: str, params: tuple = ()):  # noqa: ANN001
+        with observe_db_query(sql):
+            self._execute(sql, params)
+    def _execute(self, sql: str, params: tuple = ()):  # noqa: ANN001
         sql_low = (sql or "").lower()
         if "select metrics_json from users" in sql_low:
             data = __USER_METRICS.get(self.user, {}).copy()
@@ -0,0 +1,66 @@
+"""
+Gemini Model Setup Microbenchmark
+================================
+Compares the per-call setup cost of building a new genai.GenerativeModel
+for every request (the old call paths) against a ModelRegistry lookup, with
+and without a generation config, and reports the one-off cost of importing
+google.generativeai that modules used to pay at import time.
+
+No requests are sent: constructing a model doesn't touch the network.
+
+Run from the repo root:
+    python benchmarks/bench_model_setup.py [--iterations 20000]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+from services.model_registry import ModelRegistry  # noqa: E402
+
+MODEL_NAME = "gemini-2.0-flash-thinking-exp-01-21"
+CASES = {
+    "bare": None,
+    "config": {"temperature": 0.7, "max_output_tokens": 2048},
+}
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import google.generativeai; "
+    "print(time.perf_counter() - started)"
+)
+
+
+def sdk_import_ms() -> float:
+    """Cold import time of google.generativeai, measured in a fresh interpreter."""
+    result = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET],
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip()) * 1e3
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    registry = ModelRegistry()
+    genai = registry.genai()
+
+    print(f"SDK import (once per process): {sdk_import_ms():.1f} ms")
+    print(f"{'case':<8} {'new us/call':>12} {'registry us/call':>17} {'saved':>8}")
+    for name, config in CASES.items():
+        kwargs = {"generation_config": config} if config else {}
+        old = min(timeit.repeat(lambda: genai.GenerativeModel(MODEL_NAME, **kwargs),
+                  number=args.iterations, repeat=5)) / args.iterations * 1e6
+        new = min(timeit.repeat(lambda: registry.get(MODEL_NAME, config),
+                  number=args.iterations, repeat=5)) / args.iterations * 1e6
+        print(f"{name:<8} {old:>12.2f} {new:>17.2f} {(1 - new / old) * 100:>7.1f}%")
+
+
+if __name__ == "__main__":
+    main()
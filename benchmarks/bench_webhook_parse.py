@@ -0,0 +1,99 @@
+"""
+Webhook Parse Microbenchmark
+===========================
+Compares the per-request CPU cost of the old /webhook/manychat parse path
+(json.loads of the body, then json.dumps(indent=2) of the whole payload for
+an INFO log line) against the single-parse path (pydantic-core
+model_validate_json into InstagramMessagePayload plus a one-line log).
+
+Run from the repo root:
+    python benchmarks/bench_webhook_parse.py [--iterations 20000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.app.schemas.manychat import InstagramMessagePayload  # noqa: E402
+
+SAMPLE_PAYLOADS = {
+    "text_dm": {
+        "id": "1234567890123456",
+        "key": "user:1234567890123456",
+        "page_id": "2204732",
+        "status": "active",
+        "first_name": "Sarah",
+        "last_name": "Nguyen",
+        "name": "Sarah Nguyen",
+        "ig_username": "sarah.plantpowered",
+        "ig_id": 17841400000000000,
+        "ig_last_interaction": "2026-10-17T09:41:12+11:00",
+        "ig_last_seen": "2026-10-17T09:41:12+11:00",
+        "last_input_text": "hey! saw your vegan challenge ad, keen to know more",
+        "subscribed": "2026-10-17T09:40:58+11:00",
+        "custom_fields": {"fb ad": False, "conversation": "", "response time": None},
+    },
+    "media_dm": {
+        "id": 9876543210987654,
+        "first_name": "Tom",
+        "last_name": None,
+        "ig_username": None,
+        "ig_last_interaction": "2026-10-17T12:03:44+11:00",
+        "last_input_text": "https://lookaside.fbsbx.com/ig_messaging_cdn/?asset_id=18023456789012345&signature=AbC-dEf_123.xyz~456",
+        "custom_fields": {"fb ad": True},
+    },
+}
+
+
+class _Logger:
+    """Stand-in logger that formats but discards, like a filtered handler would."""
+
+    def info(self, message):
+        return message
+
+
+def old_path(body: bytes, log: _Logger) -> dict:
+    data = json.loads(body)
+    log.info(f"Received ManyChat webhook: {json.dumps(data, indent=2)}")
+    return {
+        "subscriber_id": data.get("id"),
+        "ig_username": data.get("ig_username"),
+        "message_text": data.get("last_input_text", ""),
+        "fb_ad": data.get("custom_fields", {}).get("fb ad", False),
+    }
+
+
+def new_path(body: bytes, log: _Logger) -> dict:
+    payload = InstagramMessagePayload.model_validate_json(body)
+    log.info(
+        f"Received ManyChat webhook from subscriber {payload.id} ({len(payload.last_input_text)} chars)")
+    return {
+        "subscriber_id": payload.id,
+        "ig_username": payload.ig_username,
+        "message_text": payload.last_input_text,
+        "fb_ad": payload.custom_fields.get("fb ad", False),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    log = _Logger()
+    print(f"{'payload':<10} {'old us/req':>11} {'new us/req':>11} {'saved':>8}")
+    for name, sample in SAMPLE_PAYLOADS.items():
+        body = json.dumps(sample).encode("utf-8")
+        old = min(timeit.repeat(lambda: old_path(body, log),
+                  number=args.iterations, repeat=5)) / args.iterations * 1e6
+        new = min(timeit.repeat(lambda: new_path(body, log),
+                  number=args.iterations, repeat=5)) / args.iterations * 1e6
+        print(f"{name:<10} {old:>11.2f} {new:>11.2f} {(1 - new / old) * 100:>7.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+"""
+Webhook Load Test
+================
+Drives /webhook/manychat with synthetic ManyChat payloads and reports
+latency percentiles, throughput, buffer flushes and DB time per request.
+
+Payload mix (weights set with --mix):
+    fb_lead    Facebook-lead DM with a null ig_username
+    media      Instagram CDN media URL
+    cals       "track my cals" calorie-tracking trigger
+    vegan_ad   reply to the vegan challenge ad
+    chat       ordinary short DM
+
+Gemini and ManyChat are replaced by local stand-ins whose latency is drawn
+from a distribution spec: fixed:MS, uniform:LO,HI, normal:MEAN,SD,
+lognormal:MEDIAN,SIGMA or exp:MEAN (all in milliseconds).
+
+Run from the repo root:
+    # In-process, through the ASGI transport (stand-ins installed here)
+    python benchmarks/webhook_load_test.py --requests 500 --concurrency 20
+
+    # Over localhost against a server started with the stand-ins
+    python benchmarks/webhook_load_test.py serve --port 8011 &
+    python benchmarks/webhook_load_test.py --url http://127.0.0.1:8011
+
+Buffer flush counts and DB timings come from the stand-ins, so they are only
+reported in-process, or fetched from the `serve` process's /loadtest/stats.
+"""
+
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# (module, attribute) pairs replaced by the Gemini and ManyChat stand-ins,
+# wherever they have been imported
+GEMINI_TARGETS = [
+    ("webhook_handlers", "get_ai_response"),
+    ("webhook_handlers", "call_gemini_with_retry"),
+    ("webhook_handlers", "a_call_gemini_with_retry"),
+    ("app.ai_handler", "get_ai_response"),
+]
+MANYCHAT_TARGETS = [
+    ("webhook_handlers", "send_manychat_message"),
+    ("webhook_handlers", "update_manychat_fields"),
+]
+# Every public function of this module counts as DB time, plus get_user_data
+DB_MODULE = "app.dashboard_modules.dashboard_sqlite_utils"
+USER_DATA_TARGET = ("webhook_handlers", "get_user_data")
+
+DEFAULT_MIX = "fb_lead=2,media=1,cals=2,vegan_ad=3,chat=4"
+
+FIRST_NAMES = ["Sarah", "Tom", "Priya", "Jake", "Mia", "Liam", "Chloe", "Noah"]
+CHAT_TEXTS = ["hey!", "thanks heaps", "sounds good", "what time works?",
+              "legs are so sore today haha", "can I swap tofu for tempeh?"]
+VEGAN_AD_TEXTS = ["Vegan challenge", "Hey I saw your ad about the vegan challenge, keen!",
+                  "Is the 28 day vegan challenge still running?", "VEGAN CHALLENGE 🌱"]
+CALS_TEXTS = ["track my cals", "Track my calories", "can you track my cals please"]
+
+
+class LatencyDistribution:
+    """Stand-in latency sampler, built from a spec like 'lognormal:900,0.5'."""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, raw_params = spec.partition(":")
+        self.kind = kind.lower()
+        self.params = [float(p) for p in raw_params.split(",") if p]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2,
+                    "lognormal": 2, "exp": 1}.get(self.kind)
+        if expected is None or len(self.params) != expected:
+            raise ValueError(f"Bad latency spec {spec!r}")
+
+    def sample(self) -> float:
+        """One latency in seconds."""
+        p = self.params
+        if self.kind == "fixed":
+            ms = p[0]
+        elif self.kind == "uniform":
+            ms = random.uniform(p[0], p[1])
+        elif self.kind == "normal":
+            ms = random.gauss(p[0], p[1])
+        elif self.kind == "lognormal":
+            ms = p[0] * random.lognormvariate(0, p[1])
+        else:
+            ms = random.expovariate(1 / p[0]) if p[0] > 0 else 0
+        return max(ms, 0) / 1000
+
+
+class StandIns:
+    """Gemini/ManyChat stand-ins plus DB and buffer instrumentation for the running app."""
+
+    def __init__(self, gemini_latency: LatencyDistribution, manychat_latency: LatencyDistribution):
+        self.gemini_latency = gemini_latency
+        self.manychat_latency = manychat_latency
+        self.counters: Counter = Counter()
+        self.db_seconds = 0.0
+
+    # --- Patching ---
+
+    @staticmethod
+    def _replace_everywhere(original: Any, replacement: Any) -> int:
+        """Rebind every module-level reference to original (covers `from x import y`)."""
+        replaced = 0
+        for module in list(sys.modules.values()):
+            namespace = getattr(module, "__dict__", None)
+            if not namespace:
+                continue
+            for name, value in list(namespace.items()):
+                if value is original:
+                    setattr(module, name, replacement)
+                    replaced += 1
+        return replaced
+
+    def _stand_in(self, original: Callable, counter: str, latency: LatencyDistribution,
+                  result: Any) -> Callable:
+        if inspect.iscoroutinefunction(original):
+            async def async_stand_in(*args, **kwargs):
+                self.counters[counter] += 1
+                await asyncio.sleep(latency.sample())
+                return result
+            return async_stand_in
+
+        def sync_stand_in(*args, **kwargs):
+            self.counters[counter] += 1
+            time.sleep(latency.sample())  # blocking, like the real sync SDK call
+            return result
+        return sync_stand_in
+
+    def _timed(self, original: Callable, adapt: Optional[Callable] = None) -> Callable:
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                value = original(*args, **kwargs)
+                return adapt(value, *args) if adapt else value
+            finally:
+                self.counters["db_calls"] += 1
+                self.db_seconds += time.perf_counter() - started
+        return timed
+
+    def install(self) -> None:
+        """Load the router and handlers, then patch Gemini, ManyChat and the DB layer."""
+        import importlib
+        import calendly_integration
+        importlib.import_module("action_router")
+        from services.message_buffer import MessageBuffer
+
+        async def no_bookings():
+            return 0
+        calendly_integration.calendly_poller.poll_once = no_bookings
+
+        reply = "Heya! Love that — what's your main goal right now?"
+        for targets, counter, latency, result in (
+                (GEMINI_TARGETS, "gemini_calls", self.gemini_latency, reply),
+                (MANYCHAT_TARGETS, "manychat_calls", self.manychat_latency, None)):
+            for module_name, attribute in targets:
+                original = getattr(sys.modules.get(module_name), attribute, None)
+                if original is not None:
+                    self._replace_everywhere(
+                        original, self._stand_in(original, counter, latency, result))
+
+        db_module = sys.modules[DB_MODULE]
+        for name, function in list(vars(db_module).items()):
+            if inspect.isfunction(function) and function.__module__ == DB_MODULE and not name.startswith("_"):
+                self._replace_everywhere(function, self._timed(function))
+
+        get_user_data = getattr(sys.modules.get(USER_DATA_TARGET[0]), USER_DATA_TARGET[1], None)
+        if get_user_data is not None:
+            adapt = None
+            if len(inspect.signature(get_user_data).parameters) == 1:
+                # The cloud stub returns a metrics dict; the router expects the
+                # full (conversations, metrics, user_id) lookup
+                def adapt(metrics, ig_username=None, subscriber_id=None):
+                    return [], metrics, subscriber_id
+
+                def call(ig_username, subscriber_id=None):
+                    return get_user_data(ig_username)
+                self._replace_everywhere(get_user_data, self._timed(call, adapt))
+            else:
+                self._replace_everywhere(get_user_data, self._timed(get_user_data))
+
+        process_claimed = MessageBuffer._process_claimed_messages
+
+        async def counted_flush(subscriber_id: str, messages: List[Dict],
+                                claimed_at: Optional[float] = None) -> None:
+            self.counters["buffer_flushes"] += 1
+            self.counters["buffer_flushed_messages"] += len(messages)
+            await process_claimed(subscriber_id, messages, claimed_at)
+        MessageBuffer._process_claimed_messages = staticmethod(counted_flush)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.counters, "db_seconds": self.db_seconds}
+
+
+# --- Payloads ---
+
+def make_payload(kind: str, subscriber_index: int) -> Dict[str, Any]:
+    """A ManyChat webhook body shaped like the real ones for the given message kind."""
+    first_name = FIRST_NAMES[subscriber_index % len(FIRST_NAMES)]
+    payload = {
+        "id": str(1_000_000_000_000_000 + subscriber_index),
+        "first_name": first_name,
+        "last_name": "Test",
+        "ig_username": f"{first_name.lower()}_{subscriber_index}",
+        # Unique per delivery so the idempotency filter lets every request through
+        "ig_last_interaction": f"{datetime.now(timezone.utc).isoformat()}#{uuid.uuid4().hex[:8]}",
+        "custom_fields": {"fb ad": False},
+    }
+    if kind == "fb_lead":
+        payload.update(ig_username=None, last_input_text=random.choice(VEGAN_AD_TEXTS),
+                       custom_fields={"fb ad": True})
+    elif kind == "media":
+        payload["last_input_text"] = (
+            "https://lookaside.fbsbx.com/ig_messaging_cdn/?asset_id="
+            f"{random.randint(10 ** 16, 10 ** 17)}&signature=AbC-dEf_123")
+    elif kind == "cals":
+        payload["last_input_text"] = random.choice(CALS_TEXTS)
+    elif kind == "vegan_ad":
+        payload.update(last_input_text=random.choice(VEGAN_AD_TEXTS),
+                       custom_fields={"fb ad": True})
+    else:
+        payload["last_input_text"] = random.choice(CHAT_TEXTS)
+    return payload
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+# --- Driver ---
+
+async def drive(client, requests: int, concurrency: int, subscribers: int,
+                mix: Dict[str, float]) -> Dict[str, Any]:
+    """Send the requests with bounded concurrency; returns latencies and outcomes."""
+    kinds, weights = list(mix), list(mix.values())
+    latencies: List[float] = []
+    outcomes: Counter = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(index: int) -> None:
+        payload = make_payload(random.choices(kinds, weights)[0],
+                               random.randrange(subscribers))
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post("/webhook/manychat", json=payload)
+                latencies.append(time.perf_counter() - started)
+                body = response.json() if response.headers.get(
+                    "content-type", "").startswith("application/json") else {}
+                result = body.get("result") if isinstance(
+                    body.get("result"), dict) else {}
+                outcomes[f"{response.status_code} {result.get('status') or body.get('status', '')}".strip()] += 1
+            except Exception as e:
+                latencies.append(time.perf_counter() - started)
+                outcomes[f"exception {type(e).__name__}"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return {"latencies": latencies, "outcomes": outcomes,
+            "elapsed": time.perf_counter() - started}
+
+
+async def wait_for_buffers(timeout: float) -> None:
+    """Wait until every buffered message has been flushed and processed."""
+    from services.message_buffer import MessageBuffer
+    from services.worker_pool import message_worker_pool
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        totals = MessageBuffer.get_totals()
+        if (not totals.get("total_buffered_messages")
+                and not totals.get("pending_flushes")
+                and message_worker_pool.total_depth() == 0):
+            return
+        await asyncio.sleep(0.1)
+
+
+async def run_in_process(args, stand_ins: StandIns) -> Dict[str, Any]:
+    import httpx
+    import webhook_main
+    import services.message_buffer as message_buffer
+
+    message_buffer.BUFFER_WINDOW = args.buffer_window
+    stand_ins.install()
+    transport = httpx.ASGITransport(app=webhook_main.app)
+    async with webhook_main.app.router.lifespan_context(webhook_main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest",
+                                     timeout=args.timeout) as client:
+            run = await drive(client, args.requests, args.concurrency,
+                              args.subscribers, parse_mix(args.mix))
+        await wait_for_buffers(args.buffer_window * 3 + 10)
+    run["stats"] = stand_ins.get_stats()
+    return run
+
+
+async def run_over_http(args) -> Dict[str, Any]:
+    import httpx
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        run = await drive(client, args.requests, args.concurrency,
+                          args.subscribers, parse_mix(args.mix))
+        await asyncio.sleep(args.buffer_window + 1)  # let the server flush buffers
+        try:
+            run["stats"] = (await client.get("/loadtest/stats")).json()
+        except Exception:
+            run["stats"] = {}
+    return run
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1,
+                max(0, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def build_report(run: Dict[str, Any], args) -> Dict[str, Any]:
+    latencies = sorted(run["latencies"])
+    stats = run.get("stats") or {}
+    requests = len(latencies)
+    report = {
+        "target": args.url or "in-process (ASGI)",
+        "requests": requests,
+        "concurrency": args.concurrency,
+        "elapsed_seconds": round(run["elapsed"], 3),
+        "requests_per_second": round(requests / run["elapsed"], 1) if run["elapsed"] else 0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0,
+            "mean": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0,
+        },
+        "outcomes": dict(run["outcomes"]),
+        "gemini_calls": stats.get("gemini_calls"),
+        "manychat_calls": stats.get("manychat_calls"),
+        "buffer_flushes": stats.get("buffer_flushes"),
+        "buffer_flushed_messages": stats.get("buffer_flushed_messages"),
+        "db_calls_per_request": round(stats["db_calls"] / requests, 2) if "db_calls" in stats and requests else None,
+        "db_ms_per_request": round(stats["db_seconds"] * 1000 / requests, 3) if "db_seconds" in stats and requests else None,
+    }
+    return report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    latency = report["latency_ms"]
+    print(f"Target:        {report['target']}")
+    print(f"Requests:      {report['requests']} at concurrency {report['concurrency']} "
+          f"in {report['elapsed_seconds']}s ({report['requests_per_second']} req/s)")
+    print(f"Latency (ms):  p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  "
+          f"max {latency['max']}  mean {latency['mean']}")
+    print("Outcomes:      " + ", ".join(f"{key}: {count}" for key,
+          count in sorted(report["outcomes"].items())))
+    print(f"Gemini calls:  {report['gemini_calls']}   ManyChat calls: {report['manychat_calls']}")
+    print(f"Buffer:        {report['buffer_flushes']} flushes "
+          f"({report['buffer_flushed_messages']} messages)")
+    print(f"DB:            {report['db_calls_per_request']} calls, "
+          f"{report['db_ms_per_request']} ms per request")
+
+
+def serve(args, stand_ins: StandIns) -> None:
+    """Run the webhook over localhost with the stand-ins installed."""
+    import uvicorn
+    import webhook_main
+    import services.message_buffer as message_buffer
+
+    message_buffer.BUFFER_WINDOW = args.buffer_window
+    stand_ins.install()
+
+    @webhook_main.app.get("/loadtest/stats")
+    async def loadtest_stats():
+        return stand_ins.get_stats()
+
+    uvicorn.run(webhook_main.app, host="127.0.0.1", port=args.port,
+                log_level="warning", access_log=False, log_config=None)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("command", nargs="?", choices=["run", "serve"], default="run",
+                        help="run the load test (default) or serve the app with stand-ins")
+    parser.add_argument("--url", default=None,
+                        help="target a server over HTTP instead of in-process")
+    parser.add_argument("--port", type=int, default=8011, help="port for `serve`")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--subscribers", type=int, default=50,
+                        help="distinct subscribers the requests are spread over")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help=f"payload kind weights (default {DEFAULT_MIX})")
+    parser.add_argument("--gemini-latency", default="lognormal:900,0.5")
+    parser.add_argument("--manychat-latency", default="lognormal:150,0.4")
+    parser.add_argument("--buffer-window", type=float, default=2.0,
+                        help="MessageBuffer window in seconds (production uses 60)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true",
+                        help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true",
+                        help="keep the app's INFO logging")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    # Keep the benchmark's journal/idempotency/buffer state out of the real state DB
+    os.environ.setdefault("SHANBOT_STATE_DB", os.path.join(
+        tempfile.mkdtemp(prefix="shanbot_loadtest_"), "state.sqlite"))
+
+    stand_ins = StandIns(LatencyDistribution(args.gemini_latency),
+                         LatencyDistribution(args.manychat_latency))
+
+    if args.command == "serve":
+        serve(args, stand_ins)
+        return
+
+    if args.url:
+        run = asyncio.run(run_over_http(args))
+    else:
+        import logging
+        import webhook_main  # noqa: F401  (configures logging)
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        run = asyncio.run(run_in_process(args, stand_ins))
+
+    report = build_report(run, args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
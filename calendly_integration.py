@@ -1,9 +1,13 @@
+import asyncio
+import os
 import requests
 import sqlite3
 import json
 import logging
-from datetime import datetime, timezone
-from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +18,19 @@ CALENDLY_TOKEN = "eyJraWQiOiIxY2UxZTEzNjE3ZGNmNzY2YjNjZWJjY2Y4ZGM1YmFmYThhNjVlNj
 CALENDLY_BASE_URL = "https://api.calendly.com"
 DB_PATH = r"C:\Users\Shannon\OneDrive\Desktop\shanbot\app\analytics_data_good.sqlite"
 
+# Async poller configuration
+CALENDLY_POLL_INTERVAL = int(os.getenv("CALENDLY_POLL_INTERVAL", "1800"))  # seconds
+CALENDLY_INVITEE_CONCURRENCY = int(
+    os.getenv("CALENDLY_INVITEE_CONCURRENCY", "5"))
+CALENDLY_PAGE_SIZE = 100  # Calendly's maximum page size
+CALENDLY_LOOKBACK = timedelta(hours=24)  # bookings older than this aren't "new"
+# Polls a failing booking holds the cursor for before it's skipped
+CALENDLY_MAX_BOOKING_ATTEMPTS = int(os.getenv("CALENDLY_MAX_BOOKING_ATTEMPTS", "5"))
+
+# save_booking_to_database results (None on error)
+BOOKING_INSERTED = "inserted"
+BOOKING_EXISTS = "exists"
+
 # Headers for Calendly API
 headers = {
     "Authorization": f"Bearer {CALENDLY_TOKEN}",
@@ -24,11 +41,12 @@ headers = {
 class CalendlyIntegration:
     """Handles Calendly API integration for booking detection."""
 
-    def __init__(self):
+    def __init__(self, initialize: bool = True):
         self.user_uuid = None
         self.event_type_uri = None
         self.last_known_booking_id = None
-        self._initialize_calendly_data()
+        if initialize:
+            self._initialize_calendly_data()
 
     def _initialize_calendly_data(self):
         """Initialize Calendly user and event data."""
@@ -208,8 +226,12 @@ class CalendlyIntegration:
             logger.error(f"Error extracting Instagram username: {e}")
             return None
 
-    def save_booking_to_database(self, booking_data: Dict) -> bool:
-        """Save booking data to database."""
+    def save_booking_to_database(self, booking_data: Dict) -> Optional[str]:
+        """Save booking data to database.
+
+        Returns BOOKING_INSERTED, BOOKING_EXISTS if the booking was already
+        saved (nothing else should be done for it), or None on error.
+        """
         try:
             conn = sqlite3.connect(DB_PATH)
             cursor = conn.cursor()
@@ -224,7 +246,7 @@ class CalendlyIntegration:
                 logger.info(
                     f"Booking {booking_data['booking_id']} already exists in database, skipping")
                 conn.close()
-                return True  # Return True since this is expected behavior
+                return BOOKING_EXISTS
 
             # Insert new booking
             cursor.execute("""
@@ -249,10 +271,25 @@ class CalendlyIntegration:
 
             logger.info(
                 f"Saved booking to database: {booking_data['invitee_name']}")
-            return True
+            return BOOKING_INSERTED
 
         except Exception as e:
             logger.error(f"Error saving booking to database: {e}")
+            return None
+
+    def delete_booking(self, booking_id: str) -> bool:
+        """Remove a saved booking, so the next poll processes it again."""
+        try:
+            conn = sqlite3.connect(DB_PATH)
+            try:
+                conn.execute(
+                    "DELETE FROM calendly_bookings WHERE booking_id = ?", (booking_id,))
+                conn.commit()
+            finally:
+                conn.close()
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting booking {booking_id}: {e}")
             return False
 
     def update_analytics_for_booking(self, booking_data: Dict) -> bool:
@@ -303,8 +340,8 @@ class CalendlyIntegration:
         processed_count = 0
 
         for booking in new_bookings:
-            # Save to database
-            if self.save_booking_to_database(booking):
+            # Save to database (bookings saved by an earlier check are done)
+            if self.save_booking_to_database(booking) == BOOKING_INSERTED:
                 # Update analytics
                 if self.update_analytics_for_booking(booking):
                     # Mark booking as completed if we have an Instagram username
@@ -514,6 +551,256 @@ def run_booking_check():
     return integration.process_new_bookings()
 
 
+class AsyncCalendlyPoller:
+    """Polls Calendly for new bookings without blocking the event loop.
+
+    Uses one pooled httpx.AsyncClient, follows pagination from a persisted
+    cursor (min_start_time plus the newest created_at already processed),
+    fetches invitees concurrently under a semaphore and runs the SQLite
+    writes in a worker thread.
+    """
+
+    def __init__(self, poll_interval: int = CALENDLY_POLL_INTERVAL,
+                 invitee_concurrency: int = CALENDLY_INVITEE_CONCURRENCY):
+        self.poll_interval = poll_interval
+        self.invitee_concurrency = invitee_concurrency
+        self.user_uri: Optional[str] = None
+        self.store = CalendlyIntegration(initialize=False)
+        # booking_id -> failed attempts, for bookings holding the cursor back
+        self._booking_failures: Dict[str, int] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=CALENDLY_BASE_URL,
+                headers=headers,
+                timeout=httpx.Timeout(15.0, connect=5.0),
+                limits=httpx.Limits(max_connections=self.invitee_concurrency + 2,
+                                    max_keepalive_connections=self.invitee_concurrency)
+            )
+        return self._client
+
+    async def close(self) -> None:
+        """Close the pooled HTTP client."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # --- Cursor ---
+
+    def _load_cursor(self) -> Dict[str, Optional[str]]:
+        """Read the poll cursor, creating the booking tables if needed."""
+        self.store._load_last_known_booking()
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS calendly_poll_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+            conn.commit()
+            return dict(conn.execute("SELECT key, value FROM calendly_poll_state").fetchall())
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _save_cursor(cursor: Dict[str, Optional[str]]) -> None:
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO calendly_poll_state (key, value) VALUES (?, ?)",
+                [(key, value) for key, value in cursor.items() if value is not None])
+            conn.commit()
+        finally:
+            conn.close()
+
+    # --- Calendly API ---
+
+    async def _get_json(self, url: str, params: Optional[Dict[str, Any]] = None) -> Optional[Dict]:
+        response = await self._get_client().get(url, params=params)
+        if response.status_code != 200:
+            logger.error(
+                f"Calendly request failed ({response.status_code}) for {url}: {response.text[:200]}")
+            return None
+        return response.json()
+
+    async def _ensure_user(self) -> bool:
+        """Resolve the Calendly user once per process."""
+        if self.user_uri:
+            return True
+        data = await self._get_json("/users/me")
+        self.user_uri = (data or {}).get("resource", {}).get("uri")
+        if self.user_uri:
+            self.store.user_uuid = self.user_uri.split("/")[-1]
+            logger.info(f"Calendly user UUID: {self.store.user_uuid}")
+        return bool(self.user_uri)
+
+    async def _fetch_events(self, min_start_time: str) -> Tuple[List[Dict], bool]:
+        """Scheduled events starting at or after min_start_time, following pagination.
+
+        Returns (events, complete); complete is False if a page failed, in
+        which case events holds only the pages fetched before it.
+        """
+        events = []
+        url, params = "/scheduled_events", {
+            "user": self.user_uri,
+            "min_start_time": min_start_time,
+            "sort": "start_time:asc",
+            "count": CALENDLY_PAGE_SIZE
+        }
+        while url:
+            page = await self._get_json(url, params)
+            if page is None:
+                return events, False
+            events.extend(page.get("collection", []))
+            # next_page is a full URL that already carries the query
+            url, params = (page.get("pagination") or {}).get("next_page"), None
+        return events, True
+
+    async def _fetch_invitee(self, event: Dict, semaphore: asyncio.Semaphore) -> Dict:
+        """The event's invitee (name, email, uri and form answers)."""
+        invitee = event.get("invitee") or {}
+        async with semaphore:
+            try:
+                if invitee.get("uri"):
+                    data = await self._get_json(invitee["uri"])
+                    invitee = {**invitee, **((data or {}).get("resource") or {})}
+                else:
+                    data = await self._get_json(f"{event.get('uri', '')}/invitees")
+                    invitee = ((data or {}).get("collection") or [{}])[0]
+            except httpx.HTTPError as e:
+                logger.error(
+                    f"Error getting invitee for event {event.get('uri')}: {e}")
+        return invitee
+
+    @staticmethod
+    def _instagram_username(invitee: Dict) -> Optional[str]:
+        """Pull the Instagram username out of the booking form answers."""
+        answers = invitee.get("questions_and_answers") or invitee.get("answers") or []
+        for answer in answers:
+            question = answer.get("question", "").lower()
+            if "instagram" in question or "facebook" in question or "username" in question:
+                username = (answer.get("answer") or "").strip().lstrip("@")
+                logger.info(f"Found Instagram username in booking: {username}")
+                return username or None
+        return None
+
+    # --- Polling ---
+
+    async def poll_once(self) -> int:
+        """Fetch and process bookings created since the last poll. Returns the count processed."""
+        if not await self._ensure_user():
+            logger.error("User UUID not available")
+            return 0
+
+        cursor = await asyncio.to_thread(self._load_cursor)
+        window_start = (datetime.now(timezone.utc) - CALENDLY_LOOKBACK).isoformat()
+        # Never look further back than the lookback window the sync check used
+        min_start_time = max(cursor.get("min_start_time") or window_start, window_start)
+        last_created_at = cursor.get("last_created_at") or ""
+
+        events, complete = await self._fetch_events(min_start_time)
+        if not complete:
+            logger.warning(
+                f"Calendly event listing incomplete ({len(events)} events fetched); cursor not advanced")
+        # Oldest booking first, so the cursor can stop at the first failure
+        new_events = sorted((event for event in events
+                             if event.get("created_at", "") > last_created_at),
+                            key=lambda event: event.get("created_at", ""))
+        if not new_events:
+            logger.info(
+                f"No new bookings ({len(events)} events since {min_start_time})")
+            await asyncio.to_thread(self._save_cursor, {"min_start_time": window_start})
+            return 0
+
+        semaphore = asyncio.Semaphore(self.invitee_concurrency)
+        invitees = await asyncio.gather(
+            *(self._fetch_invitee(event, semaphore) for event in new_events))
+
+        processed_count = 0
+        # Advances over processed (or already saved) bookings until the first failure
+        cursor_created_at = last_created_at
+        cursor_blocked = not complete
+        for event, invitee in zip(new_events, invitees):
+            booking = {
+                "booking_id": event.get("uri", "").split("/")[-1],
+                "invitee_name": invitee.get("name", "Unknown"),
+                "invitee_email": invitee.get("email", ""),
+                "booking_time": event.get("start_time", ""),
+                "event_type": event.get("event_type", ""),
+                "event_uri": event.get("uri", ""),
+                "invitee_uri": invitee.get("uri", ""),
+                "ig_username": self._instagram_username(invitee)
+            }
+            logger.info(
+                f"New booking detected: {booking['invitee_name']} (@{booking['ig_username'] or 'no_username'})")
+            result = await asyncio.to_thread(self._process_booking, booking)
+            if result is None:
+                failures = self._booking_failures.get(booking["booking_id"], 0) + 1
+                self._booking_failures[booking["booking_id"]] = failures
+                if failures < CALENDLY_MAX_BOOKING_ATTEMPTS:
+                    # Retried next poll; bookings saved after it are skipped then
+                    cursor_blocked = True
+                    continue
+                logger.error(
+                    f"Giving up on booking {booking['booking_id']} after {failures} attempts")
+            elif result == BOOKING_INSERTED:
+                processed_count += 1
+            self._booking_failures.pop(booking["booking_id"], None)
+            if not cursor_blocked:
+                cursor_created_at = event.get("created_at", "")
+
+        await asyncio.to_thread(self._save_cursor, {
+            "min_start_time": window_start,
+            "last_created_at": cursor_created_at or None
+        })
+        if processed_count > 0:
+            logger.info(f"Processed {processed_count} new booking(s)")
+        return processed_count
+
+    def _process_booking(self, booking: Dict) -> Optional[str]:
+        """Save a booking and update analytics (runs in a worker thread).
+
+        Returns the save result (BOOKING_INSERTED / BOOKING_EXISTS), or None
+        if the booking failed and should be retried.
+        """
+        saved = self.store.save_booking_to_database(booking)
+        if saved != BOOKING_INSERTED:
+            return saved
+        if not self.store.update_analytics_for_booking(booking):
+            # Un-save it, or the retry would take it for an old booking
+            self.store.delete_booking(booking["booking_id"])
+            return None
+        if booking.get("ig_username"):
+            self.store.mark_booking_completed(booking["ig_username"])
+        logger.info(
+            f"Successfully processed booking for: {booking['invitee_name']}")
+        return BOOKING_INSERTED
+
+    async def run_forever(self) -> None:
+        """Poll every poll_interval seconds until cancelled."""
+        try:
+            while True:
+                try:
+                    count = await self.poll_once()
+                    if count > 0:
+                        logger.info(
+                            f"✅ Found and processed {count} new booking(s)")
+                    else:
+                        logger.info("✅ No new bookings found")
+                except Exception as e:
+                    logger.error(f"❌ Error in Calendly booking check: {e}")
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            await self.close()
+
+
+# Shared poller for the webhook process
+calendly_poller = AsyncCalendlyPoller()
+
+
 if __name__ == "__main__":
     # Test the integration
     print("=== Testing Calendly Integration ===")
@@ -0,0 +1,127 @@
+"""
+Adaptive Debounce
+================
+Per-user quiet windows for MessageBuffer.
+
+Rather than making every buffered user wait a fixed BUFFER_WINDOW, this
+keeps each user's most recent gaps between messages within a burst and
+waits a multiple of their 90th-percentile gap after their latest message:
+long enough for someone who sends a thought as several slow messages, short
+for quick typists. Users without enough history use the gaps pooled over
+all users.
+
+Two triggers bound the wait regardless of the window:
+    DEBOUNCE_MAX_WAIT       flush this long after the burst's first message
+    DEBOUNCE_MAX_MESSAGES   flush as soon as this many messages are buffered
+
+Each user costs a few floats (a short ring of gaps) in a bounded LRU map,
+process-local.
+"""
+
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+
+MESSAGE_BUFFER_ADAPTIVE = os.getenv(
+    "MESSAGE_BUFFER_ADAPTIVE", "true").lower() in ("1", "true", "yes")
+DEBOUNCE_MIN_WINDOW = float(os.getenv("DEBOUNCE_MIN_WINDOW", "4"))
+DEBOUNCE_MAX_WAIT = float(os.getenv("DEBOUNCE_MAX_WAIT", "120"))
+DEBOUNCE_MAX_MESSAGES = int(os.getenv("DEBOUNCE_MAX_MESSAGES", "8"))
+# Window = multiplier x the 90th-percentile recent gap
+DEBOUNCE_GAP_MULTIPLIER = float(os.getenv("DEBOUNCE_GAP_MULTIPLIER", "3"))
+DEBOUNCE_GAP_QUANTILE = 0.9
+DEBOUNCE_RECENT_GAPS = 16
+DEBOUNCE_POOLED_GAPS = 256
+# Gap samples needed before a user's own gaps are trusted
+DEBOUNCE_MIN_SAMPLES = int(os.getenv("DEBOUNCE_MIN_SAMPLES", "3"))
+DEBOUNCE_MAX_USERS = int(os.getenv("DEBOUNCE_MAX_USERS", "20000"))
+
+
+def _quantile(gaps: Deque[float], q: float = DEBOUNCE_GAP_QUANTILE) -> float:
+    ordered = sorted(gaps)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+class UserGaps:
+    """A user's most recent in-burst gaps and last arrival time."""
+
+    __slots__ = ("gaps", "last_arrival")
+
+    def __init__(self):
+        self.gaps: Deque[float] = deque(maxlen=DEBOUNCE_RECENT_GAPS)
+        self.last_arrival = 0.0
+
+
+class AdaptiveDebounce:
+    """Chooses each subscriber's debounce window from their message rhythm."""
+
+    def __init__(self, enabled: bool = MESSAGE_BUFFER_ADAPTIVE, max_users: int = DEBOUNCE_MAX_USERS):
+        self.enabled = enabled
+        self.max_users = max_users
+        self._users: "OrderedDict[str, UserGaps]" = OrderedDict()
+        self._pooled: Deque[float] = deque(maxlen=DEBOUNCE_POOLED_GAPS)
+        self._lock = threading.Lock()
+
+    def observe_arrival(self, subscriber_id: str, received_at: float, max_gap: float) -> None:
+        """Record a message arrival, learning from the gap since the user's previous message.
+
+        Gaps longer than max_gap (the longest window we'd ever wait) start a
+        new conversation rather than continue a burst, so they aren't learned.
+        """
+        with self._lock:
+            user = self._users.get(subscriber_id)
+            if user is None:
+                user = self._users[subscriber_id] = UserGaps()
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(subscriber_id)
+                gap = received_at - user.last_arrival
+                if 0 <= gap <= max_gap:
+                    user.gaps.append(gap)
+                    self._pooled.append(gap)
+            user.last_arrival = received_at
+
+    def window_for(self, subscriber_id: str, max_window: float) -> float:
+        """Quiet period to wait after this subscriber's latest message, capped at max_window."""
+        if not self.enabled:
+            return max_window
+        with self._lock:
+            user = self._users.get(subscriber_id)
+            gaps = user.gaps if user is not None and len(
+                user.gaps) >= DEBOUNCE_MIN_SAMPLES else self._pooled
+            if len(gaps) < DEBOUNCE_MIN_SAMPLES:
+                return max_window
+            window = DEBOUNCE_GAP_MULTIPLIER * _quantile(gaps)
+        return min(max(window, min(DEBOUNCE_MIN_WINDOW, max_window)), max_window)
+
+    def evict_idle(self, cutoff: float) -> int:
+        """Drop users whose last message arrived before cutoff. Returns how many were dropped."""
+        with self._lock:
+            evicted = 0
+            # LRU order: least recently active first
+            while self._users:
+                subscriber_id, user = next(iter(self._users.items()))
+                if user.last_arrival >= cutoff:
+                    break
+                del self._users[subscriber_id]
+                evicted += 1
+        return evicted
+
+    def forget(self, subscriber_id: str) -> None:
+        with self._lock:
+            self._users.pop(subscriber_id, None)
+
+    def get_stats(self, subscriber_id: Optional[str] = None) -> Dict[str, float]:
+        with self._lock:
+            user = self._users.get(subscriber_id) if subscriber_id else None
+            gaps = user.gaps if user is not None else self._pooled
+            summary = {"tracked_users": len(self._users), "gap_samples": len(gaps)}
+            if gaps:
+                summary["gap_p90"] = round(_quantile(gaps), 3)
+        return summary
+
+
+# Global instance
+adaptive_debounce = AdaptiveDebounce()
@@ -0,0 +1,181 @@
+"""
+Admission Control Service
+========================
+Load shedding for the single-process webhook.
+
+Watches in-flight webhook requests, router queue depth and recent Gemini
+latency, and picks the most degraded mode any signal calls for:
+
+    normal            -> route as usual
+    buffer_only       -> send everything through the MessageBuffer
+    defer_generation  -> journal the message and acknowledge; generate later
+    reject            -> 503 with Retry-After
+"""
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger("shanbot_admission")
+
+# Modes, least to most degraded
+MODE_NORMAL = "normal"
+MODE_BUFFER_ONLY = "buffer_only"
+MODE_DEFER_GENERATION = "defer_generation"
+MODE_REJECT = "reject"
+MODES = [MODE_NORMAL, MODE_BUFFER_ONLY, MODE_DEFER_GENERATION, MODE_REJECT]
+
+
+def _thresholds(name: str, defaults: Tuple[float, float, float]) -> Tuple[float, float, float]:
+    """Read 'buffer,defer,reject' thresholds from ADMISSION_<NAME>, e.g. ADMISSION_INFLIGHT=20,40,80."""
+    raw = os.getenv(f"ADMISSION_{name}")
+    if not raw:
+        return defaults
+    try:
+        buffer_at, defer_at, reject_at = (float(part) for part in raw.split(","))
+        return buffer_at, defer_at, reject_at
+    except ValueError:
+        logger.warning(
+            f"[Admission] Ignoring malformed ADMISSION_{name}={raw!r}, using {defaults}")
+        return defaults
+
+
+# Thresholds per signal: (buffer_only, defer_generation, reject)
+INFLIGHT_THRESHOLDS = _thresholds("INFLIGHT", (20, 40, 80))
+QUEUE_DEPTH_THRESHOLDS = _thresholds("QUEUE_DEPTH", (50, 200, 800))
+LLM_LATENCY_THRESHOLDS = _thresholds("LLM_LATENCY", (8.0, 20.0, 60.0))  # seconds
+RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER", "30"))
+
+LLM_LATENCY_ALPHA = 0.3  # EWMA weight of the newest sample
+LLM_LATENCY_STALE_SECONDS = 120  # forget latency samples older than this (lets a shed service recover)
+# Running calls count towards latency only when at least this many are that slow,
+# so one hung call can't shed all traffic on its own
+LLM_SLOW_CALLS_MIN = max(1, int(os.getenv("ADMISSION_LLM_SLOW_CALLS_MIN", "2")))
+
+
+class AdmissionController:
+    """Tracks load signals and decides the webhook's degraded mode."""
+
+    def __init__(self, inflight_thresholds: Tuple[float, float, float] = INFLIGHT_THRESHOLDS,
+                 queue_depth_thresholds: Tuple[float, float, float] = QUEUE_DEPTH_THRESHOLDS,
+                 llm_latency_thresholds: Tuple[float, float, float] = LLM_LATENCY_THRESHOLDS,
+                 retry_after_seconds: int = RETRY_AFTER_SECONDS):
+        self.inflight_thresholds = inflight_thresholds
+        self.queue_depth_thresholds = queue_depth_thresholds
+        self.llm_latency_thresholds = llm_latency_thresholds
+        self.retry_after_seconds = retry_after_seconds
+        self.queue_depth_fn: Callable[[], int] = lambda: 0
+        self.in_flight = 0
+        self.mode = MODE_NORMAL
+        self.rejected_total = 0
+        self.deferred_total = 0
+        self._llm_latency_ewma: Optional[float] = None
+        self._llm_latency_updated = 0.0
+        self._llm_calls_started: Dict[int, float] = {}
+        self._next_llm_call_id = 0
+
+    # --- Signals ---
+
+    @contextmanager
+    def track_request(self):
+        """Count a webhook request as in flight for the duration of the block."""
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    @contextmanager
+    def track_llm_call(self):
+        """Time a Gemini call; calls still running also count towards recent latency."""
+        call_id = self._next_llm_call_id
+        self._next_llm_call_id += 1
+        started = time.monotonic()
+        self._llm_calls_started[call_id] = started
+        try:
+            yield
+        finally:
+            del self._llm_calls_started[call_id]
+            self.record_llm_latency(time.monotonic() - started)
+
+    def record_llm_latency(self, seconds: float) -> None:
+        """Fold a completed LLM call's latency into the moving average."""
+        if self._llm_latency_ewma is None:
+            self._llm_latency_ewma = seconds
+        else:
+            self._llm_latency_ewma += LLM_LATENCY_ALPHA * \
+                (seconds - self._llm_latency_ewma)
+        self._llm_latency_updated = time.monotonic()
+
+    def recent_llm_latency(self) -> float:
+        """Recent LLM latency: the EWMA, or how long the running calls have taken if longer.
+
+        For running calls this is the age of the LLM_SLOW_CALLS_MIN-th oldest
+        (so a single hung call is ignored), capped at the defer_generation
+        threshold: a tracked call spans a whole retry/hedge loop, so running
+        calls alone can defer generation but never reject traffic. Only
+        completed calls can push latency into reject.
+        """
+        now = time.monotonic()
+        latency = 0.0
+        if self._llm_latency_ewma is not None and now - self._llm_latency_updated < LLM_LATENCY_STALE_SECONDS:
+            latency = self._llm_latency_ewma
+        if len(self._llm_calls_started) >= LLM_SLOW_CALLS_MIN:
+            started = sorted(self._llm_calls_started.values())[
+                LLM_SLOW_CALLS_MIN - 1]
+            latency = max(latency, min(
+                now - started, self.llm_latency_thresholds[1]))
+        return latency
+
+    # --- Decision ---
+
+    @staticmethod
+    def _level(value: float, thresholds: Tuple[float, float, float]) -> int:
+        return sum(1 for threshold in thresholds if value >= threshold)
+
+    def evaluate(self) -> str:
+        """Recompute the current mode from all signals."""
+        try:
+            queue_depth = self.queue_depth_fn()
+        except Exception as e:
+            logger.warning(f"[Admission] Could not read queue depth: {e}")
+            queue_depth = 0
+
+        level = max(
+            self._level(self.in_flight, self.inflight_thresholds),
+            self._level(queue_depth, self.queue_depth_thresholds),
+            self._level(self.recent_llm_latency(), self.llm_latency_thresholds)
+        )
+        mode = MODES[level]
+        if mode != self.mode:
+            logger.warning(
+                f"[Admission] Mode {self.mode} -> {mode} (in_flight={self.in_flight}, queue_depth={queue_depth}, llm_latency={self.recent_llm_latency():.1f}s)")
+            self.mode = mode
+        return mode
+
+    def generation_allowed(self) -> bool:
+        """Whether deferred work may be generated now."""
+        return self.evaluate() in (MODE_NORMAL, MODE_BUFFER_ONLY)
+
+    def get_status(self) -> Dict[str, Any]:
+        """Current mode and the signals behind it (for /health)."""
+        mode = self.evaluate()
+        return {
+            "mode": mode,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth_fn(),
+            "llm_latency_seconds": round(self.recent_llm_latency(), 3),
+            "rejected_total": self.rejected_total,
+            "deferred_total": self.deferred_total,
+            "thresholds": {
+                "in_flight": self.inflight_thresholds,
+                "queue_depth": self.queue_depth_thresholds,
+                "llm_latency_seconds": self.llm_latency_thresholds
+            }
+        }
+
+
+# Shared controller for the webhook process
+admission_controller = AdmissionController()
@@ -0,0 +1,183 @@
+"""
+Message Buffer Backends
+======================
+Storage for MessageBuffer's debounce state.
+
+- InMemoryBufferBackend: per-process dicts (single uvicorn worker).
+- SqliteBufferBackend: shared SQLite (WAL) table, so several uvicorn workers
+  combine one subscriber's messages no matter which process received them.
+
+Flushing goes through claim(), which atomically checks the quiet window and
+takes the messages, so exactly one process flushes a given burst.
+"""
+
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from services.state_db import get_state_connection
+
+logger = logging.getLogger("shanbot_buffer")
+
+MESSAGE_BUFFER_BACKEND = os.getenv("MESSAGE_BUFFER_BACKEND", "memory").lower()
+
+
+class BufferBackend:
+    """Interface for MessageBuffer storage."""
+
+    name = "base"
+
+    def append(self, subscriber_id: str, message_data: Dict, received_at: float) -> int:
+        """Store a message. Returns the subscriber's buffer size."""
+        raise NotImplementedError
+
+    def last_message_time(self, subscriber_id: str) -> float:
+        """Arrival time of the subscriber's newest buffered message (0 if none)."""
+        raise NotImplementedError
+
+    def size(self, subscriber_id: str) -> int:
+        """Number of buffered messages for the subscriber."""
+        raise NotImplementedError
+
+    def claim(self, subscriber_id: str, quiet_window: float) -> Optional[List[Dict]]:
+        """Atomically take the subscriber's messages if none arrived within quiet_window.
+
+        Returns None if the buffer is still active, [] if there is nothing to flush.
+        """
+        raise NotImplementedError
+
+    def clear(self, subscriber_id: str) -> None:
+        """Drop the subscriber's buffered messages."""
+        raise NotImplementedError
+
+    def get_totals(self) -> Dict[str, int]:
+        """Buffered message and subscriber counts across all subscribers."""
+        raise NotImplementedError
+
+
+class InMemoryBufferBackend(BufferBackend):
+    """Process-local buffer (the original module-global dicts)."""
+
+    name = "memory"
+
+    def __init__(self):
+        self.buffers: Dict[str, List[Dict]] = defaultdict(list)
+        self.last_times: Dict[str, float] = {}
+
+    def append(self, subscriber_id: str, message_data: Dict, received_at: float) -> int:
+        self.buffers[subscriber_id].append(message_data)
+        self.last_times[subscriber_id] = received_at
+        return len(self.buffers[subscriber_id])
+
+    def last_message_time(self, subscriber_id: str) -> float:
+        return self.last_times.get(subscriber_id, 0)
+
+    def size(self, subscriber_id: str) -> int:
+        return len(self.buffers.get(subscriber_id, []))
+
+    def claim(self, subscriber_id: str, quiet_window: float) -> Optional[List[Dict]]:
+        # Runs on the event loop thread, so check-and-take is already atomic
+        if time.time() - self.last_times.get(subscriber_id, 0) < quiet_window:
+            return None
+        return self.buffers.pop(subscriber_id, [])
+
+    def clear(self, subscriber_id: str) -> None:
+        self.buffers.pop(subscriber_id, None)
+        self.last_times.pop(subscriber_id, None)
+
+    def get_totals(self) -> Dict[str, int]:
+        return {
+            "total_buffered_messages": sum(len(b) for b in self.buffers.values()),
+            "total_users_with_buffers": sum(1 for b in self.buffers.values() if b)
+        }
+
+
+class SqliteBufferBackend(BufferBackend):
+    """Buffer shared between processes through a WAL-mode SQLite table."""
+
+    name = "sqlite"
+
+    def __init__(self):
+        conn = get_state_connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS message_buffer (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    subscriber_id TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    received_at REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_message_buffer_subscriber ON message_buffer (subscriber_id, id)")
+
+    def append(self, subscriber_id: str, message_data: Dict, received_at: float) -> int:
+        conn = get_state_connection()
+        with conn:
+            conn.execute(
+                "INSERT INTO message_buffer (subscriber_id, message, received_at) VALUES (?, ?, ?)",
+                (subscriber_id, json.dumps(message_data, default=str), received_at)
+            )
+        return self.size(subscriber_id)
+
+    def last_message_time(self, subscriber_id: str) -> float:
+        row = get_state_connection().execute(
+            "SELECT MAX(received_at) FROM message_buffer WHERE subscriber_id = ?", (subscriber_id,)).fetchone()
+        return row[0] or 0
+
+    def size(self, subscriber_id: str) -> int:
+        return get_state_connection().execute(
+            "SELECT COUNT(*) FROM message_buffer WHERE subscriber_id = ?", (subscriber_id,)).fetchone()[0]
+
+    def claim(self, subscriber_id: str, quiet_window: float) -> Optional[List[Dict]]:
+        conn = get_state_connection()
+        # IMMEDIATE takes the write lock up front, so two processes can't both
+        # see the burst as quiet and flush it twice
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, message, received_at FROM message_buffer WHERE subscriber_id = ? ORDER BY id",
+                (subscriber_id,)).fetchall()
+            if not rows:
+                conn.commit()
+                return []
+            if time.time() - max(row[2] for row in rows) < quiet_window:
+                conn.commit()
+                return None
+            conn.execute("DELETE FROM message_buffer WHERE subscriber_id = ? AND id <= ?",
+                         (subscriber_id, rows[-1][0]))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return [json.loads(row[1]) for row in rows]
+
+    def clear(self, subscriber_id: str) -> None:
+        conn = get_state_connection()
+        with conn:
+            conn.execute(
+                "DELETE FROM message_buffer WHERE subscriber_id = ?", (subscriber_id,))
+
+    def get_totals(self) -> Dict[str, int]:
+        total, users = get_state_connection().execute(
+            "SELECT COUNT(*), COUNT(DISTINCT subscriber_id) FROM message_buffer").fetchone()
+        return {"total_buffered_messages": total, "total_users_with_buffers": users}
+
+
+BUFFER_BACKENDS = {
+    InMemoryBufferBackend.name: InMemoryBufferBackend,
+    SqliteBufferBackend.name: SqliteBufferBackend,
+}
+
+
+def create_buffer_backend(name: str = MESSAGE_BUFFER_BACKEND) -> BufferBackend:
+    """Build the configured backend, falling back to in-memory on error."""
+    try:
+        return BUFFER_BACKENDS[name]()
+    except Exception as e:
+        logger.error(
+            f"[Buffer] Could not create '{name}' buffer backend, using in-memory: {e}")
+        return InMemoryBufferBackend()
@@ -0,0 +1,198 @@
+"""
+Buffer Persistence
+=================
+Write-through copy of MessageBuffer's in-memory buffers in the state DB.
+
+The in-memory backend loses every buffered message if the process restarts
+inside the debounce window. With persistence on, each buffered message is
+also written to a small buffered_messages table, and removed once its flush
+has been processed. On startup MessageBuffer.recover() re-buffers whatever a
+previous process left behind.
+
+The webhook path only serializes the message and puts it on a queue. A
+dedicated writer thread takes everything queued and commits it as one
+transaction, so a burst of deliveries costs one commit rather than one each.
+Writes are applied in queue order, so a discard never removes a message
+queued after it.
+
+The SQLite buffer backend is durable by itself and doesn't use this.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from services.metrics import buffer_persist_batch_ops, buffer_persist_commit_seconds
+from services.state_db import close_state_connection, get_state_connection
+
+logger = logging.getLogger("shanbot_buffer")
+
+MESSAGE_BUFFER_PERSIST = os.getenv(
+    "MESSAGE_BUFFER_PERSIST", "true").lower() in ("1", "true", "yes")
+BUFFER_PERSIST_MAX_BATCH = int(os.getenv("MESSAGE_BUFFER_PERSIST_MAX_BATCH", "256"))
+
+# Writer queue operations
+OP_APPEND = "append"
+OP_DISCARD = "discard"
+OP_SYNC = "sync"
+OP_STOP = "stop"
+
+
+class BufferPersistence:
+    """Durable log of buffered messages, written by a background thread."""
+
+    def __init__(self, enabled: bool = MESSAGE_BUFFER_PERSIST, max_batch: int = BUFFER_PERSIST_MAX_BATCH):
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.discarded = 0
+        self.commits = 0
+        self.errors = 0
+
+    @staticmethod
+    def ensure_schema() -> None:
+        conn = get_state_connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buffered_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    subscriber_id TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    received_at REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_buffered_messages_subscriber ON buffered_messages (subscriber_id, received_at)")
+
+    def start(self) -> None:
+        """Create the table and start the writer thread (idempotent)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self.ensure_schema()
+            self._thread = threading.Thread(
+                target=self._writer, name="buffer-persist", daemon=True)
+            self._thread.start()
+        logger.info("[BufferPersist] Writer thread started")
+
+    def record_append(self, subscriber_id: str, message_data: Dict, received_at: float) -> None:
+        """Queue a buffered message for writing. Serialized now, so later edits to the dict don't leak in."""
+        if not self.enabled:
+            return
+        self.start()
+        self._queue.put((OP_APPEND, subscriber_id, json.dumps(
+            message_data, default=str), received_at))
+
+    def record_discard(self, subscriber_id: str, up_to: float) -> None:
+        """Queue removal of the subscriber's messages received at or before up_to."""
+        if not self.enabled:
+            return
+        self.start()
+        self._queue.put((OP_DISCARD, subscriber_id, up_to))
+
+    def sync(self, timeout: float = 5.0) -> bool:
+        """Wait until everything queued so far is committed. Returns False on timeout."""
+        if not self.enabled or self._thread is None or not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        self._queue.put((OP_SYNC, done))
+        return done.wait(timeout)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Commit what's queued and stop the writer thread."""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put((OP_STOP,))
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning(
+                f"[BufferPersist] Writer did not finish within {timeout}s ({self._queue.qsize()} writes queued)")
+        self._thread = None
+
+    def load_pending(self) -> Dict[str, List[Tuple[Dict, float]]]:
+        """Messages left by a previous process: subscriber_id -> [(message, received_at)] oldest first."""
+        if not self.enabled:
+            return {}
+        self.ensure_schema()
+        pending: Dict[str, List[Tuple[Dict, float]]] = {}
+        rows = get_state_connection().execute(
+            "SELECT subscriber_id, message, received_at FROM buffered_messages ORDER BY id").fetchall()
+        for subscriber_id, message, received_at in rows:
+            try:
+                pending.setdefault(subscriber_id, []).append(
+                    (json.loads(message), received_at))
+            except ValueError as e:
+                logger.error(
+                    f"[BufferPersist] Skipping unreadable message for {subscriber_id}: {e}")
+        return pending
+
+    def _writer(self) -> None:
+        """Writer thread: apply queued writes in batches, one transaction per batch."""
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            writes = [op for op in batch if op[0] in (OP_APPEND, OP_DISCARD)]
+            if writes:
+                self._commit(writes)
+            for op in batch:
+                if op[0] == OP_SYNC:
+                    op[1].set()
+                elif op[0] == OP_STOP:
+                    running = False
+        close_state_connection()
+        logger.info("[BufferPersist] Writer thread stopped")
+
+    def _commit(self, writes: List[Tuple]) -> None:
+        started = time.perf_counter()
+        try:
+            conn = get_state_connection()
+            with conn:
+                for op in writes:
+                    if op[0] == OP_APPEND:
+                        conn.execute(
+                            "INSERT INTO buffered_messages (subscriber_id, message, received_at) VALUES (?, ?, ?)",
+                            op[1:])
+                    else:
+                        conn.execute(
+                            "DELETE FROM buffered_messages WHERE subscriber_id = ? AND received_at <= ?", op[1:])
+        except Exception as e:
+            self.errors += 1
+            logger.error(
+                f"[BufferPersist] Failed to write {len(writes)} buffer updates: {e}")
+            return
+        self.commits += 1
+        self.written += sum(1 for op in writes if op[0] == OP_APPEND)
+        self.discarded += sum(1 for op in writes if op[0] == OP_DISCARD)
+        buffer_persist_batch_ops.observe(len(writes))
+        buffer_persist_commit_seconds.observe(time.perf_counter() - started)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "running": self._thread is not None and self._thread.is_alive(),
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "discarded": self.discarded,
+            "commits": self.commits,
+            "errors": self.errors
+        }
+
+
+# Global instance
+buffer_persistence = BufferPersistence()
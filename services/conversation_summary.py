@@ -0,0 +1,207 @@
+"""
+Conversation Summaries
+=====================
+Rolling per-user summaries, so prompts carry a summary plus the recent
+tail instead of up to 40 raw history turns.
+
+Each user has one row in the state DB's conversation_summaries table: the
+summary text and the timestamp of the newest message folded into it.
+prompt_history() splits a cleaned history into (summary, tail), where the
+tail is every message after that timestamp, and never fewer than the last
+SUMMARY_KEEP_RECENT.
+
+Once a user's unsummarized tail grows past SUMMARY_REFRESH_AFTER messages,
+prompt_history() starts a background refresh on the event loop: a cheap
+model (CONVERSATION_SUMMARY_MODEL, in the bulk limiter lane) folds all but
+the last SUMMARY_KEEP_RECENT messages into the summary. The reply being
+built doesn't wait for it; the next one uses the new summary. Until a user
+has a summary their full history is used as before.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from services.gemini_limiter import LANE_BULK, llm_lane
+from services.state_db import get_state_connection
+
+logger = logging.getLogger("shanbot_conversation_summary")
+
+CONVERSATION_SUMMARY_MODEL = os.getenv(
+    "CONVERSATION_SUMMARY_MODEL", "gemini-2.5-flash-lite")
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "10"))
+SUMMARY_REFRESH_AFTER = int(os.getenv("SUMMARY_REFRESH_AFTER", "24"))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "200"))
+
+SUMMARY_PROMPT_TEMPLATE = """You keep a running summary of an Instagram DM conversation between Shannon, a fitness coach, and @{ig_username}.
+
+Summary so far:
+{summary}
+
+Newer messages:
+{messages}
+
+Rewrite the summary so it also covers the newer messages. Keep what matters for Shannon's future replies: the person's goals, diet, training, personal details they've shared, anything promised or agreed, open questions, and where the conversation left off. Plain prose, at most {max_words} words, no preamble."""
+
+AI_SENDERS = ("ai", "bot", "shannon", "assistant")
+
+
+def _timestamp(message: Dict[str, Any]) -> str:
+    """Sortable second-resolution timestamp of a history item ("" if it has none)."""
+    ts = str(message.get("timestamp") or "").strip().replace(" ", "T")
+    return ts.split("+")[0].split(".")[0].rstrip("Z")
+
+
+def format_summary_messages(messages: List[Dict[str, Any]]) -> str:
+    lines = []
+    for m in messages:
+        sender = str(m.get("type") or m.get("sender") or "").lower()
+        speaker = "Shannon" if sender in AI_SENDERS else "User"
+        lines.append(f"{speaker}: {m.get('text') or m.get('message') or ''}")
+    return "\n".join(lines)
+
+
+class ConversationSummaries:
+    """Rolling conversation summaries in the state DB, refreshed in the background."""
+
+    def __init__(self, keep_recent: int = SUMMARY_KEEP_RECENT, refresh_after: int = SUMMARY_REFRESH_AFTER,
+                 model: str = CONVERSATION_SUMMARY_MODEL):
+        self.keep_recent = keep_recent
+        self.refresh_after = refresh_after
+        self.model = model
+        self._refreshing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._schema_ready = False
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def _ensure_schema(self) -> None:
+        if self._schema_ready:
+            return
+        conn = get_state_connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_summaries (
+                    ig_username TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    summarized_through TEXT NOT NULL,
+                    messages_summarized INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+        self._schema_ready = True
+
+    def get(self, ig_username: str) -> Optional[Tuple[str, str, int]]:
+        """(summary, summarized_through, messages_summarized) for the user, or None."""
+        try:
+            self._ensure_schema()
+            return get_state_connection().execute(
+                "SELECT summary, summarized_through, messages_summarized FROM conversation_summaries WHERE ig_username = ?",
+                (ig_username,)).fetchone()
+        except Exception as e:
+            logger.warning(
+                f"[ConvSummary] Could not read summary for {ig_username}: {e}")
+            return None
+
+    def prompt_history(self, ig_username: str, history: List[Dict[str, Any]],
+                       summarize: Optional[Callable[[str], Awaitable[Optional[str]]]] = None
+                       ) -> Tuple[str, List[Dict[str, Any]]]:
+        """Split a cleaned, oldest-first history into (summary, tail) for a prompt.
+
+        With summarize (an async prompt -> text call) and a running event loop,
+        also starts a background refresh when the unsummarized tail is long.
+        Without a summary yet, returns ("", history).
+        """
+        if not ig_username or not history:
+            return "", history
+        row = self.get(ig_username)
+        summary, through, summarized = row if row else ("", "", 0)
+
+        start = 0
+        if through:
+            for i, message in enumerate(history):
+                ts = _timestamp(message)
+                if ts and ts <= through:
+                    start = i + 1
+
+        if summarize is not None and len(history) - start > self.refresh_after:
+            self._schedule_refresh(ig_username, summary, summarized,
+                                   history[start:len(history) - self.keep_recent], summarize)
+
+        if not summary:
+            return "", history
+        tail = history[min(start, max(0, len(history) - self.keep_recent)):]
+        logger.info(
+            f"[ConvSummary] {ig_username}: summary of {summarized} messages + {len(tail)}/{len(history)} recent")
+        return summary, tail
+
+    def _schedule_refresh(self, ig_username: str, summary: str, summarized: int,
+                          messages: List[Dict[str, Any]], summarize: Callable[[str], Awaitable[Optional[str]]]) -> None:
+        if ig_username in self._refreshing or not messages or not _timestamp(messages[-1]):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # sync caller (dashboard): use the summary as is
+            return
+        self._refreshing.add(ig_username)
+        task = loop.create_task(self._refresh(
+            ig_username, summary, summarized, messages, summarize))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, ig_username: str, summary: str, summarized: int,
+                       messages: List[Dict[str, Any]], summarize: Callable[[str], Awaitable[Optional[str]]]) -> None:
+        """Fold messages into the user's summary with the cheap model and store it."""
+        started = time.perf_counter()
+        try:
+            prompt = SUMMARY_PROMPT_TEMPLATE.format(
+                ig_username=ig_username,
+                summary=summary or "(none yet)",
+                messages=format_summary_messages(messages),
+                max_words=SUMMARY_MAX_WORDS)
+            with llm_lane(LANE_BULK):
+                new_summary = await summarize(prompt)
+            if not new_summary or not new_summary.strip():
+                self.refresh_failures += 1
+                logger.warning(
+                    f"[ConvSummary] Empty summary for {ig_username}, keeping the old one")
+                return
+            through = _timestamp(messages[-1])
+            self._ensure_schema()
+            conn = get_state_connection()
+            with conn:
+                # Another process may have stored a newer summary meanwhile
+                conn.execute("""
+                    INSERT INTO conversation_summaries
+                        (ig_username, summary, summarized_through, messages_summarized, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(ig_username) DO UPDATE SET summary = excluded.summary,
+                        summarized_through = excluded.summarized_through,
+                        messages_summarized = excluded.messages_summarized, updated_at = excluded.updated_at
+                    WHERE excluded.summarized_through > conversation_summaries.summarized_through
+                """, (ig_username, new_summary.strip(), through, summarized + len(messages), time.time()))
+            self.refreshes += 1
+            logger.info(
+                f"[ConvSummary] Folded {len(messages)} messages into {ig_username}'s summary "
+                f"in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            self.refresh_failures += 1
+            logger.error(
+                f"[ConvSummary] Summary refresh failed for {ig_username}: {e}")
+        finally:
+            self._refreshing.discard(ig_username)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "refreshing": len(self._refreshing),
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "keep_recent": self.keep_recent,
+            "refresh_after": self.refresh_after
+        }
+
+
+# Shared summaries store
+conversation_summaries = ConversationSummaries()
@@ -0,0 +1,140 @@
+"""
+Deadline Scheduler
+=================
+One coroutine that fires callbacks at per-key deadlines.
+
+Replaces one sleeping asyncio.Task per key (per buffered subscriber): all
+deadlines live in a single min-heap and a single task sleeps until the
+earliest one. Rescheduling a key is O(log n) and leaves its old heap entry
+behind to be skipped when it surfaces (lazy deletion).
+
+Callbacks run on the scheduler task one at a time, so they should be quick
+(hand slow work to the worker pool). An optional housekeeping callback runs
+every housekeeping_interval seconds for evicting idle state.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("shanbot_scheduler")
+
+
+class DeadlineScheduler:
+    """Min-heap of (deadline, key) serviced by a single asyncio task."""
+
+    def __init__(self, callback: Callable[[str], Awaitable[None]], name: str = "scheduler",
+                 housekeeping: Optional[Callable[[], None]] = None, housekeeping_interval: float = 300.0):
+        self.callback = callback
+        self.name = name
+        self.housekeeping = housekeeping
+        self.housekeeping_interval = housekeeping_interval
+        self._heap: List[Tuple[float, int, str]] = []
+        # key -> (deadline, sequence) of its live heap entry
+        self._pending: Dict[str, Tuple[float, int]] = {}
+        self._sequence = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._next_housekeeping = time.time() + housekeeping_interval
+        self.fired = 0
+
+    def schedule(self, key: str, deadline: float) -> None:
+        """Fire callback(key) at deadline (time.time() based), replacing any earlier schedule for key."""
+        entry = (deadline, next(self._sequence))
+        self._pending[key] = entry
+        heapq.heappush(self._heap, (entry[0], entry[1], key))
+        self._ensure_running()
+        if self._heap[0][1] == entry[1]:
+            # New earliest deadline: wake the loop so it sleeps less
+            self._wakeup.set()
+
+    def cancel(self, key: str) -> bool:
+        return self._pending.pop(key, None) is not None
+
+    def is_pending(self, key: str) -> bool:
+        return key in self._pending
+
+    def deadline(self, key: str) -> Optional[float]:
+        entry = self._pending.get(key)
+        return entry[0] if entry else None
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def pending_keys(self) -> List[str]:
+        return list(self._pending)
+
+    def _ensure_running(self) -> None:
+        loop = asyncio.get_event_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        # First use, or the previous loop went away (e.g. a restarted app in tests)
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    def _pop_due(self, now: float) -> List[str]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, sequence, key = heapq.heappop(self._heap)
+            if self._pending.get(key) == (deadline, sequence):
+                del self._pending[key]
+                due.append(key)
+        # Drop stale entries at the head so the sleep targets a live deadline
+        while self._heap and self._pending.get(self._heap[0][2]) != (self._heap[0][0], self._heap[0][1]):
+            heapq.heappop(self._heap)
+        return due
+
+    async def _run(self) -> None:
+        logger.info(f"[Scheduler] {self.name} started")
+        try:
+            while True:
+                now = time.time()
+                for key in self._pop_due(now):
+                    self.fired += 1
+                    try:
+                        await self.callback(key)
+                    except Exception as e:
+                        logger.error(
+                            f"[Scheduler] {self.name} callback failed for {key}: {e}")
+
+                if self.housekeeping and now >= self._next_housekeeping:
+                    self._next_housekeeping = now + self.housekeeping_interval
+                    try:
+                        self.housekeeping()
+                    except Exception as e:
+                        logger.error(
+                            f"[Scheduler] {self.name} housekeeping failed: {e}")
+
+                wake_at = self._next_housekeeping if self.housekeeping else None
+                if self._heap:
+                    wake_at = min(wake_at or self._heap[0][0], self._heap[0][0])
+                self._wakeup.clear()
+                timeout = None if wake_at is None else max(0.0, wake_at - time.time())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            logger.info(f"[Scheduler] {self.name} stopped")
+            raise
+
+    def stop(self) -> None:
+        """Cancel the scheduler task. Pending deadlines are kept (see pending_keys)."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+    def get_stats(self) -> Dict[str, object]:
+        next_deadline = self._heap[0][0] if self._heap else None
+        return {
+            "pending": len(self._pending),
+            "heap_entries": len(self._heap),
+            "fired": self.fired,
+            "next_due_in": round(max(0.0, next_deadline - time.time()), 2) if next_deadline else None,
+            "running": self._task is not None and not self._task.done()
+        }
@@ -0,0 +1,471 @@
+"""
+Gemini Rate Limiter
+==================
+Client-side limiter shared by every Gemini call path (webhook and dashboard).
+
+Each model has a token bucket (requests per second, with a small burst) and a
+concurrency window, both adjusted AIMD-style from what the calls observe:
+
+- a 429 halves the window and the rate (at most once per cooldown, so one
+  burst of 429s counts as one signal)
+- a success grows the window by 1/window and the rate by a small step
+- a success slower than GEMINI_LIMITER_SLOW_SECONDS, or a call that timed
+  out, shrinks the window a little instead, backing off before the API
+  starts refusing
+- a cancelled call (e.g. the losing side of a hedge) just returns its slot
+
+Calls are admitted by priority lane (llm_lane): interactive replies first,
+then dashboard review regenerations, then bulk jobs. A lane doesn't take a
+slot while a higher lane has callers queued for the same model, and bulk
+work only ever uses part of the window, leaving room for live DMs to
+arrive. Time spent queued is reported per lane.
+
+State lives in the state DB (gemini_limiter, plus one row per call in
+flight and per queued caller), so the webhook and dashboard processes
+share one budget per model.
+Leases older than GEMINI_LIMITER_LEASE_TTL are treated as abandoned (a
+crashed caller) and ignored.
+
+If the state DB can't be used, calls go ahead unlimited rather than fail.
+The async path runs its state DB transactions in a worker thread, since a
+BEGIN IMMEDIATE can wait on another process's write lock.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+
+from services.metrics import llm_queue_wait_seconds
+from services.state_db import get_state_connection
+
+logger = logging.getLogger("shanbot_gemini_limiter")
+
+# Limiter configuration
+GEMINI_LIMITER_ENABLED = os.getenv(
+    "GEMINI_LIMITER_ENABLED", "true").lower() in ("1", "true", "yes")
+INITIAL_CONCURRENCY = float(os.getenv("GEMINI_LIMITER_CONCURRENCY", "8"))
+MIN_CONCURRENCY = 1.0
+MAX_CONCURRENCY = float(os.getenv("GEMINI_LIMITER_MAX_CONCURRENCY", "32"))
+INITIAL_RATE = float(os.getenv("GEMINI_LIMITER_RATE", "4"))  # requests/second
+MIN_RATE = 0.2
+MAX_RATE = float(os.getenv("GEMINI_LIMITER_MAX_RATE", "20"))
+RATE_STEP = 0.05  # additive increase per success, requests/second
+BURST = float(os.getenv("GEMINI_LIMITER_BURST", "10"))
+DECREASE_FACTOR = 0.5
+SLOW_DECREASE_FACTOR = 0.9
+SLOW_CALL_SECONDS = float(os.getenv("GEMINI_LIMITER_SLOW_SECONDS", "20"))
+DECREASE_COOLDOWN_SECONDS = 2.0
+LEASE_TTL_SECONDS = float(os.getenv("GEMINI_LIMITER_LEASE_TTL", "180"))
+MAX_WAIT_SECONDS = float(os.getenv("GEMINI_LIMITER_MAX_WAIT", "30"))
+WINDOW_POLL_SECONDS = 0.25  # re-check interval while the concurrency window is full
+WAITER_STALE_SECONDS = 5.0  # a queued caller that stops polling this long has gone away
+
+# Priority lanes, highest priority first
+LANE_INTERACTIVE = "interactive"
+LANE_REVIEW = "review"
+LANE_BULK = "bulk"
+LANE_PRIORITY = {LANE_INTERACTIVE: 0, LANE_REVIEW: 1, LANE_BULK: 2}
+# Share of a model's concurrency window each lane may occupy on its own
+LANE_WINDOW_SHARE = {
+    LANE_INTERACTIVE: 1.0,
+    LANE_REVIEW: 1.0,
+    LANE_BULK: float(os.getenv("GEMINI_LIMITER_BULK_SHARE", "0.5")),
+}
+# How long each lane will queue before giving up
+LANE_MAX_WAIT = {
+    LANE_INTERACTIVE: MAX_WAIT_SECONDS,
+    LANE_REVIEW: float(os.getenv("GEMINI_LIMITER_REVIEW_MAX_WAIT", "120")),
+    LANE_BULK: float(os.getenv("GEMINI_LIMITER_BULK_MAX_WAIT", "600")),
+}
+
+# Lane of the Gemini calls made in the current context (webhook work is interactive)
+_current_lane: ContextVar[str] = ContextVar(
+    "gemini_lane", default=LANE_INTERACTIVE)
+
+# Call outcomes fed back by release()
+OUTCOME_OK = "ok"
+OUTCOME_RATE_LIMITED = "rate_limited"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_CANCELLED = "cancelled"
+OUTCOME_ERROR = "error"
+
+
+class GeminiLimiterTimeout(Exception):
+    """No capacity for the model within the caller's wait budget."""
+
+
+@contextmanager
+def llm_lane(lane: str) -> Iterator[None]:
+    """Run the Gemini calls made inside this block in the given priority lane."""
+    if lane not in LANE_PRIORITY:
+        raise ValueError(f"Unknown LLM lane: {lane}")
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def current_lane() -> str:
+    return _current_lane.get()
+
+
+def classify_outcome(error: Optional[BaseException]) -> str:
+    """Map a Gemini call's exception (or None) to a limiter outcome."""
+    if error is None:
+        return OUTCOME_OK
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return OUTCOME_TIMEOUT
+    if not isinstance(error, Exception):  # CancelledError, KeyboardInterrupt, GeneratorExit
+        return OUTCOME_CANCELLED
+    text = str(error)
+    if "429" in text or "ResourceExhausted" in type(error).__name__:
+        return OUTCOME_RATE_LIMITED
+    return OUTCOME_ERROR
+
+
+class GeminiLimiter:
+    """Per-model token bucket + AIMD concurrency window, shared through SQLite."""
+
+    def __init__(self, enabled: bool = GEMINI_LIMITER_ENABLED):
+        self.enabled = enabled
+        self.waits = 0
+        self.timeouts = 0
+        # lane -> [acquisitions, total seconds queued]
+        self.lane_waits: Dict[str, list] = {
+            lane: [0, 0.0] for lane in LANE_PRIORITY}
+        self._schema_ready = False
+
+    def _ensure_schema(self, conn) -> None:
+        if self._schema_ready:
+            return
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS gemini_limiter (
+                    model TEXT PRIMARY KEY,
+                    concurrency REAL NOT NULL,
+                    rate REAL NOT NULL,
+                    tokens REAL NOT NULL,
+                    refilled_at REAL NOT NULL,
+                    last_decrease REAL NOT NULL DEFAULT 0,
+                    successes INTEGER NOT NULL DEFAULT 0,
+                    rate_limited INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS gemini_limiter_leases (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    model TEXT NOT NULL,
+                    lane TEXT NOT NULL DEFAULT 'interactive',
+                    acquired_at REAL NOT NULL,
+                    pid INTEGER NOT NULL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_gemini_limiter_leases_model ON gemini_limiter_leases (model, acquired_at)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS gemini_limiter_waiters (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    model TEXT NOT NULL,
+                    lane TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    since REAL NOT NULL,
+                    seen_at REAL NOT NULL,
+                    pid INTEGER NOT NULL
+                )
+            """)
+        self._schema_ready = True
+
+    def _try_acquire(self, model: str, lane: str, waiter_id: Optional[int]) -> Tuple[Optional[int], float, Optional[int]]:
+        """Take a lease if the model has a free slot and a token for this lane.
+
+        Returns (lease_id, 0, None) on success, else (None, seconds to wait,
+        waiter_id) with the caller registered (or refreshed) as queued.
+        """
+        now = time.time()
+        priority = LANE_PRIORITY[lane]
+        conn = get_state_connection()
+        self._ensure_schema(conn)
+        # IMMEDIATE so two processes can't both take the last token
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT concurrency, rate, tokens, refilled_at FROM gemini_limiter WHERE model = ?",
+                (model,)).fetchone()
+            if row is None:
+                concurrency, rate, tokens, refilled_at = INITIAL_CONCURRENCY, INITIAL_RATE, BURST, now
+                conn.execute(
+                    "INSERT INTO gemini_limiter (model, concurrency, rate, tokens, refilled_at) VALUES (?, ?, ?, ?, ?)",
+                    (model, concurrency, rate, tokens, refilled_at))
+            else:
+                concurrency, rate, tokens, refilled_at = row
+            tokens = min(BURST, tokens + max(0.0, now - refilled_at) * rate)
+
+            higher_waiting = conn.execute(
+                "SELECT COUNT(*) FROM gemini_limiter_waiters WHERE model = ? AND priority < ? AND seen_at >= ?",
+                (model, priority, now - WAITER_STALE_SECONDS)).fetchone()[0]
+            in_flight, lane_in_flight = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(lane = ?), 0) FROM gemini_limiter_leases WHERE model = ? AND acquired_at >= ?",
+                (lane, model, now - LEASE_TTL_SECONDS)).fetchone()
+            lane_window = max(1, int(concurrency * LANE_WINDOW_SHARE[lane]))
+
+            lease_id, wait = None, 0.0
+            if higher_waiting or in_flight >= int(concurrency) or lane_in_flight >= lane_window:
+                wait = WINDOW_POLL_SECONDS
+            elif tokens < 1:
+                wait = min(WINDOW_POLL_SECONDS * 4, (1 - tokens) / rate)
+            else:
+                tokens -= 1
+                lease_id = conn.execute(
+                    "INSERT INTO gemini_limiter_leases (model, lane, acquired_at, pid) VALUES (?, ?, ?, ?)",
+                    (model, lane, now, os.getpid())).lastrowid
+
+            if lease_id is not None:
+                if waiter_id is not None:
+                    conn.execute(
+                        "DELETE FROM gemini_limiter_waiters WHERE id = ?", (waiter_id,))
+                    waiter_id = None
+            elif waiter_id is None:
+                waiter_id = conn.execute(
+                    "INSERT INTO gemini_limiter_waiters (model, lane, priority, since, seen_at, pid) VALUES (?, ?, ?, ?, ?, ?)",
+                    (model, lane, priority, now, now, os.getpid())).lastrowid
+            else:
+                conn.execute(
+                    "UPDATE gemini_limiter_waiters SET seen_at = ? WHERE id = ?", (now, waiter_id))
+
+            conn.execute("UPDATE gemini_limiter SET tokens = ?, refilled_at = ? WHERE model = ?",
+                         (tokens, now, model))
+            conn.execute("DELETE FROM gemini_limiter_leases WHERE acquired_at < ?",
+                         (now - LEASE_TTL_SECONDS,))
+            conn.execute("DELETE FROM gemini_limiter_waiters WHERE seen_at < ?",
+                         (now - LEASE_TTL_SECONDS,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return lease_id, wait, waiter_id
+
+    def _drop_waiter(self, waiter_id: Optional[int]) -> None:
+        if waiter_id is None:
+            return
+        try:
+            conn = get_state_connection()
+            with conn:
+                conn.execute(
+                    "DELETE FROM gemini_limiter_waiters WHERE id = ?", (waiter_id,))
+        except Exception as e:
+            logger.warning(
+                f"[GeminiLimiter] Could not remove queued caller {waiter_id}: {e}")
+
+    def _acquire_step(self, model: str, lane: str, waiter_id: Optional[int],
+                      deadline: float, max_wait: float) -> Tuple[Optional[int], float, Optional[int]]:
+        """One acquisition attempt: (lease_id, 0, None) on success, (None, wait, waiter_id) to retry; raises on timeout."""
+        try:
+            lease_id, wait, waiter_id = self._try_acquire(
+                model, lane, waiter_id)
+        except Exception as e:
+            logger.warning(
+                f"[GeminiLimiter] State DB unavailable, calling {model} unlimited: {e}")
+            return None, 0.0, waiter_id
+        if lease_id is not None:
+            return lease_id, 0.0, None
+        if time.time() + wait > deadline:
+            self.timeouts += 1
+            raise GeminiLimiterTimeout(
+                f"No Gemini capacity for {model} in the {lane} lane within {max_wait:g}s (client-side limit)")
+        return None, wait, waiter_id
+
+    def _record_wait(self, lane: str, queued: float) -> None:
+        if queued > 0:
+            self.waits += 1
+        totals = self.lane_waits[lane]
+        totals[0] += 1
+        totals[1] += queued
+        llm_queue_wait_seconds.observe(queued, lane=lane)
+
+    def acquire_sync(self, model: str, max_wait: Optional[float] = None) -> Optional[int]:
+        """Block until the model has capacity in the current lane. Returns a lease id (None when unlimited)."""
+        if not self.enabled:
+            return None
+        lane = current_lane()
+        max_wait = LANE_MAX_WAIT[lane] if max_wait is None else max_wait
+        started = time.time()
+        deadline = started + max_wait
+        waiter_id = None
+        try:
+            while True:
+                lease_id, wait, waiter_id = self._acquire_step(
+                    model, lane, waiter_id, deadline, max_wait)
+                if wait <= 0:
+                    self._record_wait(lane, time.time() - started)
+                    return lease_id
+                time.sleep(wait)
+        finally:
+            self._drop_waiter(waiter_id)
+
+    def _abandon_step(self, model: str, step: "asyncio.Future") -> None:
+        """Undo an acquisition step whose caller was cancelled meanwhile: return its lease or drop its queue row."""
+        if step.cancelled() or step.exception() is not None:
+            return
+        lease_id, _, waiter_id = step.result()
+        loop = asyncio.get_running_loop()
+        if lease_id is not None:
+            loop.run_in_executor(
+                None, self.release, model, lease_id, OUTCOME_CANCELLED, 0.0)
+        elif waiter_id is not None:
+            loop.run_in_executor(None, self._drop_waiter, waiter_id)
+
+    async def acquire(self, model: str, max_wait: Optional[float] = None) -> Optional[int]:
+        """Wait (without blocking the loop) until the model has capacity in the current lane. Returns a lease id (None when unlimited)."""
+        if not self.enabled:
+            return None
+        lane = current_lane()
+        max_wait = LANE_MAX_WAIT[lane] if max_wait is None else max_wait
+        started = time.time()
+        deadline = started + max_wait
+        waiter_id = None
+        try:
+            while True:
+                step = asyncio.ensure_future(asyncio.to_thread(
+                    self._acquire_step, model, lane, waiter_id, deadline, max_wait))
+                try:
+                    # Shielded: the step finishes in its thread even if we're cancelled
+                    lease_id, wait, waiter_id = await asyncio.shield(step)
+                except asyncio.CancelledError:
+                    step.add_done_callback(
+                        lambda done: self._abandon_step(model, done))
+                    raise
+                if wait <= 0:
+                    self._record_wait(lane, time.time() - started)
+                    return lease_id
+                await asyncio.sleep(wait)
+        finally:
+            if waiter_id is not None:
+                await asyncio.to_thread(self._drop_waiter, waiter_id)
+
+    def release(self, model: str, lease_id: Optional[int], outcome: str, latency: float) -> None:
+        """Return the lease and feed the call's outcome into the model's AIMD state.
+
+        Cancelled and failed (non-429) calls only return the lease.
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        try:
+            conn = get_state_connection()
+            self._ensure_schema(conn)
+            with conn:
+                if lease_id is not None:
+                    conn.execute(
+                        "DELETE FROM gemini_limiter_leases WHERE id = ?", (lease_id,))
+                row = conn.execute(
+                    "SELECT concurrency, rate, last_decrease FROM gemini_limiter WHERE model = ?",
+                    (model,)).fetchone()
+                if row is None:
+                    return
+                concurrency, rate, last_decrease = row
+                if outcome == OUTCOME_RATE_LIMITED:
+                    if now - last_decrease < DECREASE_COOLDOWN_SECONDS:
+                        conn.execute(
+                            "UPDATE gemini_limiter SET rate_limited = rate_limited + 1 WHERE model = ?", (model,))
+                        return
+                    concurrency = max(
+                        MIN_CONCURRENCY, concurrency * DECREASE_FACTOR)
+                    rate = max(MIN_RATE, rate * DECREASE_FACTOR)
+                    conn.execute("""
+                        UPDATE gemini_limiter SET concurrency = ?, rate = ?, last_decrease = ?,
+                            rate_limited = rate_limited + 1 WHERE model = ?
+                    """, (concurrency, rate, now, model))
+                    logger.warning(
+                        f"[GeminiLimiter] 429 from {model}: window {concurrency:.1f}, rate {rate:.2f}/s")
+                elif outcome == OUTCOME_TIMEOUT:
+                    concurrency = max(
+                        MIN_CONCURRENCY, concurrency * SLOW_DECREASE_FACTOR)
+                    conn.execute(
+                        "UPDATE gemini_limiter SET concurrency = ? WHERE model = ?", (concurrency, model))
+                    logger.warning(
+                        f"[GeminiLimiter] {model} call timed out after {latency:.1f}s: window {concurrency:.1f}")
+                elif outcome == OUTCOME_OK:
+                    if latency > SLOW_CALL_SECONDS:
+                        concurrency = max(
+                            MIN_CONCURRENCY, concurrency * SLOW_DECREASE_FACTOR)
+                    else:
+                        concurrency = min(
+                            MAX_CONCURRENCY, concurrency + 1 / concurrency)
+                        rate = min(MAX_RATE, rate + RATE_STEP)
+                    conn.execute(
+                        "UPDATE gemini_limiter SET concurrency = ?, rate = ?, successes = successes + 1 WHERE model = ?",
+                        (concurrency, rate, model))
+        except Exception as e:
+            logger.warning(
+                f"[GeminiLimiter] Could not record {outcome} for {model}: {e}")
+
+    @contextmanager
+    def limit(self, model: str, max_wait: Optional[float] = None) -> Iterator[None]:
+        """Hold a slot for one blocking Gemini call: `with gemini_limiter.limit(model): ...`"""
+        lease_id = self.acquire_sync(model, max_wait)
+        started = time.perf_counter()
+        error: Optional[BaseException] = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.release(model, lease_id, classify_outcome(error),
+                         time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def limit_async(self, model: str, max_wait: Optional[float] = None) -> AsyncIterator[None]:
+        """Hold a slot for one awaited Gemini call: `async with gemini_limiter.limit_async(model): ...`"""
+        lease_id = await self.acquire(model, max_wait)
+        started = time.perf_counter()
+        error: Optional[BaseException] = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await asyncio.to_thread(self.release, model, lease_id, classify_outcome(error),
+                                    time.perf_counter() - started)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Current window, rate, in-flight and queued callers per model, and queue wait per lane."""
+        stats: Dict[str, Any] = {"enabled": self.enabled,
+                                 "waits": self.waits, "timeouts": self.timeouts, "models": {},
+                                 "lanes": {lane: {"acquired": count, "avg_wait_seconds": round(total / count, 3) if count else 0.0}
+                                           for lane, (count, total) in self.lane_waits.items()}}
+        try:
+            conn = get_state_connection()
+            self._ensure_schema(conn)
+            now = time.time()
+            in_flight = dict(conn.execute(
+                "SELECT model, COUNT(*) FROM gemini_limiter_leases WHERE acquired_at >= ? GROUP BY model",
+                (now - LEASE_TTL_SECONDS,)).fetchall())
+            queued: Dict[str, Dict[str, int]] = {}
+            for model, lane, count in conn.execute(
+                    "SELECT model, lane, COUNT(*) FROM gemini_limiter_waiters WHERE seen_at >= ? GROUP BY model, lane",
+                    (now - WAITER_STALE_SECONDS,)):
+                queued.setdefault(model, {})[lane] = count
+            for model, concurrency, rate, successes, rate_limited in conn.execute(
+                    "SELECT model, concurrency, rate, successes, rate_limited FROM gemini_limiter"):
+                stats["models"][model] = {
+                    "concurrency": round(concurrency, 2),
+                    "rate_per_second": round(rate, 3),
+                    "in_flight": in_flight.get(model, 0),
+                    "queued": queued.get(model, {}),
+                    "successes": successes,
+                    "rate_limited": rate_limited
+                }
+        except Exception as e:
+            stats["error"] = str(e)
+        return stats
+
+
+# Shared limiter for all Gemini calls in this process
+gemini_limiter = GeminiLimiter()
@@ -1,9 +1,11 @@
 import os
 import logging
-import google.generativeai as genai
 from dotenv import load_dotenv
 import traceback
 
+from services.gemini_limiter import gemini_limiter
+from services.model_registry import model_registry
+
 # Load environment variables
 load_dotenv()
 
@@ -22,8 +24,8 @@ if not GEMINI_API_KEY:
 else:
     logger.info(f"Using Gemini model: {GEMINI_MODEL}")
 
-# Configure the Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
+# The SDK is imported and configured on first use, not at import time
+model_registry.configure(GEMINI_API_KEY)
 
 
 class GeminiService:
@@ -31,15 +33,20 @@ class GeminiService:
 
     def __init__(self):
         """Initialize the Gemini service"""
-        self.models = None
-        if GEMINI_API_KEY:
+        self._models = None
+
+    @property
+    def models(self):
+        """Available Gemini models, listed over the network on first access."""
+        if self._models is None and GEMINI_API_KEY:
             try:
-                self.models = genai.list_models()
+                self._models = list(model_registry.genai().list_models())
                 logger.info(
-                    f"Available models: {[model.name for model in self.models]}")
+                    f"Available models: {[model.name for model in self._models]}")
             except Exception as e:
                 logger.error(f"Error listing models: {e}")
                 logger.error(traceback.format_exc())
+        return self._models
 
     async def complete(self, prompt, model=None, temperature=0.7, max_tokens=2048):
         """
@@ -65,14 +72,12 @@ class GeminiService:
                 "max_output_tokens": max_tokens,
             }
 
-            # Initialize model
-            model = genai.GenerativeModel(
-                model_name=model_to_use,
-                generation_config=generation_config
-            )
+            # Shared client for this model and config
+            model = model_registry.get(model_to_use, generation_config)
 
             # Generate completion
-            response = model.generate_content(prompt)
+            async with gemini_limiter.limit_async(model_to_use):
+                response = await model.generate_content_async(prompt)
 
             if response.text:
                 # Just return the text directly instead of the JSON object
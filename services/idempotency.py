@@ -0,0 +1,143 @@
+"""
+Webhook Idempotency Filter
+=========================
+Drops ManyChat retry deliveries before any routing, DB reads or LLM calls.
+
+A delivery is identified by (subscriber id, last_input_text, ig_last_interaction).
+Recently seen keys live in an in-memory TTL/LRU map; a small SQLite table backs
+it so retries are still recognised after a restart or by another worker.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from services.state_db import get_state_connection
+
+logger = logging.getLogger("shanbot_idempotency")
+
+# Idempotency configuration
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("WEBHOOK_IDEMPOTENCY_TTL", "900"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("WEBHOOK_IDEMPOTENCY_MAX_KEYS", "10000"))
+PRUNE_EVERY_N_INSERTS = 500
+
+
+class IdempotencyFilter:
+    """TTL/LRU duplicate filter for webhook deliveries, backed by SQLite."""
+
+    def __init__(self, ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS, max_keys: int = IDEMPOTENCY_MAX_KEYS):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self.duplicates_suppressed = 0
+        self.deliveries_checked = 0
+        self._recent: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts_since_prune = 0
+        self._schema_ready = False
+
+    @staticmethod
+    def make_key(subscriber_id: str, message_text: str, ig_last_interaction: str) -> str:
+        """Build the delivery key from the fields ManyChat repeats on a retry."""
+        raw = "\x1f".join([str(subscriber_id), message_text or "", str(ig_last_interaction)])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _ensure_schema(self) -> None:
+        if self._schema_ready:
+            return
+        conn = get_state_connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS webhook_idempotency (
+                    key TEXT PRIMARY KEY,
+                    seen_at REAL NOT NULL
+                )
+            """)
+        self._schema_ready = True
+
+    def check_and_mark(self, subscriber_id: str, message_text: str, ig_last_interaction: Optional[str]) -> bool:
+        """Return True if this delivery was already seen (and should be dropped), otherwise record it."""
+        # Without ManyChat's interaction timestamp a retry can't be told apart
+        # from the user genuinely repeating themselves, so let it through.
+        if not ig_last_interaction:
+            return False
+
+        key = self.make_key(subscriber_id, message_text, ig_last_interaction)
+        now = time.time()
+
+        with self._lock:
+            self.deliveries_checked += 1
+            seen_at = self._recent.get(key)
+            if seen_at is not None and now - seen_at < self.ttl_seconds:
+                self._recent.move_to_end(key)
+                self.duplicates_suppressed += 1
+                return True
+
+        is_duplicate = False
+        try:
+            is_duplicate = not self._claim_persistent(key, now)
+        except Exception as e:
+            # Never block a delivery because the idempotency store is unavailable
+            logger.warning(f"[Idempotency] SQLite check failed, using memory only: {e}")
+
+        with self._lock:
+            if is_duplicate:
+                self.duplicates_suppressed += 1
+            self._recent[key] = now
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.max_keys:
+                self._recent.popitem(last=False)
+        return is_duplicate
+
+    def unmark(self, subscriber_id: str, message_text: str, ig_last_interaction: Optional[str]) -> None:
+        """Forget a delivery recorded by check_and_mark, so ManyChat's retry of it is processed.
+
+        For deliveries that failed after being marked (routing or the journal
+        append raised and the webhook answered 500).
+        """
+        if not ig_last_interaction:
+            return
+        key = self.make_key(subscriber_id, message_text, ig_last_interaction)
+        with self._lock:
+            self._recent.pop(key, None)
+        try:
+            self._ensure_schema()
+            conn = get_state_connection()
+            with conn:
+                conn.execute(
+                    "DELETE FROM webhook_idempotency WHERE key = ?", (key,))
+        except Exception as e:
+            logger.warning(f"[Idempotency] Could not unmark delivery for {subscriber_id}: {e}")
+
+    def _claim_persistent(self, key: str, now: float) -> bool:
+        """Atomically record the key in SQLite. Returns False if it was already there and fresh."""
+        self._ensure_schema()
+        conn = get_state_connection()
+        with conn:
+            claimed = conn.execute("""
+                INSERT INTO webhook_idempotency (key, seen_at) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET seen_at = excluded.seen_at
+                WHERE webhook_idempotency.seen_at < ?
+            """, (key, now, now - self.ttl_seconds)).rowcount
+            self._inserts_since_prune += 1
+            if self._inserts_since_prune >= PRUNE_EVERY_N_INSERTS:
+                conn.execute("DELETE FROM webhook_idempotency WHERE seen_at < ?",
+                             (now - self.ttl_seconds,))
+                self._inserts_since_prune = 0
+        return claimed > 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get duplicate-suppression counters."""
+        return {
+            "duplicates_suppressed": self.duplicates_suppressed,
+            "deliveries_checked": self.deliveries_checked,
+            "keys_in_memory": len(self._recent),
+            "ttl_seconds": self.ttl_seconds
+        }
+
+
+# Shared filter for the ManyChat webhook
+webhook_idempotency = IdempotencyFilter()
@@ -0,0 +1,242 @@
+"""
+Ingest Journal Service
+=====================
+Append-only SQLite journal for ManyChat webhook deliveries.
+
+In journal ingest mode the webhook appends the parsed payload here and
+acknowledges straight away; background workers then drain the journal
+through the ActionRouter. Entries a previous process left pending or
+mid-processing are replayed on startup.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from services.state_db import get_state_connection
+
+logger = logging.getLogger("shanbot_journal")
+
+# Journal configuration
+JOURNAL_WORKERS = int(os.getenv("WEBHOOK_JOURNAL_WORKERS", "4"))
+JOURNAL_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_JOURNAL_MAX_ATTEMPTS", "3"))
+JOURNAL_RETENTION_SECONDS = 7 * 24 * 3600  # keep finished entries for a week
+
+# Entry statuses
+STATUS_PENDING = "pending"
+STATUS_PROCESSING = "processing"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Global journal worker state
+journal_queue: Optional[asyncio.Queue] = None
+journal_workers: List[asyncio.Task] = []
+journal_handler: Optional[Callable[..., Awaitable[Dict[str, Any]]]] = None
+journal_gate: Optional[Callable[[], bool]] = None
+
+GATE_POLL_SECONDS = 1.0  # how often a closed gate is re-checked
+
+
+class IngestJournal:
+    """Durable webhook ingest journal drained by async workers."""
+
+    @staticmethod
+    def ensure_schema() -> None:
+        """Create the journal table if it doesn't exist."""
+        conn = get_state_connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS webhook_journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    subscriber_id TEXT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    last_error TEXT,
+                    received_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_webhook_journal_status ON webhook_journal (status, id)")
+
+    @staticmethod
+    def append(subscriber_id: str, payload: Dict[str, Any]) -> int:
+        """Append a parsed webhook payload and queue it for processing. Returns the entry id."""
+        conn = get_state_connection()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO webhook_journal (subscriber_id, payload, status, received_at) VALUES (?, ?, ?, ?)",
+                (subscriber_id, json.dumps(payload), STATUS_PENDING, time.time())
+            )
+        entry_id = cursor.lastrowid
+
+        if journal_queue is not None:
+            journal_queue.put_nowait(entry_id)
+        else:
+            logger.warning(
+                f"[Journal] Entry {entry_id} stored but no workers are running; it will be replayed on startup")
+        return entry_id
+
+    @staticmethod
+    async def start(handler: Callable[..., Awaitable[Dict[str, Any]]], worker_count: int = JOURNAL_WORKERS,
+                    gate: Optional[Callable[[], bool]] = None) -> int:
+        """Start the drain workers and replay unfinished entries. Returns the replay count.
+
+        If a gate is given, workers only process entries while it returns True;
+        an entry dequeued while it's closed is held until it reopens.
+        """
+        global journal_queue, journal_handler, journal_gate
+
+        IngestJournal.ensure_schema()
+        journal_handler = handler
+        journal_gate = gate
+        journal_queue = asyncio.Queue()
+
+        # Anything still 'processing' was interrupted by a restart
+        conn = get_state_connection()
+        with conn:
+            conn.execute("UPDATE webhook_journal SET status = ? WHERE status = ?",
+                         (STATUS_PENDING, STATUS_PROCESSING))
+            conn.execute("DELETE FROM webhook_journal WHERE status IN (?, ?) AND finished_at < ?",
+                         (STATUS_DONE, STATUS_FAILED, time.time() - JOURNAL_RETENTION_SECONDS))
+        pending_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM webhook_journal WHERE status = ? ORDER BY id", (STATUS_PENDING,))]
+        for entry_id in pending_ids:
+            journal_queue.put_nowait(entry_id)
+
+        for index in range(max(1, worker_count)):
+            journal_workers.append(asyncio.create_task(
+                IngestJournal._worker(index)))
+
+        logger.info(
+            f"[Journal] Started {len(journal_workers)} workers, replaying {len(pending_ids)} pending entries")
+        return len(pending_ids)
+
+    @staticmethod
+    async def stop() -> None:
+        """Stop the drain workers. Unfinished entries stay pending for the next startup."""
+        global journal_queue
+        for task in journal_workers:
+            task.cancel()
+        if journal_workers:
+            await asyncio.gather(*journal_workers, return_exceptions=True)
+        journal_workers.clear()
+        journal_queue = None
+        logger.info("[Journal] Workers stopped")
+
+    @staticmethod
+    async def _worker(index: int) -> None:
+        """Drain journal entries until cancelled."""
+        while True:
+            entry_id = await journal_queue.get()
+            try:
+                # Checked after the dequeue: idle workers are all parked in get(),
+                # so a gate checked before it would let them through when it closes
+                while journal_gate is not None and not journal_gate():
+                    await asyncio.sleep(GATE_POLL_SECONDS)
+                await IngestJournal._process_entry(entry_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(
+                    f"[Journal] Worker {index} error on entry {entry_id}: {e}", exc_info=True)
+            finally:
+                journal_queue.task_done()
+
+    @staticmethod
+    async def _process_entry(entry_id: int) -> None:
+        """Run a single journal entry through the handler and record its status."""
+        conn = get_state_connection()
+        with conn:
+            claimed = conn.execute(
+                "UPDATE webhook_journal SET status = ?, attempts = attempts + 1, started_at = ? WHERE id = ? AND status = ?",
+                (STATUS_PROCESSING, time.time(), entry_id, STATUS_PENDING)
+            ).rowcount
+        if not claimed:
+            return  # Already handled (e.g. queued twice during replay)
+
+        row = conn.execute(
+            "SELECT payload, attempts FROM webhook_journal WHERE id = ?", (entry_id,)).fetchone()
+        payload, attempts = json.loads(row[0]), row[1]
+
+        try:
+            result = await journal_handler(**payload)
+        except asyncio.CancelledError:
+            # Shutting down mid-entry: leave it for replay
+            IngestJournal._set_status(entry_id, STATUS_PENDING)
+            raise
+        except Exception as e:
+            if attempts < JOURNAL_MAX_ATTEMPTS:
+                logger.warning(
+                    f"[Journal] Entry {entry_id} failed (attempt {attempts}/{JOURNAL_MAX_ATTEMPTS}), requeueing: {e}")
+                IngestJournal._set_status(
+                    entry_id, STATUS_PENDING, error=str(e))
+                journal_queue.put_nowait(entry_id)
+            else:
+                logger.error(
+                    f"[Journal] Entry {entry_id} failed permanently: {e}")
+                IngestJournal._set_status(
+                    entry_id, STATUS_FAILED, error=str(e), finished=True)
+            return
+
+        status = STATUS_FAILED if isinstance(
+            result, dict) and result.get("status") == "error" else STATUS_DONE
+        IngestJournal._set_status(entry_id, status, result=result,
+                                  error=result.get("message") if status == STATUS_FAILED else None,
+                                  finished=True)
+
+    @staticmethod
+    def _set_status(entry_id: int, status: str, result: Any = None,
+                    error: Optional[str] = None, finished: bool = False) -> None:
+        """Update the processing status of a journal entry."""
+        conn = get_state_connection()
+        with conn:
+            conn.execute(
+                "UPDATE webhook_journal SET status = ?, result = COALESCE(?, result), last_error = COALESCE(?, last_error), finished_at = ? WHERE id = ?",
+                (status, json.dumps(result, default=str) if result is not None else None,
+                 error, time.time() if finished else None, entry_id)
+            )
+
+    @staticmethod
+    def get_entry(entry_id: int) -> Optional[Dict[str, Any]]:
+        """Get the processing status of a journal entry."""
+        IngestJournal.ensure_schema()
+        row = get_state_connection().execute(
+            "SELECT id, subscriber_id, status, attempts, result, last_error, received_at, started_at, finished_at FROM webhook_journal WHERE id = ?",
+            (entry_id,)
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            "id": row[0],
+            "subscriber_id": row[1],
+            "status": row[2],
+            "attempts": row[3],
+            "result": json.loads(row[4]) if row[4] else None,
+            "last_error": row[5],
+            "received_at": row[6],
+            "started_at": row[7],
+            "finished_at": row[8]
+        }
+
+    @staticmethod
+    def get_stats() -> Dict[str, Any]:
+        """Get journal entry counts by status."""
+        try:
+            IngestJournal.ensure_schema()
+            counts = dict(get_state_connection().execute(
+                "SELECT status, COUNT(*) FROM webhook_journal GROUP BY status").fetchall())
+            return {
+                "workers": len(journal_workers),
+                "queued": journal_queue.qsize() if journal_queue is not None else 0,
+                "by_status": counts
+            }
+        except Exception as e:
+            logger.error(f"[Journal] Error getting journal stats: {e}")
+            return {"error": str(e)}
@@ -0,0 +1,211 @@
+"""
+Intent Detector
+==============
+Single-pass intent detection shared by the action handlers.
+
+Every handler keyword list is compiled into one Aho-Corasick automaton and
+the URL/quantity patterns into precompiled regexes. A message is lowercased
+and scanned once; detect_intents() returns an IntentResult with every
+matched intent and its confidence, and the handlers' _is_* checks read from
+that result instead of rescanning the text with their own loops.
+
+Results are cached by message text, so the router and each handler asking
+about the same message share one scan.
+"""
+
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+# Keyword groups (substring matches on the lowercased message, as the handlers
+# did with `any(kw in text ...)`)
+KEYWORD_GROUPS: Dict[str, List[str]] = {
+    # AdResponseHandler.is_ad_response
+    "ad_vegan": ["vegan"],
+    "ad_vegetarian": ["vegetarian"],
+    "ad_challenge": ["challeng"],
+    "ad_program": ["program", "join", "weight loss", "weightloss", "fitness", "training"],
+    "ad_keyword": ["challenge", "vegan challenge", "vegetarian challenge", "learn more", "get started"],
+    # FormCheckHandler._is_form_check_request
+    "form_check": ["form check", "check my form", "form", "technique", "how did i do",
+                   "how does this look", "feedback on", "critique", "analyze", "video", "movement"],
+    "exercise": ["squat", "deadlift", "bench", "press", "curl", "row", "pull", "push", "lift", "exercise"],
+    "question": ["?", "how"],
+    # TrainerizeActionHandler._is_program_build_request
+    "program_build": ["build program", "create program", "make program", "design program",
+                      "set up program", "program me", "trainerize program", "workout program"],
+    # CalorieActionHandler._is_food_log
+    "food": ["ate", "had", "breakfast", "lunch", "dinner", "snack", "meal", "food",
+             "calories", "protein", "carbs"],
+}
+
+# Exact-phrase commands (whitespace-normalized, lowercased message)
+EXACT_PHRASES: Dict[str, Set[str]] = {
+    "calorie_tracking": {"track my cals", "track my cals plz"},
+    "workout_request": {"adjust my workout plz"},
+}
+
+MEDIA_URL_RE = re.compile(
+    r"(https?://lookaside\.fbsbx\.com/ig_messaging_cdn/\?asset_id=[\w-]+&signature=[\w\-_.~]+)")
+QUANTITY_RE = re.compile(
+    r"\d+\s*(?:g|grams|oz|ounces|cups?|tbsp|tsp|calories|cal|kcal|servings?|portions?)")
+
+# Ad scenarios, as stored in users.ad_scenario
+AD_SCENARIO_VEGAN = 1
+AD_SCENARIO_VEGETARIAN = 2
+AD_SCENARIO_PLANT_BASED = 3
+
+
+class AhoCorasick:
+    """Multi-pattern substring matcher: finds every occurrence of every pattern in one pass."""
+
+    def __init__(self, patterns: Iterable[Tuple[str, str]] = ()):
+        # Trie nodes: goto[node][char] -> node, fail[node] -> node, output[node] -> [(pattern, value)]
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, str]]] = [[]]
+        self._built = False
+        for pattern, value in patterns:
+            self.add(pattern, value)
+
+    def add(self, pattern: str, value: str) -> None:
+        """Add a pattern; value is reported with each match (e.g. its keyword group)."""
+        if not pattern:
+            return
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append((pattern, value))
+        self._built = False
+
+    def build(self) -> "AhoCorasick":
+        """Compute failure links (breadth-first) and merge outputs along them."""
+        queue = deque()
+        for child in self._goto[0].values():
+            self._fail[child] = 0
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + \
+                    self._output[self._fail[child]]
+        self._built = True
+        return self
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, str, str]]:
+        """Yield (end_index, pattern, value) for every match in text."""
+        if not self._built:
+            self.build()
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for pattern, value in output[node]:
+                yield index, pattern, value
+
+
+def _build_keyword_automaton() -> AhoCorasick:
+    automaton = AhoCorasick()
+    for group, keywords in KEYWORD_GROUPS.items():
+        for keyword in keywords:
+            automaton.add(keyword, group)
+    return automaton.build()
+
+
+KEYWORD_AUTOMATON = _build_keyword_automaton()
+
+
+class IntentResult:
+    """Everything the handlers need to know about one message, from a single scan."""
+
+    def __init__(self, message_text: str):
+        self.text = message_text
+        self.lowered = message_text.lower()
+        self.normalized = " ".join(self.lowered.split())
+        self.word_count = len(message_text.split())
+
+        self.matches: Dict[str, Set[str]] = {}
+        for _, keyword, group in KEYWORD_AUTOMATON.iter_matches(self.lowered):
+            self.matches.setdefault(group, set()).add(keyword)
+
+        media_match = MEDIA_URL_RE.search(message_text)
+        self.media_url: Optional[str] = media_match.group(
+            1) if media_match else None
+        self.has_media_url = media_match is not None
+        self.has_quantity = QUANTITY_RE.search(self.lowered) is not None
+
+        self.ad_scenario = AD_SCENARIO_PLANT_BASED
+        # intent name -> confidence (0-100); only matched intents are present
+        self.intents: Dict[str, int] = {}
+        self._score()
+
+    def has(self, group: str) -> bool:
+        return group in self.matches
+
+    def matched(self, group: str) -> List[str]:
+        return sorted(self.matches.get(group, ()))
+
+    def confidence(self, intent: str) -> int:
+        return self.intents.get(intent, 0)
+
+    def _score(self) -> None:
+        for intent, phrases in EXACT_PHRASES.items():
+            if self.normalized in phrases:
+                self.intents[intent] = 100
+
+        # Ad response: same precedence as AdResponseHandler.is_ad_response
+        if self.has("ad_vegan") and self.has("ad_challenge"):
+            self.ad_scenario, self.intents["ad_response"] = AD_SCENARIO_VEGAN, 90
+        elif self.has("ad_vegetarian") and self.has("ad_challenge"):
+            self.ad_scenario, self.intents["ad_response"] = AD_SCENARIO_VEGETARIAN, 90
+        elif self.has("ad_vegan") and self.has("ad_program"):
+            self.ad_scenario, self.intents["ad_response"] = AD_SCENARIO_VEGAN, 85
+        elif self.has("ad_vegetarian") and self.has("ad_program"):
+            self.ad_scenario, self.intents["ad_response"] = AD_SCENARIO_VEGETARIAN, 85
+        elif self.has("ad_keyword"):
+            self.ad_scenario, self.intents["ad_response"] = AD_SCENARIO_PLANT_BASED, 80
+
+        # Form check: a video, a form-check phrase, or an exercise plus a question
+        if self.has_media_url:
+            self.intents["form_check"] = 90
+        elif self.has("form_check"):
+            self.intents["form_check"] = 80
+        elif self.has("exercise") and self.has("question"):
+            self.intents["form_check"] = 60
+
+        if self.has("program_build"):
+            self.intents["program_build"] = 80
+
+        # Food log: a food image, or a food word with a quantity or some detail
+        if self.has_media_url:
+            self.intents["food_log"] = 90
+        elif self.has("food") and self.has_quantity:
+            self.intents["food_log"] = 80
+        elif self.has("food") and self.word_count > 3:
+            self.intents["food_log"] = 60
+
+
+@lru_cache(maxsize=512)
+def _detect_cached(message_text: str) -> IntentResult:
+    return IntentResult(message_text)
+
+
+def detect_intents(message_text: Optional[str]) -> IntentResult:
+    """Scan a message once and return all matched intents (cached by text)."""
+    return _detect_cached(message_text if isinstance(message_text, str) else "")
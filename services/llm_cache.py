@@ -0,0 +1,181 @@
+"""
+LLM Response Cache
+=================
+Content-addressed cache for short, classification-style Gemini calls.
+
+A response is keyed by (model, normalized prompt, generation config):
+prompts are compared with whitespace collapsed, so re-indenting an f-string
+template doesn't invalidate the cache. Entries live in an in-memory LRU and
+a SQLite table in the state DB with a TTL, trimmed to LLM_CACHE_MAX_ENTRIES
+least-recently-used rows.
+
+Caching is opt-in per call site (get_or_call); only use it for prompts whose
+answer is a pure function of the prompt text.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from services.metrics import llm_cache_total
+from services.state_db import get_state_connection
+
+logger = logging.getLogger("shanbot_llm_cache")
+
+# Cache configuration
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "512"))
+PRUNE_EVERY_N_INSERTS = 200
+
+
+class LLMCache:
+    """Two-tier (memory LRU + SQLite) cache of LLM responses by content hash."""
+
+    def __init__(self, enabled: bool = LLM_CACHE_ENABLED, ttl_seconds: float = LLM_CACHE_TTL_SECONDS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES, memory_entries: int = LLM_CACHE_MEMORY_ENTRIES):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts_since_prune = 0
+        self._schema_ready = False
+
+    @staticmethod
+    def make_key(model: str, prompt: str, generation_config: Optional[Dict[str, Any]] = None) -> str:
+        """Content hash of one LLM request."""
+        normalized_prompt = " ".join((prompt or "").split())
+        config = json.dumps(generation_config or {}, sort_keys=True, default=str)
+        raw = "\x1f".join([str(model), normalized_prompt, config])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _ensure_schema(self) -> None:
+        if self._schema_ready:
+            return
+        conn = get_state_connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)")
+        self._schema_ready = True
+
+    def get(self, key: str) -> tuple:
+        """Return (response, tier) for a fresh entry, or (None, None)."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                return entry[1], "memory"
+
+        try:
+            self._ensure_schema()
+            conn = get_state_connection()
+            row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ? AND created_at >= ?",
+                               (key, now - self.ttl_seconds)).fetchone()
+            if row is None:
+                return None, None
+            with conn:
+                conn.execute(
+                    "UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+        except Exception as e:
+            logger.warning(f"[LLMCache] SQLite lookup failed: {e}")
+            return None, None
+
+        self._remember(key, row[1], row[0])
+        return row[0], "sqlite"
+
+    def put(self, key: str, model: str, response: str) -> None:
+        now = time.time()
+        self._remember(key, now, response)
+        try:
+            self._ensure_schema()
+            conn = get_state_connection()
+            with conn:
+                conn.execute("""
+                    INSERT INTO llm_cache (key, model, response, created_at, last_used) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET response = excluded.response,
+                        created_at = excluded.created_at, last_used = excluded.last_used
+                """, (key, model, response, now, now))
+                self._inserts_since_prune += 1
+                if self._inserts_since_prune >= PRUNE_EVERY_N_INSERTS:
+                    self._prune(conn, now)
+                    self._inserts_since_prune = 0
+        except Exception as e:
+            logger.warning(f"[LLMCache] SQLite write failed: {e}")
+
+    def _remember(self, key: str, created_at: float, response: str) -> None:
+        with self._lock:
+            self._memory[key] = (created_at, response)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _prune(self, conn, now: float) -> None:
+        """Drop expired rows, then the least recently used beyond max_entries."""
+        conn.execute("DELETE FROM llm_cache WHERE created_at < ?",
+                     (now - self.ttl_seconds,))
+        conn.execute("""
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
+
+    async def get_or_call(self, model: str, prompt: str, call: Callable[[], Awaitable[Optional[str]]],
+                          site: str, generation_config: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Return the cached response for this request, or await call() and cache a non-empty result."""
+        if not self.enabled:
+            return await call()
+
+        key = self.make_key(model, prompt, generation_config)
+        response, tier = self.get(key)
+        if response is not None:
+            self.hits += 1
+            llm_cache_total.inc(site=site, result=f"hit_{tier}")
+            return response
+
+        self.misses += 1
+        llm_cache_total.inc(site=site, result="miss")
+        response = await call()
+        if isinstance(response, str) and response.strip():
+            self.put(key, model, response)
+        return response
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get hit/miss counters and tier sizes."""
+        stats = {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "ttl_seconds": self.ttl_seconds
+        }
+        try:
+            self._ensure_schema()
+            stats["sqlite_entries"] = get_state_connection().execute(
+                "SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        except Exception as e:
+            stats["sqlite_error"] = str(e)
+        return stats
+
+
+# Shared cache for classification-style prompts
+llm_cache = LLMCache()
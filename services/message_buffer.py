@@ -2,26 +2,50 @@
 Message Buffer Service
 =====================
 Handles message buffering and delayed processing for ManyChat webhooks.
+
+With the in-memory backend, buffered messages are also written through to
+the state DB (see buffer_persistence) so a restart inside the debounce
+window doesn't lose them: recover() re-buffers them on startup and
+shutdown() flushes what's pending before the process exits.
 """
 
 import asyncio
 import logging
+import os
 import time
-from collections import defaultdict
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional
 from functools import partial
 
+from services.buffer_backends import BufferBackend, InMemoryBufferBackend, create_buffer_backend
+from services.buffer_persistence import buffer_persistence
+from services.worker_pool import message_worker_pool
+from services.deadline_scheduler import DeadlineScheduler
+from services.adaptive_debounce import adaptive_debounce, DEBOUNCE_MAX_WAIT, DEBOUNCE_MAX_MESSAGES
+from services.metrics import (buffer_flush_messages, buffer_flush_seconds, buffer_flush_total,
+                              buffer_wait_seconds, buffer_window_seconds)
+
 logger = logging.getLogger("shanbot_buffer")
 
-# Global message buffering state
-manychat_message_buffer: Dict[str, List[Dict]] = defaultdict(list)
-manychat_last_message_time: Dict[str, float] = {}
-user_buffer_task_scheduled: Dict[str, bool] = defaultdict(bool)
-user_buffer_tasks: Dict[str, asyncio.Task] = {}
+# Buffered messages and last-message times live in the configured backend
+# (MESSAGE_BUFFER_BACKEND=memory|sqlite); only the flush deadlines are per process.
+buffer_backend: BufferBackend = create_buffer_backend()
+if buffer_backend.name != InMemoryBufferBackend.name:
+    # The shared SQLite backend is durable already
+    buffer_persistence.enabled = False
+
+# Arrival time of the first message in each subscriber's current burst
+user_burst_started: Dict[str, float] = {}
 
 # Buffer configuration
-BUFFER_WINDOW = 60.0  # seconds
+BUFFER_WINDOW = 60.0  # seconds; upper bound for the adaptive per-user window
+# Debounce stats for subscribers quiet this long are dropped
+BUFFER_IDLE_EVICT_SECONDS = float(
+    os.getenv("MESSAGE_BUFFER_IDLE_EVICT_SECONDS", "21600"))
+# How long shutdown() waits for pending bursts to be processed
+BUFFER_DRAIN_TIMEOUT = float(os.getenv("MESSAGE_BUFFER_DRAIN_TIMEOUT", "20"))
+# Retry delay for a claimed burst whose worker shard queue was full
+BUFFER_REQUEUE_DELAY = float(os.getenv("MESSAGE_BUFFER_REQUEUE_DELAY", "2"))
 
 
 class MessageBuffer:
@@ -32,16 +56,24 @@ class MessageBuffer:
         """Add message to buffer and schedule processing if needed."""
         try:
             current_time = time.time()
+            adaptive_debounce.observe_arrival(
+                subscriber_id, current_time, BUFFER_WINDOW)
+            user_burst_started.setdefault(subscriber_id, current_time)
 
             # Add message to buffer
-            manychat_message_buffer[subscriber_id].append(message_data)
-            manychat_last_message_time[subscriber_id] = current_time
+            buffer_size = buffer_backend.append(
+                subscriber_id, message_data, current_time)
+            buffer_persistence.record_append(
+                subscriber_id, message_data, current_time)
 
             logger.info(
-                f"[Buffer] Added message for {subscriber_id}. Buffer size: {len(manychat_message_buffer[subscriber_id])}")
+                f"[Buffer] Added message for {subscriber_id}. Buffer size: {buffer_size}")
 
-            # Schedule processing if not already scheduled
-            if not user_buffer_task_scheduled[subscriber_id]:
+            if buffer_size >= DEBOUNCE_MAX_MESSAGES:
+                # Enough for a complete thought; flush without waiting
+                MessageBuffer._schedule_delayed_processing(subscriber_id, 0)
+            elif not flush_scheduler.is_pending(subscriber_id):
+                # Schedule processing if not already scheduled
                 MessageBuffer._schedule_delayed_processing(subscriber_id)
 
         except Exception as e:
@@ -49,66 +81,146 @@ class MessageBuffer:
                 f"[Buffer] Error adding message for {subscriber_id}: {e}")
 
     @staticmethod
-    def _schedule_delayed_processing(subscriber_id: str) -> None:
+    def _schedule_delayed_processing(subscriber_id: str, delay: Optional[float] = None) -> None:
         """Schedule delayed processing for a user."""
         try:
-            user_buffer_task_scheduled[subscriber_id] = True
-
-            # Cancel existing task if any
-            if subscriber_id in user_buffer_tasks:
-                user_buffer_tasks[subscriber_id].cancel()
-
-            # Create new delayed task
-            loop = asyncio.get_event_loop()
-            task = loop.create_task(
-                MessageBuffer._delayed_message_processing(subscriber_id))
-            user_buffer_tasks[subscriber_id] = task
+            if delay is None:
+                delay = adaptive_debounce.window_for(
+                    subscriber_id, BUFFER_WINDOW)
+                buffer_window_seconds.observe(delay)
+            flush_scheduler.schedule(subscriber_id, time.time() + delay)
 
             logger.info(
-                f"[Buffer] Scheduled delayed processing for {subscriber_id}")
+                f"[Buffer] Scheduled delayed processing for {subscriber_id} in {delay:.1f}s")
 
         except Exception as e:
             logger.error(
                 f"[Buffer] Error scheduling processing for {subscriber_id}: {e}")
 
     @staticmethod
-    async def _delayed_message_processing(subscriber_id: str) -> None:
-        """Process buffered messages after delay."""
+    async def _on_flush_deadline(subscriber_id: str) -> None:
+        """Scheduler callback: flush the subscriber's burst if it has gone quiet, else reschedule."""
         try:
-            # Wait for buffer window
-            await asyncio.sleep(BUFFER_WINDOW)
+            # Claim the burst only if no message (in any process) arrived
+            # within the user's window, unless it has hit the max wait or
+            # max messages; otherwise wait out the remainder
+            window = adaptive_debounce.window_for(subscriber_id, BUFFER_WINDOW)
+            now = time.time()
+            burst_started = user_burst_started.get(subscriber_id, now)
+            if buffer_backend.size(subscriber_id) >= DEBOUNCE_MAX_MESSAGES:
+                reason = "max_messages"
+            elif now - burst_started >= DEBOUNCE_MAX_WAIT:
+                reason = "max_wait"
+            else:
+                reason = "quiet"
+            messages = buffer_backend.claim(
+                subscriber_id, window if reason == "quiet" else 0)
+            if messages is None:
+                delay = max(0.1, min(
+                    buffer_backend.last_message_time(
+                        subscriber_id) + window - now,
+                    burst_started + DEBOUNCE_MAX_WAIT - now))
+                flush_scheduler.schedule(subscriber_id, now + delay)
+                logger.info(
+                    f"[Buffer] More messages arrived for {subscriber_id}, waiting {delay:.1f}s more")
+                return
 
-            # Check if more messages arrived recently
-            current_time = time.time()
-            last_message_time = manychat_last_message_time.get(
-                subscriber_id, 0)
+            burst_started = user_burst_started.pop(subscriber_id, None)
 
-            if current_time - last_message_time < BUFFER_WINDOW:
-                # More messages arrived, schedule another processing
+            if not messages:
+                # Another worker process already flushed this burst
                 logger.info(
-                    f"[Buffer] More messages arrived for {subscriber_id}, rescheduling")
-                MessageBuffer._schedule_delayed_processing(subscriber_id)
+                    f"[Buffer] Nothing left to flush for {subscriber_id}")
                 return
 
-            # Process buffered messages
-            await MessageBuffer.process_buffered_messages(subscriber_id)
+            buffer_flush_total.inc(reason=reason)
+            if burst_started is not None:
+                buffer_wait_seconds.observe(time.time() - burst_started)
+            logger.info(
+                f"[Buffer] Flushing {len(messages)} messages for {subscriber_id} ({reason}, window {window:.1f}s)")
+
+            # Hand the flush to the subscriber's shard so it runs in order
+            # with any other work for this subscriber
+            MessageBuffer._submit_flush(
+                subscriber_id, messages, now, burst_started)
 
-        except asyncio.CancelledError:
-            logger.info(f"[Buffer] Processing cancelled for {subscriber_id}")
         except Exception as e:
             logger.error(
                 f"[Buffer] Error in delayed processing for {subscriber_id}: {e}")
-        finally:
-            user_buffer_task_scheduled[subscriber_id] = False
-            if subscriber_id in user_buffer_tasks:
-                del user_buffer_tasks[subscriber_id]
+
+    @staticmethod
+    def _submit_flush(subscriber_id: str, messages: List[Dict], claimed_at: float,
+                      burst_started: Optional[float] = None, requeue: bool = True) -> Optional[asyncio.Future]:
+        """Queue a claimed burst on the subscriber's worker shard.
+
+        If the shard is full the burst goes back into the buffer and is
+        retried after BUFFER_REQUEUE_DELAY (or, with requeue=False, left to
+        persistence for recovery on restart) instead of being dropped.
+        """
+        try:
+            future = message_worker_pool.submit(
+                subscriber_id, partial(MessageBuffer._process_claimed_messages, subscriber_id, messages, claimed_at))
+        except asyncio.QueueFull:
+            if not requeue:
+                logger.warning(
+                    f"[Buffer] Worker queue full for {subscriber_id}; {len(messages)} messages left for recovery")
+                return None
+            # Still persisted (nothing was discarded), so straight back into the backend
+            for message_data in messages:
+                buffer_backend.append(subscriber_id, message_data, claimed_at)
+            user_burst_started.setdefault(
+                subscriber_id, burst_started if burst_started is not None else claimed_at)
+            MessageBuffer._schedule_delayed_processing(
+                subscriber_id, BUFFER_REQUEUE_DELAY)
+            logger.warning(
+                f"[Buffer] Worker queue full for {subscriber_id}; re-buffered {len(messages)} messages")
+            return None
+        future.add_done_callback(
+            partial(MessageBuffer._log_flush_failure, subscriber_id))
+        return future
+
+    @staticmethod
+    def _log_flush_failure(subscriber_id: str, future: asyncio.Future) -> None:
+        """Done-callback: surface a flush job's exception (nobody awaits the future)."""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error(
+                f"[Buffer] Flush job failed for {subscriber_id}: {error!r}")
+
+    @staticmethod
+    def _evict_idle_state() -> None:
+        """Scheduler housekeeping: drop per-subscriber state nobody is using."""
+        cutoff = time.time() - BUFFER_IDLE_EVICT_SECONDS
+        evicted = adaptive_debounce.evict_idle(cutoff)
+        # Bursts whose flush was lost (e.g. claimed by another worker process)
+        stale_bursts = [subscriber_id for subscriber_id, started in user_burst_started.items()
+                        if started < cutoff and not flush_scheduler.is_pending(subscriber_id)]
+        for subscriber_id in stale_bursts:
+            user_burst_started.pop(subscriber_id, None)
+        if evicted or stale_bursts:
+            logger.info(
+                f"[Buffer] Evicted idle state for {evicted} subscribers ({len(stale_bursts)} stale bursts)")
 
     @staticmethod
     async def process_buffered_messages(subscriber_id: str) -> None:
-        """Process all buffered messages for a user."""
+        """Process all buffered messages for a user now, ignoring the buffer window."""
         try:
-            messages = manychat_message_buffer.get(subscriber_id, [])
+            claimed_at = time.time()
+            messages = buffer_backend.claim(subscriber_id, 0)
+            user_burst_started.pop(subscriber_id, None)
+            await MessageBuffer._process_claimed_messages(subscriber_id, messages or [], claimed_at)
 
+        except Exception as e:
+            logger.error(
+                f"[Buffer] Error processing buffered messages for {subscriber_id}: {e}")
+
+    @staticmethod
+    async def _process_claimed_messages(subscriber_id: str, messages: List[Dict],
+                                        claimed_at: Optional[float] = None) -> None:
+        """Process messages already taken out of the buffer (at claimed_at)."""
+        try:
             if not messages:
                 logger.info(
                     f"[Buffer] No messages to process for {subscriber_id}")
@@ -117,16 +229,20 @@ class MessageBuffer:
             logger.info(
                 f"[Buffer] Processing {len(messages)} buffered messages for {subscriber_id}")
 
-            # Clear the buffer
-            manychat_message_buffer[subscriber_id] = []
-
             # Process messages
-            await MessageBuffer._handle_buffered_messages_for_subscriber(subscriber_id, messages)
+            buffer_flush_messages.observe(len(messages))
+            with buffer_flush_seconds.time():
+                await MessageBuffer._handle_buffered_messages_for_subscriber(subscriber_id, messages)
 
         except Exception as e:
             logger.error(
                 f"[Buffer] Error processing buffered messages for {subscriber_id}: {e}")
 
+        # Done with (or given up on) these messages: nothing to recover after a
+        # restart. A cancelled flush skips this and is recovered instead.
+        if claimed_at is not None:
+            buffer_persistence.record_discard(subscriber_id, claimed_at)
+
     @staticmethod
     async def _handle_buffered_messages_for_subscriber(subscriber_id: str, messages: List[Dict]) -> None:
         """Handle buffered messages for a specific subscriber."""
@@ -182,28 +298,37 @@ class MessageBuffer:
     def get_buffer_stats(subscriber_id: str) -> Dict[str, Any]:
         """Get buffer statistics for a user."""
         return {
-            "buffer_size": len(manychat_message_buffer.get(subscriber_id, [])),
-            "last_message_time": manychat_last_message_time.get(subscriber_id, 0),
-            "processing_scheduled": user_buffer_task_scheduled.get(subscriber_id, False),
-            "has_active_task": subscriber_id in user_buffer_tasks
+            "buffer_size": buffer_backend.size(subscriber_id),
+            "last_message_time": buffer_backend.last_message_time(subscriber_id),
+            "processing_scheduled": flush_scheduler.is_pending(subscriber_id),
+            "flush_at": flush_scheduler.deadline(subscriber_id),
+            "debounce_window": round(adaptive_debounce.window_for(subscriber_id, BUFFER_WINDOW), 2),
+            "backend": buffer_backend.name
         }
 
+    @staticmethod
+    def get_totals() -> Dict[str, Any]:
+        """Get buffer totals across all users."""
+        totals = buffer_backend.get_totals()
+        totals["active_buffers"] = flush_scheduler.pending_count()
+        totals["pending_flushes"] = flush_scheduler.pending_count()
+        totals["scheduler"] = flush_scheduler.get_stats()
+        totals["debounce"] = adaptive_debounce.get_stats()
+        totals["persistence"] = buffer_persistence.get_stats()
+        totals["backend"] = buffer_backend.name
+        return totals
+
     @staticmethod
     def clear_user_buffer(subscriber_id: str) -> None:
         """Clear buffer for a specific user."""
         try:
             # Cancel any scheduled processing
-            if subscriber_id in user_buffer_tasks:
-                user_buffer_tasks[subscriber_id].cancel()
-                del user_buffer_tasks[subscriber_id]
+            flush_scheduler.cancel(subscriber_id)
 
             # Clear buffer data
-            if subscriber_id in manychat_message_buffer:
-                del manychat_message_buffer[subscriber_id]
-            if subscriber_id in manychat_last_message_time:
-                del manychat_last_message_time[subscriber_id]
-
-            user_buffer_task_scheduled[subscriber_id] = False
+            buffer_backend.clear(subscriber_id)
+            buffer_persistence.record_discard(subscriber_id, time.time())
+            user_burst_started.pop(subscriber_id, None)
 
             logger.info(f"[Buffer] Cleared buffer for {subscriber_id}")
 
@@ -212,6 +337,69 @@ class MessageBuffer:
                 f"[Buffer] Error clearing buffer for {subscriber_id}: {e}")
 
     @staticmethod
-    def shutdown():
-        """Gracefully stop background tasks (stub for webhook)."""
-        return
+    def recover() -> int:
+        """Re-buffer messages a previous process persisted but never processed. Returns the message count."""
+        try:
+            buffer_persistence.start()
+            pending = buffer_persistence.load_pending()
+        except Exception as e:
+            logger.error(f"[Buffer] Could not load persisted buffers: {e}")
+            return 0
+
+        recovered = 0
+        for subscriber_id, entries in pending.items():
+            for message_data, received_at in entries:
+                # Already persisted, so straight into the backend
+                buffer_backend.append(subscriber_id, message_data, received_at)
+                recovered += 1
+            user_burst_started.setdefault(subscriber_id, entries[0][1])
+            # The deadline callback flushes now if the window has passed, or
+            # waits out the rest of it
+            MessageBuffer._schedule_delayed_processing(subscriber_id, 0)
+
+        if recovered:
+            logger.info(
+                f"[Buffer] Recovered {recovered} buffered messages for {len(pending)} subscribers")
+        return recovered
+
+    @staticmethod
+    async def shutdown(timeout: float = BUFFER_DRAIN_TIMEOUT) -> None:
+        """Flush every pending burst now and wait up to timeout for it to be processed.
+
+        Bursts still unprocessed when the timeout expires (or the worker pool
+        stops) stay persisted and are recovered on the next startup.
+        """
+        pending = flush_scheduler.pending_keys()
+        flush_scheduler.stop()
+
+        flushes = []
+        for subscriber_id in pending:
+            flush_scheduler.cancel(subscriber_id)
+            try:
+                claimed_at = time.time()
+                messages = buffer_backend.claim(subscriber_id, 0)
+                user_burst_started.pop(subscriber_id, None)
+                if messages:
+                    future = MessageBuffer._submit_flush(
+                        subscriber_id, messages, claimed_at, requeue=False)
+                    if future is not None:
+                        flushes.append(future)
+            except Exception as e:
+                logger.error(
+                    f"[Buffer] Error draining buffer for {subscriber_id}: {e}")
+
+        if flushes:
+            logger.info(
+                f"[Buffer] Draining {len(flushes)} buffered bursts before shutdown")
+            _, unfinished = await asyncio.wait(flushes, timeout=timeout)
+            if unfinished:
+                logger.warning(
+                    f"[Buffer] {len(unfinished)} bursts not processed within {timeout}s; they will be recovered on restart")
+
+        await asyncio.to_thread(buffer_persistence.stop)
+
+
+# One scheduler coroutine services every subscriber's flush deadline
+flush_scheduler = DeadlineScheduler(
+    MessageBuffer._on_flush_deadline, name="buffer_flush",
+    housekeeping=MessageBuffer._evict_idle_state, housekeeping_interval=300.0)
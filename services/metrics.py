@@ -0,0 +1,320 @@
+"""
+Metrics Service
+==============
+Lightweight in-process metrics registry for the webhook, exposed in the
+Prometheus text format at /metrics. No client library or external service
+is needed; values live in this process only.
+
+Stages instrumented:
+    shanbot_router_*          ActionRouter.route_webhook_message, by branch taken
+    shanbot_db_query_*        queries on get_db_connection() connections, by operation
+    shanbot_db_queries_per_message  queries issued while routing one message, by branch
+    shanbot_gemini_call_*     Gemini calls, by model and outcome
+    shanbot_manychat_update_* update_manychat_fields sends, by outcome
+    shanbot_buffer_flush_*    MessageBuffer flushes, by trigger
+    shanbot_buffer_wait_*     time from a burst's first message to its flush
+"""
+
+import asyncio
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds: sub-millisecond SQLite up to slow LLM calls
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 3, 5, 8, 13, 21)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+TOKEN_BUCKETS = (500, 1000, 2000, 4000, 6000, 8000, 12000, 16000, 24000, 32000)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """Base class: a named metric family with fixed label names."""
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.type_name}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in items]
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram with _bucket, _sum and _count series."""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.setdefault(
+                key, [0] * (len(self.buckets) + 1) + [0.0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[len(self.buckets)] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[Dict[str, str]]:
+        """Observe the block's duration. Labels can be filled in inside the block via the yielded dict."""
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def get_count(self, **labels) -> int:
+        series = self._values.get(self._key(labels))
+        return int(series[len(self.buckets)]) if series else 0
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._values.items())
+        bounds = [f'le="{bound}"' for bound in self.buckets] + ['le="+Inf"']
+        lines = []
+        for key, series in items:
+            for index, bound in enumerate(bounds):
+                labels = _format_labels(self.labelnames, key, bound)
+                lines.append(f"{self.name}_bucket{labels} {int(series[index])}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-1])}")
+            lines.append(
+                f"{self.name}_count{labels} {int(series[len(self.buckets)])}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds metric families and renders them in the Prometheus text format."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4"
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Shared registry for the webhook process
+registry = MetricsRegistry()
+
+router_branch_total = registry.counter(
+    "shanbot_router_branch_total", "Messages routed, by ActionRouter branch taken", ["branch"])
+router_seconds = registry.histogram(
+    "shanbot_router_seconds", "ActionRouter.route_webhook_message latency, by branch", ["branch"])
+db_query_seconds = registry.histogram(
+    "shanbot_db_query_seconds", "SQLite query latency on get_db_connection connections", ["operation"])
+gemini_call_seconds = registry.histogram(
+    "shanbot_gemini_call_seconds", "Gemini call latency, by model and outcome", ["model", "outcome"])
+gemini_hedge_total = registry.counter(
+    "shanbot_gemini_hedge_total", "get_ai_response answers, by call site and winning model", ["site", "winner"])
+gemini_hedge_saved_seconds = registry.histogram(
+    "shanbot_gemini_hedge_saved_seconds", "Estimated latency saved by hedging, by call site", ["site"])
+llm_queue_wait_seconds = registry.histogram(
+    "shanbot_llm_queue_wait_seconds", "Time Gemini calls queued in the client-side limiter, by priority lane", ["lane"])
+manychat_update_seconds = registry.histogram(
+    "shanbot_manychat_update_seconds", "update_manychat_fields latency, by outcome", ["outcome"])
+buffer_flush_seconds = registry.histogram(
+    "shanbot_buffer_flush_seconds", "Time to process a flushed MessageBuffer burst")
+buffer_flush_messages = registry.histogram(
+    "shanbot_buffer_flush_messages", "Messages per MessageBuffer flush", buckets=SIZE_BUCKETS)
+buffer_flush_total = registry.counter(
+    "shanbot_buffer_flush_total", "MessageBuffer flushes, by trigger (quiet, max_wait, max_messages)", ["reason"])
+buffer_wait_seconds = registry.histogram(
+    "shanbot_buffer_wait_seconds", "Time from a burst's first buffered message to its flush")
+buffer_window_seconds = registry.histogram(
+    "shanbot_buffer_window_seconds", "Debounce window chosen when scheduling a flush")
+buffer_persist_commit_seconds = registry.histogram(
+    "shanbot_buffer_persist_commit_seconds", "Write-through commit latency for buffered messages")
+buffer_persist_batch_ops = registry.histogram(
+    "shanbot_buffer_persist_batch_ops", "Buffer writes grouped into one commit", buckets=BATCH_SIZE_BUCKETS)
+llm_cache_total = registry.counter(
+    "shanbot_llm_cache_total", "LLM cache lookups, by call site and result (hit_memory, hit_sqlite, miss)",
+    ["site", "result"])
+prompt_tokens = registry.histogram(
+    "shanbot_prompt_tokens", "Estimated prompt tokens after budget trimming, by prompt type",
+    ["prompt_type"], buckets=TOKEN_BUCKETS)
+db_queries_per_message = registry.histogram(
+    "shanbot_db_queries_per_message", "SQLite queries issued while routing one message, by branch",
+    ["branch"], buckets=QUERY_COUNT_BUCKETS)
+
+
+class QueryCount:
+    """Mutable query tally for the message currently being routed."""
+
+    def __init__(self):
+        self.count = 0
+
+
+# Set by count_db_queries(); follows the message across awaits but not into
+# other tasks' messages
+_current_query_count: ContextVar[Optional[QueryCount]] = ContextVar(
+    "shanbot_current_query_count", default=None)
+
+
+@contextmanager
+def count_db_queries() -> Iterator[QueryCount]:
+    """Count the SQLite queries observed inside the block (including ones run in to_thread)."""
+    tally = QueryCount()
+    token = _current_query_count.set(tally)
+    try:
+        yield tally
+    finally:
+        _current_query_count.reset(token)
+
+
+def sql_operation(sql: str) -> str:
+    """The statement's leading keyword (SELECT, INSERT, PRAGMA, ...) as a low-cardinality label."""
+    words = (sql or "").lstrip().split(None, 1)
+    return words[0].upper() if words else "UNKNOWN"
+
+
+def gemini_call_outcome(error: Optional[BaseException]) -> str:
+    """Outcome label for a Gemini call that raised error (or None on success)."""
+    if error is None:
+        return "ok"
+    if isinstance(error, asyncio.CancelledError):
+        return "cancelled"
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    return "rate_limited" if "429" in str(error) else "error"
+
+
+@contextmanager
+def observe_gemini_call(model: str) -> Iterator[None]:
+    """Time a Gemini call into shanbot_gemini_call_seconds, labelled by how it ended."""
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        gemini_call_seconds.observe(time.perf_counter() - started,
+                                    model=model, outcome=gemini_call_outcome(error))
+
+
+@contextmanager
+def observe_db_query(sql: str) -> Iterator[None]:
+    """Time one query into shanbot_db_query_seconds (and count it for the current message)."""
+    tally = _current_query_count.get()
+    if tally is not None:
+        tally.count += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        db_query_seconds.observe(time.perf_counter() - started,
+                                 operation=sql_operation(sql))
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """sqlite3 cursor that times execute/executemany."""
+
+    def execute(self, sql, parameters=()):
+        with observe_db_query(sql):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with observe_db_query(sql):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection whose cursors (and shortcut execute calls) are timed.
+
+    Use as sqlite3.connect(..., factory=InstrumentedConnection).
+    """
+
+    def cursor(self, factory: Optional[type] = None):
+        return super().cursor(factory or InstrumentedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,104 @@
+"""
+Gemini Model Registry
+====================
+Configured GenerativeModel instances, created once and reused.
+
+Call paths used to build a new genai.GenerativeModel for every request
+(and each module configured the SDK at import time). The registry keeps one
+model per (model name, generation config, system instruction) and imports
+and configures google.generativeai on the first get(), so importing a
+module that makes Gemini calls no longer pays for the SDK.
+
+configure() records the API key to use; if the SDK is already configured
+with a different key it is reconfigured and the cached models (which hold
+clients for the old key) are dropped.
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger("shanbot_model_registry")
+
+
+class ModelRegistry:
+    """Lazily configured google.generativeai with a GenerativeModel cache."""
+
+    def __init__(self, api_key: Optional[str] = None):
+        self._api_key = api_key
+        self._genai = None
+        self._configured_key: Optional[str] = None
+        self._models: Dict[Tuple[str, str, str], Any] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def configure(self, api_key: Optional[str]) -> None:
+        """Set the API key. Takes effect on first use, or now if the SDK is already configured."""
+        with self._lock:
+            self._api_key = api_key
+            if self._genai is not None and api_key != self._configured_key:
+                self._configure_locked()
+
+    def _configure_locked(self) -> None:
+        api_key = self._api_key or os.getenv("GEMINI_API_KEY")
+        self._genai.configure(api_key=api_key)
+        self._configured_key = api_key
+        self._models.clear()
+
+    def genai(self):
+        """The google.generativeai module, imported and configured on first call."""
+        if self._genai is None:
+            with self._lock:
+                if self._genai is None:
+                    import google.generativeai as genai
+                    self._genai = genai
+                    self._configure_locked()
+        return self._genai
+
+    @staticmethod
+    def make_key(model_name: str, generation_config: Optional[Dict[str, Any]] = None,
+                 system_instruction: Optional[str] = None) -> Tuple[str, str, str]:
+        config = json.dumps(generation_config, sort_keys=True,
+                            default=str) if generation_config else ""
+        return model_name, config, system_instruction or ""
+
+    def get(self, model_name: str, generation_config: Optional[Dict[str, Any]] = None,
+            system_instruction: Optional[str] = None):
+        """Shared GenerativeModel for this model name and configuration."""
+        genai = self.genai()
+        key = self.make_key(model_name, generation_config, system_instruction)
+        model = self._models.get(key)
+        if model is not None:
+            self.reused += 1
+            return model
+        kwargs: Dict[str, Any] = {}
+        if generation_config:
+            kwargs["generation_config"] = generation_config
+        if system_instruction:
+            kwargs["system_instruction"] = system_instruction
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(model_name, **kwargs)
+                self._models[key] = model
+                self.created += 1
+                logger.info(
+                    f"[ModelRegistry] Created {model_name} client ({len(self._models)} cached)")
+            else:
+                self.reused += 1
+        return model
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "configured": self._genai is not None,
+            "models": len(self._models),
+            "created": self.created,
+            "reused": self.reused
+        }
+
+
+# Shared registry (API key from GEMINI_API_KEY unless a caller configures one)
+model_registry = ModelRegistry()
@@ -0,0 +1,160 @@
+"""
+Prompt Budget
+============
+Token-budgeted prompt assembly.
+
+clean_and_dedupe_history caps history by message count, and few-shot
+examples and bio context are added on top, so a prompt's size (and with it
+Gemini latency and cost) depends on how chatty the user and the example
+table have been. build_prompt() estimates tokens locally and fits the
+variable parts of a template into a per-prompt-type budget, trimming in a
+fixed order:
+
+  1. history, oldest first, down to the last PROMPT_MIN_HISTORY_ITEMS
+  2. few-shot examples, last first
+  3. bio context, truncated from the end
+
+The fixed text of the template is never touched. Every build logs the final
+size; a prompt that is still over budget after trimming is sent anyway,
+with a warning.
+
+Tokens are estimated as characters / PROMPT_CHARS_PER_TOKEN, close enough
+for budgeting and free to compute.
+"""
+
+import logging
+import math
+import os
+from functools import lru_cache
+from string import Formatter
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+from services.metrics import prompt_tokens
+
+logger = logging.getLogger("shanbot_prompt_budget")
+
+PROMPT_CHARS_PER_TOKEN = float(os.getenv("PROMPT_CHARS_PER_TOKEN", "4"))
+PROMPT_MIN_HISTORY_ITEMS = int(os.getenv("PROMPT_MIN_HISTORY_ITEMS", "6"))
+DEFAULT_PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "8000"))
+
+
+def _budget(prompt_type: str, default: int) -> int:
+    return int(os.getenv(f"PROMPT_TOKEN_BUDGET_{prompt_type.upper()}", str(default)))
+
+
+# Token budget per prompt type (the review queue's prompt_type values).
+# general_chat's onboarding template alone is ~13k tokens.
+PROMPT_TOKEN_BUDGETS: Dict[str, int] = {
+    "facebook_ad_response": _budget("facebook_ad_response", 6000),
+    "general_chat": _budget("general_chat", 20000),
+    "member_chat": _budget("member_chat", 6000),
+    "checkins": _budget("checkins", 4000),
+    "monday_morning_text": _budget("monday_morning_text", 4000),
+}
+
+FewShotExamples = Union[str, Sequence[Union[str, Dict[str, str]]], None]
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count of text."""
+    return math.ceil(len(text or "") / PROMPT_CHARS_PER_TOKEN)
+
+
+def format_few_shot_example(example: Union[str, Dict[str, str]]) -> str:
+    """One few-shot example as prompt text ({"input", "output"} rows from the examples tables)."""
+    if isinstance(example, dict):
+        return f"User: {example.get('input', '')}\nShannon: {example.get('output', '')}"
+    return str(example)
+
+
+@lru_cache(maxsize=64)
+def _placeholder_counts(template: str) -> Dict[str, int]:
+    """How many times each field appears in a format template."""
+    counts: Dict[str, int] = {}
+    for _, field_name, _, _ in Formatter().parse(template):
+        if field_name:
+            counts[field_name] = counts.get(field_name, 0) + 1
+    return counts
+
+
+def build_prompt(prompt_type: str, template: str, fields: Dict[str, Any],
+                 history: Optional[List[Dict[str, str]]] = None,
+                 format_history: Optional[Callable[[List[Dict[str, str]]], str]] = None,
+                 history_suffix: str = "", history_summary: str = "",
+                 few_shot_examples: FewShotExamples = None,
+                 bio: str = "", history_field: str = "full_conversation",
+                 examples_field: str = "few_shot_examples", bio_field: str = "bio_context",
+                 budget: Optional[int] = None) -> str:
+    """Format template with fields plus history, few-shot examples and bio fitted to the budget.
+
+    history is rendered with format_history (one line per item) followed by
+    history_suffix, which is always kept (e.g. the message being answered).
+    A history_summary (see services.conversation_summary) goes before the
+    history and is kept too.
+    few_shot_examples may be a list of strings / {"input", "output"} dicts or
+    one preformatted block (kept or dropped whole). Parts whose field isn't
+    in the template are left out and don't count towards the budget.
+    """
+    if budget is None:
+        budget = PROMPT_TOKEN_BUDGETS.get(
+            prompt_type, DEFAULT_PROMPT_TOKEN_BUDGET)
+    counts = _placeholder_counts(template)
+    history = list(history or [])
+
+    # Cost of each removable piece, times the number of places it's rendered
+    history_weight = counts.get(history_field, 0)
+    examples_weight = counts.get(examples_field, 0)
+    bio_weight = counts.get(bio_field, 0)
+    if not examples_weight:
+        examples = []
+    elif isinstance(few_shot_examples, str):
+        examples = [few_shot_examples] if few_shot_examples.strip() else []
+    else:
+        examples = [format_few_shot_example(e) for e in few_shot_examples or []]
+    bio = (bio or "") if bio_weight else ""
+    history_costs = [estimate_tokens(format_history([item])) + 1
+                     for item in history] if history_weight and format_history else []
+    example_costs = [estimate_tokens(e) + 2 for e in examples]
+
+    history_prefix = (f"Summary of earlier messages: {history_summary}\n\nRecent messages:\n"
+                      if history_summary else "")
+    empty = {history_field: history_prefix + history_suffix,
+             examples_field: "", bio_field: ""}
+    total = estimate_tokens(template.format_map({**fields, **empty}))
+    total += history_weight * sum(history_costs)
+    total += examples_weight * sum(example_costs)
+    total += bio_weight * estimate_tokens(bio)
+    over = total - budget
+
+    dropped_history = 0
+    while over > 0 and len(history_costs) - dropped_history > PROMPT_MIN_HISTORY_ITEMS:
+        over -= history_weight * history_costs[dropped_history]
+        dropped_history += 1
+    kept_examples = len(examples)
+    while over > 0 and kept_examples:
+        kept_examples -= 1
+        over -= examples_weight * example_costs[kept_examples]
+    bio_chars = len(bio)
+    if over > 0 and bio:
+        bio_chars = max(0, len(bio) - int(math.ceil(over / bio_weight) * PROMPT_CHARS_PER_TOKEN))
+
+    parts = {
+        history_field: history_prefix + (format_history(history[dropped_history:]) if format_history else "")
+        + history_suffix,
+        examples_field: "\n\n".join(examples[:kept_examples]),
+        bio_field: bio[:bio_chars],
+    }
+    prompt = template.format_map({**fields, **parts})
+
+    tokens = estimate_tokens(prompt)
+    prompt_tokens.observe(tokens, prompt_type=prompt_type)
+    trimmed = (f"dropped {dropped_history}/{len(history)} history items, "
+               f"{len(examples) - kept_examples}/{len(examples)} few-shot examples, "
+               f"{len(bio) - bio_chars} bio chars")
+    if tokens > budget:
+        logger.warning(
+            f"[PromptBudget] {prompt_type}: ~{tokens} tokens, over the {budget} budget after trimming ({trimmed})")
+    else:
+        logger.info(
+            f"[PromptBudget] {prompt_type}: ~{tokens} tokens of {budget} ({trimmed})")
+    return prompt
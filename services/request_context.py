@@ -0,0 +1,130 @@
+"""
+Request Context
+==============
+Per-message snapshot of a user's state, loaded once when a webhook message
+is routed and passed through ActionRouter and the action handlers.
+
+Before this, routing a single message re-read the same users row several
+times (get_user_data, is_user_in_calorie_flow, get_user_metrics_json, ad-hoc
+SELECTs), each on a fresh connection and each re-parsing metrics_json. The
+snapshot is one query (users row + recent messages) with JSON parsed once.
+
+The snapshot reflects the database when the message arrived. Code that
+writes user state and then needs to read it back should still query the
+database directly.
+
+The context also carries what was decided while routing the message: the
+ad-intent verdict (computed once, reused by later stages) and a decision
+trace of every stage that used it.
+"""
+
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("shanbot_context")
+
+# Recent messages loaded with the snapshot (handlers use the tail for prompts/heuristics)
+CONTEXT_HISTORY_LIMIT = 40
+
+
+def _parse_json(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return value
+    if isinstance(value, str) and value.strip():
+        try:
+            return json.loads(value)
+        except (TypeError, ValueError):
+            pass
+    return {}
+
+
+class AdVerdict:
+    """An ad-intent verdict: (is_ad, scenario, confidence), and whether an earlier stage computed it."""
+
+    def __init__(self, is_ad: bool, scenario: int, confidence: int, cached: bool = False):
+        self.is_ad = is_ad
+        self.scenario = scenario
+        self.confidence = confidence
+        self.cached = cached
+
+    def as_tuple(self) -> tuple:
+        return self.is_ad, self.scenario, self.confidence
+
+    def trace_entry(self, stage: str) -> Dict[str, Any]:
+        """Decision-trace record for a routing stage that used this verdict."""
+        return {
+            "stage": stage,
+            "cached": self.cached,
+            "is_ad": self.is_ad,
+            "scenario": self.scenario,
+            "confidence": self.confidence
+        }
+
+
+class RequestContext:
+    """Snapshot of one user's row, parsed metrics and recent history for a single message."""
+
+    def __init__(self, ig_username: str, subscriber_id: Optional[str] = None,
+                 user: Optional[Dict[str, Any]] = None,
+                 history: Optional[List[Dict[str, Any]]] = None):
+        self.ig_username = ig_username
+        self.subscriber_id = subscriber_id
+        self.user: Dict[str, Any] = dict(user or {})
+        self.found = bool(user)
+        self.conversation_history: List[Dict[str, Any]] = list(history or [])
+        self.metrics_json: Dict[str, Any] = _parse_json(
+            self.user.get("metrics_json"))
+        if not isinstance(self.metrics_json, dict):
+            self.metrics_json = {}
+        self.is_in_calorie_flow = bool(self.user.get("is_in_calorie_flow"))
+        self.metrics = self._build_metrics()
+        # Keyword ad-intent verdicts by message text, shared by the routing stages
+        self.ad_verdicts: Dict[str, AdVerdict] = {}
+        # Classification verdicts used while routing this message, in order
+        self.decision_trace: List[Dict[str, Any]] = []
+
+    @classmethod
+    def load(cls, ig_username: str, subscriber_id: Optional[str] = None,
+             history_limit: int = CONTEXT_HISTORY_LIMIT) -> "RequestContext":
+        """Load the snapshot with a single query. Returns an empty context on error or unknown user."""
+        try:
+            from app.dashboard_modules.dashboard_sqlite_utils import load_user_context
+            loaded = load_user_context(
+                ig_username, subscriber_id, history_limit=history_limit)
+        except Exception as e:
+            logger.warning(
+                f"[Context] Could not load user context for {ig_username}: {e}")
+            loaded = None
+        if not loaded:
+            return cls(ig_username, subscriber_id)
+        return cls(ig_username, subscriber_id, loaded.get("user"), loaded.get("history"))
+
+    def _build_metrics(self) -> Dict[str, Any]:
+        """The metrics dict handlers expect from get_user_data: metrics_json overlaid with the row's columns."""
+        metrics = dict(self.metrics_json)
+        for column, value in self.user.items():
+            if column == "metrics_json":
+                continue
+            if column.endswith("_json"):
+                # e.g. client_analysis_json -> client_analysis
+                metrics[column[:-len("_json")]] = _parse_json(value)
+            elif value is not None:
+                metrics[column] = value
+        metrics["metrics_json"] = self.metrics_json
+        metrics["conversation_history"] = self.conversation_history
+        return metrics
+
+    @property
+    def user_id(self) -> Optional[str]:
+        return self.user.get("subscriber_id") or self.subscriber_id
+
+    def user_data(self) -> Tuple[List[Dict[str, Any]], Dict[str, Any], Optional[str]]:
+        """Same shape as get_user_data(): (conversation_history, metrics, user_id)."""
+        return self.conversation_history, self.metrics, self.user_id
+
+    def record_user_message(self, message_text: str, timestamp: str) -> None:
+        """Append a message the handler just persisted, so the snapshot's history includes it."""
+        if message_text and message_text.strip():
+            self.conversation_history.append(
+                {"timestamp": timestamp or "", "type": "user", "text": message_text})
@@ -0,0 +1,119 @@
+"""
+Startup Profiler
+===============
+Measures webhook cold-start cost, for `python webhook_main.py --profile-startup`.
+
+- Import-time tree: `import webhook_main` in a fresh interpreter under
+  `python -X importtime`, folded into a tree of cumulative times.
+- Time to first request: a fresh interpreter imports the app, runs the
+  lifespan startup and serves GET /health in-process.
+"""
+
+import json
+import os
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Budget for import + startup + first /health response
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "1500"))
+
+FIRST_REQUEST_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import webhook_main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(webhook_main.app) as client:
+    ready = time.perf_counter()
+    status = client.get("/health").status_code
+    served = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "startup_ms": (ready - imported) * 1000,
+    "first_request_ms": (served - ready) * 1000,
+    "total_ms": (served - started) * 1000,
+    "status_code": status
+}))
+"""
+
+
+def _run(args: List[str]) -> subprocess.CompletedProcess:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+    return subprocess.run([sys.executable] + args, cwd=REPO_ROOT, env=env,
+                          capture_output=True, text=True)
+
+
+def parse_importtime(stderr: str) -> List[Dict[str, Any]]:
+    """Fold `-X importtime` output into a tree of {name, self_ms, cumulative_ms, children}."""
+    pending: List[tuple] = []  # (depth, node), in the post-order importtime prints
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name_field = line[len("import time:"):].split("|", 2)
+        depth = (len(name_field) - len(name_field.lstrip()) - 1) // 2
+        node = {
+            "name": name_field.strip(),
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+            "children": []
+        }
+        # Children are printed before their parent, one level deeper
+        while pending and pending[-1][0] > depth:
+            node["children"].insert(0, pending.pop()[1])
+        pending.append((depth, node))
+    return [node for _, node in pending]
+
+
+def format_tree(nodes: List[Dict[str, Any]], min_ms: float = 5.0, max_depth: int = 4,
+                depth: int = 0) -> List[str]:
+    """Render the heaviest branches of an import tree, one line per module."""
+    lines = []
+    for node in sorted(nodes, key=lambda n: n["cumulative_ms"], reverse=True):
+        if node["cumulative_ms"] < min_ms:
+            continue
+        lines.append(
+            f"{node['cumulative_ms']:>9.1f}ms {node['self_ms']:>8.1f}ms  {'  ' * depth}{node['name']}")
+        if depth + 1 < max_depth:
+            lines.extend(format_tree(
+                node["children"], min_ms, max_depth, depth + 1))
+    return lines
+
+
+def measure_first_request() -> Optional[Dict[str, Any]]:
+    """Time import, lifespan startup and the first /health request in a fresh interpreter."""
+    result = _run(["-c", FIRST_REQUEST_SCRIPT])
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    print(result.stderr[-2000:], file=sys.stderr)
+    return None
+
+
+def profile_startup(budget_ms: float = STARTUP_BUDGET_MS, min_ms: float = 5.0) -> bool:
+    """Print the import tree and time-to-first-request. Returns True if within budget."""
+    result = _run(["-X", "importtime", "-c", "import webhook_main"])
+    tree = parse_importtime(result.stderr)
+    total_ms = sum(node["cumulative_ms"] for node in tree)
+
+    print(f"Import-time tree for webhook_main (modules >= {min_ms:g}ms)")
+    print(f"{'cumulative':>11} {'self':>10}  module")
+    for line in format_tree(tree, min_ms=min_ms):
+        print(line)
+    print(f"Total import time: {total_ms:.1f}ms")
+
+    timings = measure_first_request()
+    if not timings:
+        print("Could not measure time to first request")
+        return False
+
+    print(f"\nTime to first request: {timings['total_ms']:.1f}ms "
+          f"(import {timings['import_ms']:.1f}ms, startup {timings['startup_ms']:.1f}ms, "
+          f"first /health {timings['first_request_ms']:.1f}ms, status {timings['status_code']})")
+    within_budget = timings["total_ms"] <= budget_ms
+    print(f"Budget {budget_ms:.0f}ms: {'OK' if within_budget else 'EXCEEDED'}")
+    return within_budget
@@ -0,0 +1,40 @@
+"""
+Webhook State Database
+=====================
+Shared SQLite connection for the webhook's own operational state
+(ingest journal, idempotency keys, buffer state).
+"""
+
+import os
+import sqlite3
+import threading
+
+# The state DB is separate from the analytics DB so it can live on local disk
+# next to the webhook process.
+STATE_DB_PATH = os.getenv(
+    "SHANBOT_STATE_DB",
+    os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "shanbot_state.sqlite")
+)
+STATE_DB_TIMEOUT = 5.0  # seconds to wait on a locked database
+
+_local = threading.local()
+
+
+def get_state_connection() -> sqlite3.Connection:
+    """Return this thread's connection to the state DB (WAL mode)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=STATE_DB_TIMEOUT)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+    return conn
+
+
+def close_state_connection() -> None:
+    """Close this thread's state DB connection, if open."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
@@ -0,0 +1,57 @@
+"""Tests for the rolling conversation summaries"""
+
+import asyncio
+
+import pytest
+
+from action_handlers.ad_response_handler import AdResponseHandler
+from services import state_db
+from services.conversation_summary import ConversationSummaries
+
+
+@pytest.fixture
+def summaries(tmp_path, monkeypatch):
+    state_db.close_state_connection()
+    monkeypatch.setattr(state_db, "STATE_DB_PATH",
+                        str(tmp_path / "state.sqlite"))
+    yield ConversationSummaries(keep_recent=10, refresh_after=24)
+    state_db.close_state_connection()
+
+
+def make_history(count):
+    return [{"timestamp": f"2025-01-01T10:{i:02d}:00", "type": "user" if i % 2 == 0 else "ai",
+             "text": f"message {i}"} for i in range(count)]
+
+
+async def refresh(summaries, ig_username, history):
+    """prompt_history with the summarizer the ad handler passes, then wait for the background refresh."""
+    result = summaries.prompt_history(
+        ig_username, history, AdResponseHandler.summarize_history)
+    await asyncio.gather(*list(summaries._tasks))
+    return result
+
+
+def test_refresh_stores_summary(summaries):
+    history = make_history(30)
+
+    summary, tail = asyncio.run(refresh(summaries, "test_user", history))
+    assert (summary, tail) == ("", history)
+
+    row = summaries.get("test_user")
+    assert row is not None
+    stored_summary, summarized_through, messages_summarized = row
+    assert stored_summary
+    assert summarized_through == "2025-01-01T10:19:00"
+    assert messages_summarized == 20
+    assert summaries.refreshes == 1 and summaries.refresh_failures == 0
+
+    summary, tail = summaries.prompt_history("test_user", history)
+    assert summary == stored_summary
+    assert tail == history[20:]
+
+
+def test_short_history_is_not_summarized(summaries):
+    history = make_history(20)
+
+    assert asyncio.run(refresh(summaries, "test_user", history)) == ("", history)
+    assert summaries.get("test_user") is None
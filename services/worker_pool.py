@@ -0,0 +1,136 @@
+"""
+Sharded Worker Pool
+==================
+Fixed-size pool of async workers with per-subscriber ordering.
+
+Each subscriber_id hashes to one shard. A shard is a queue drained by a single
+worker, so one subscriber's messages run strictly in order while different
+subscribers run in parallel across shards.
+"""
+
+import asyncio
+import logging
+import os
+import zlib
+from typing import Any, Awaitable, Callable, Dict, List
+
+logger = logging.getLogger("shanbot_workers")
+
+# Worker pool configuration
+WORKER_SHARDS = int(os.getenv("WEBHOOK_WORKER_SHARDS", "8"))
+SHARD_QUEUE_MAX = int(os.getenv("WEBHOOK_SHARD_QUEUE_MAX", "1000"))
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class ShardedWorkerPool:
+    """Async worker pool that serialises work per key and parallelises across keys."""
+
+    def __init__(self, shard_count: int = WORKER_SHARDS, max_queue_per_shard: int = SHARD_QUEUE_MAX,
+                 name: str = "messages"):
+        self.shard_count = max(1, shard_count)
+        self.max_queue_per_shard = max_queue_per_shard
+        self.name = name
+        self._queues: List[asyncio.Queue] = []
+        self._workers: List[asyncio.Task] = []
+        self._busy: List[bool] = []
+        self._processed: List[int] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def shard_for(self, key: str) -> int:
+        """Stable shard index for a key (same key -> same shard across restarts)."""
+        return zlib.crc32(str(key).encode("utf-8")) % self.shard_count
+
+    def start(self) -> None:
+        """Start one worker per shard. Must be called with a running event loop."""
+        if self.running:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.max_queue_per_shard)
+                        for _ in range(self.shard_count)]
+        self._busy = [False] * self.shard_count
+        self._processed = [0] * self.shard_count
+        self._workers = [asyncio.create_task(self._worker(shard))
+                         for shard in range(self.shard_count)]
+        logger.info(
+            f"[Workers] Started '{self.name}' pool with {self.shard_count} shards")
+
+    async def stop(self) -> None:
+        """Cancel all workers. Queued jobs are dropped and their futures cancelled."""
+        for task in self._workers:
+            task.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        for queue in self._queues:
+            while not queue.empty():
+                _, future = queue.get_nowait()
+                future.cancel()
+        self._workers = []
+        self._queues = []
+        logger.info(f"[Workers] Stopped '{self.name}' pool")
+
+    def submit(self, key: str, job: Job) -> asyncio.Future:
+        """Queue a job on the key's shard. Raises asyncio.QueueFull if the shard is saturated."""
+        if not self.running:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queues[self.shard_for(key)].put_nowait((job, future))
+        return future
+
+    async def run(self, key: str, job: Job) -> Any:
+        """Queue a job on the key's shard and wait for its result."""
+        return await self.submit(key, job)
+
+    async def _worker(self, shard: int) -> None:
+        """Run the shard's jobs one at a time, in arrival order."""
+        queue = self._queues[shard]
+        while True:
+            job, future = await queue.get()
+            if future.cancelled():
+                queue.task_done()
+                continue
+            self._busy[shard] = True
+            try:
+                result = await job()
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                logger.error(
+                    f"[Workers] Job failed on '{self.name}' shard {shard}: {e}", exc_info=True)
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._busy[shard] = False
+                self._processed[shard] += 1
+                queue.task_done()
+
+    def total_depth(self) -> int:
+        """Total number of queued jobs across all shards."""
+        return sum(queue.qsize() for queue in self._queues)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get per-shard queue depth and activity."""
+        return {
+            "name": self.name,
+            "running": self.running,
+            "shard_count": self.shard_count,
+            "total_depth": self.total_depth(),
+            "shards": [
+                {
+                    "shard": shard,
+                    "depth": self._queues[shard].qsize(),
+                    "busy": self._busy[shard],
+                    "processed": self._processed[shard]
+                }
+                for shard in range(len(self._queues))
+            ]
+        }
+
+
+# Shared pool for per-subscriber message processing
+message_worker_pool = ShardedWorkerPool()
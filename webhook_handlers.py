@@ -2,6 +2,9 @@
 from typing import Any, Dict, Optional
 import asyncio
 
+from services.admission_control import admission_controller
+from services.metrics import manychat_update_seconds, observe_gemini_call
+
 
 def get_user_data(ig_username: str) -> Dict[str, Any]:
     return {"ig_username": ig_username, "status": "active"}
@@ -13,7 +16,8 @@ def update_analytics_data(*args, **kwargs) -> None:
 
 def call_gemini_with_retry(prompt: str, model: Optional[str] = None, *args, **kwargs) -> str:
     # Deterministic short reply; keep it under 15 words to match your rules
-    return "Heya! Keen to help. Tell me your goals?"
+    with observe_gemini_call(model or "default"):
+        return "Heya! Keen to help. Tell me your goals?"
 
 # Async convenience wrapper if callers await
 async def a_call_gemini_with_retry(prompt: str, model: Optional[str] = None, *args, **kwargs) -> str:
@@ -27,11 +31,13 @@ async def send_manychat_message(subscriber_id: str, text: str) -> None:
 # Simple AI wrapper expected by some handlers
 async def get_ai_response(prompt: str, model: str | None = None) -> str:
     # Keep under 15 words
-    return "Gotcha! Quick one — what’s the goal you want help with?"
+    with admission_controller.track_llm_call(), observe_gemini_call(model or "default"):
+        return "Gotcha! Quick one — what’s the goal you want help with?"
 
 async def update_manychat_fields(subscriber_id: str, fields: dict) -> None:
     # No-op stub for cloud runtime
-    return None
+    with manychat_update_seconds.time(outcome="ok"):
+        return None
 
 def build_member_chat_prompt(ig_username: str, full_conversation: str, user_metrics: dict = None) -> str:
     # Stub: Returns basic prompt template for member chat
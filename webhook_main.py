@@ -9,9 +9,11 @@ through a clean, organized structure.
 
 import sqlite3
 import asyncio
+import importlib
 import json
 import logging
 import os
+import random
 import sys
 import time
 from datetime import datetime
@@ -26,13 +28,21 @@ except Exception:
     except Exception:
         def update_analytics_data(*args, **kwargs):
             return None
-from action_router import ActionRouter
-from calendly_integration import run_booking_check
+from services.ingest_journal import IngestJournal
+from services.worker_pool import message_worker_pool
+from services.message_buffer import MessageBuffer
+from services.idempotency import webhook_idempotency
+from services.admission_control import (
+    admission_controller, MODE_REJECT, MODE_DEFER_GENERATION
+)
+from services.metrics import registry as metrics_registry
+from app.app.schemas.manychat import InstagramMessagePayload
 
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, Field, ValidationError
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 
@@ -88,6 +98,17 @@ logging.getLogger("uvicorn.error").setLevel(logging.WARNING)
 
 logger = logging.getLogger("shanbot_webhook")
 
+# Ingest mode: "inline" routes each message before responding, "journal"
+# appends it to the ingest journal and acknowledges with 202 immediately.
+WEBHOOK_INGEST_MODE = os.getenv("WEBHOOK_INGEST_MODE", "inline").lower()
+
+# Fraction of webhook payloads dumped in full when DEBUG logging is enabled
+PAYLOAD_LOG_SAMPLE_RATE = float(
+    os.getenv("WEBHOOK_PAYLOAD_LOG_SAMPLE_RATE", "0.01"))
+
+# Pre-load the router and handlers in the background after startup
+WARM_IMPORTS = os.getenv("WEBHOOK_WARM_IMPORTS", "true").lower() == "true"
+
 # Simple stub functions to avoid import issues
 
 
@@ -113,6 +134,27 @@ def get_user_data(subscriber_id: str) -> Dict[str, Any]:
     # This is a stub - in real implementation, this would query the database
     return {"subscriber_id": subscriber_id, "status": "active"}
 
+# Lazily loaded modules (see _warm_imports)
+LAZY_MODULES = ["action_router"]
+
+
+def _warm_imports() -> None:
+    """Import the router and its handlers ahead of the first webhook."""
+    started = time.perf_counter()
+    for module_name in LAZY_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            logger.error(f"[Startup] Failed to pre-load {module_name}: {e}")
+    logger.info(
+        f"[Startup] ✓ Handlers pre-loaded in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+
+async def route_message_ordered(**route_kwargs) -> Dict[str, Any]:
+    """Route a message through the ActionRouter, importing it on first use."""
+    from action_router import ActionRouter
+    return await ActionRouter.route_webhook_message_ordered(**route_kwargs)
+
 # Lifespan context manager
 
 
@@ -121,35 +163,53 @@ async def lifespan(app: FastAPI):
     """Run startup and shutdown tasks."""
     logger.info("[Startup] Shanbot Webhook starting up...")
 
-    # Start Calendly booking check task
-    logger.info("[Startup] Starting Calendly booking check task...")
+    # Start the Calendly poller (async HTTP; DB writes run in worker threads)
+    calendly_task = None
     try:
-        # Create a proper async task for the booking check
-        async def run_calendly_check():
-            while True:
-                try:
-                    # Run the booking check (this is a sync function)
-                    count = run_booking_check()
-                    if count > 0:
-                        logger.info(
-                            f"✅ Found and processed {count} new booking(s)")
-                    else:
-                        logger.info("✅ No new bookings found")
-                except Exception as e:
-                    logger.error(f"❌ Error in Calendly booking check: {e}")
-
-                # Wait 30 minutes before next check
-                await asyncio.sleep(1800)  # 30 minutes
-
-        # Start the background task
-        asyncio.create_task(run_calendly_check())
-        logger.info("[Startup] ✓ Calendly booking check task started")
+        async def run_calendly_poller():
+            # calendly_integration pulls in requests, so import it off the loop
+            calendly = await asyncio.to_thread(importlib.import_module, "calendly_integration")
+            await calendly.calendly_poller.run_forever()
+
+        calendly_task = asyncio.create_task(run_calendly_poller())
+        logger.info("[Startup] ✓ Calendly booking poller started")
+    except Exception as e:
+        logger.error(f"[Startup] Failed to start Calendly booking poller: {e}")
+
+    # Re-buffer messages a previous process persisted but never flushed,
+    # ahead of the journal replay so they keep their order
+    try:
+        recovered = MessageBuffer.recover()
+        logger.info(
+            f"[Startup] ✓ Message buffer ready ({recovered} buffered messages recovered)")
     except Exception as e:
-        logger.error(f"[Startup] Failed to start Calendly booking check: {e}")
+        logger.error(f"[Startup] Failed to recover buffered messages: {e}")
+
+    # Start ingest journal workers (also replays entries left by a previous run).
+    # They run in inline mode too, to drain messages deferred under load.
+    admission_controller.queue_depth_fn = message_worker_pool.total_depth
+    try:
+        replayed = await IngestJournal.start(
+            route_message_ordered, gate=admission_controller.generation_allowed)
+        logger.info(
+            f"[Startup] ✓ Ingest journal started ({replayed} entries replayed)")
+    except Exception as e:
+        logger.error(f"[Startup] Failed to start ingest journal: {e}")
+
+    # Load the router and handlers off the event loop, after startup, so the
+    # first webhook doesn't pay for the import
+    if WARM_IMPORTS:
+        asyncio.get_running_loop().run_in_executor(None, _warm_imports)
 
     yield
 
     logger.info("[Shutdown] Shanbot Webhook shutting down...")
+    if calendly_task is not None:
+        calendly_task.cancel()
+        await asyncio.gather(calendly_task, return_exceptions=True)
+    await IngestJournal.stop()
+    await MessageBuffer.shutdown()
+    await message_worker_pool.stop()
 
 # Create FastAPI app
 app = FastAPI(
@@ -168,9 +228,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create action router
-action_router = ActionRouter()
-
 # ============================================================================
 # WEBHOOK ENDPOINTS
 # ============================================================================
@@ -179,35 +236,70 @@ action_router = ActionRouter()
 @app.post("/webhook/manychat")
 async def manychat_webhook(request: Request, background_tasks: BackgroundTasks):
     """Handle ManyChat webhooks."""
+    mode = admission_controller.evaluate()
+    if mode == MODE_REJECT:
+        admission_controller.rejected_total += 1
+        logger.warning("Webhook overloaded - rejecting ManyChat delivery")
+        return JSONResponse(
+            status_code=503,
+            content={"status": "overloaded", "mode": mode},
+            headers={"Retry-After": str(
+                admission_controller.retry_after_seconds)}
+        )
+
+    with admission_controller.track_request():
+        return await _handle_manychat_webhook(request, mode)
+
+
+async def _handle_manychat_webhook(request: Request, mode: str):
+    """Parse, de-duplicate and route (or journal) a ManyChat delivery."""
+    # (subscriber_id, text, ig_last_interaction) once the delivery is marked as seen
+    marked_delivery = None
     try:
-        # Get raw payload
-        payload = await request.body()
-        headers = dict(request.headers)
+        # Read the raw body once; it is both verified and parsed from these bytes
+        body = await request.body()
 
         # Verify signature (stub function)
-        if not verify_manychat_signature(payload, headers):
+        if not verify_manychat_signature(body, request.headers):
             logger.warning("ManyChat signature verification failed")
             raise HTTPException(status_code=401, detail="Invalid signature")
 
-        # Parse JSON payload
-        data = await request.json()
-        logger.info(f"Received ManyChat webhook: {json.dumps(data, indent=2)}")
+        # Single parse + validation straight from bytes (pydantic-core JSON parser)
+        try:
+            payload = InstagramMessagePayload.model_validate_json(body)
+        except ValidationError as e:
+            logger.error(
+                f"Invalid ManyChat webhook payload: {e.error_count()} error(s)")
+            raise HTTPException(status_code=400, detail="Invalid payload")
 
         # Extract key fields
-        subscriber_id = data.get("id")
-        ig_username = data.get("ig_username")
-        message_text = data.get("last_input_text", "")
+        subscriber_id = payload.id
+        ig_username = payload.ig_username
+        message_text = payload.last_input_text
+        logger.info(
+            f"Received ManyChat webhook from subscriber {subscriber_id} ({len(message_text)} chars)")
+        if logger.isEnabledFor(logging.DEBUG) and random.random() < PAYLOAD_LOG_SAMPLE_RATE:
+            logger.debug(
+                f"ManyChat webhook payload sample: {payload.model_dump_json()}")
 
         if not subscriber_id:
             logger.error("Missing subscriber ID in webhook payload")
             raise HTTPException(
                 status_code=400, detail="Missing subscriber ID")
 
+        # Drop ManyChat retries before any routing, DB reads or LLM calls
+        if webhook_idempotency.check_and_mark(subscriber_id, message_text, payload.ig_last_interaction):
+            logger.info(
+                f"Duplicate ManyChat delivery for subscriber {subscriber_id} ignored")
+            return {"status": "duplicate_ignored"}
+        marked_delivery = (subscriber_id, message_text,
+                           payload.ig_last_interaction)
+
         # Handle Facebook leads with null ig_username
         if ig_username is None or ig_username == "null":
             # Create consistent identifier for Facebook leads
-            first_name = data.get("first_name", "")
-            last_name = data.get("last_name", "")
+            first_name = payload.first_name or ""
+            last_name = payload.last_name or ""
             if first_name and last_name:
                 ig_username = f"fb_{first_name.lower()}_{last_name.lower()}_{subscriber_id[-4:]}"
             else:
@@ -215,22 +307,36 @@ async def manychat_webhook(request: Request, background_tasks: BackgroundTasks):
             logger.info(
                 f"Facebook lead detected - using consistent ig_username: {ig_username}")
 
-        # Process the message
-        result = await ActionRouter.route_webhook_message(
-            ig_username=ig_username,
-            message_text=message_text,
-            subscriber_id=subscriber_id,
-            first_name=data.get("first_name", ""),
-            last_name=data.get("last_name", ""),
-            user_message_timestamp_iso=data.get(
-                "ig_last_interaction", datetime.now().isoformat()),
-            fb_ad=data.get("custom_fields", {}).get("fb ad", False)
-        )
+        route_kwargs = {
+            "ig_username": ig_username,
+            "message_text": message_text,
+            "subscriber_id": subscriber_id,
+            "first_name": payload.first_name or "",
+            "last_name": payload.last_name or "",
+            "user_message_timestamp_iso": payload.ig_last_interaction or datetime.now().isoformat(),
+            "fb_ad": payload.custom_fields.get("fb ad", False)
+        }
+
+        # Journal mode (or deferred under load): persist and acknowledge,
+        # workers route it later
+        if WEBHOOK_INGEST_MODE == "journal" or mode == MODE_DEFER_GENERATION:
+            entry_id = IngestJournal.append(subscriber_id, route_kwargs)
+            if mode == MODE_DEFER_GENERATION:
+                admission_controller.deferred_total += 1
+            return JSONResponse(status_code=202, content={"status": "accepted", "journal_id": entry_id})
+
+        # Process the message (serialised per subscriber on the worker pool)
+        result = await route_message_ordered(**route_kwargs)
 
         return {"status": "success", "result": result}
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing ManyChat webhook: {e}", exc_info=True)
+        if marked_delivery:
+            # Not routed or journalled: let ManyChat's retry through
+            webhook_idempotency.unmark(*marked_delivery)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
@@ -241,10 +347,32 @@ async def health_check():
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
         "version": "2.0.0",
-        "service": "shanbot-webhook"
+        "service": "shanbot-webhook",
+        "admission": admission_controller.get_status()
     }
 
 
+@app.get("/webhook/journal/{entry_id}")
+async def journal_entry_status(entry_id: int):
+    """Processing status of a journaled webhook delivery."""
+    entry = IngestJournal.get_entry(entry_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Journal entry not found")
+    return entry
+
+
+@app.get("/stats/workers")
+async def worker_stats():
+    """Per-shard queue depth of the message worker pool."""
+    return message_worker_pool.get_stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Per-stage counters and latency histograms in the Prometheus text format."""
+    return Response(content=metrics_registry.render(), media_type=metrics_registry.CONTENT_TYPE)
+
+
 @app.get("/debug")
 async def debug_info():
     """Debug information endpoint."""
@@ -253,6 +381,9 @@ async def debug_info():
             "timestamp": datetime.now().isoformat(),
             "python_version": sys.version,
             "current_directory": os.getcwd(),
+            "ingest_mode": WEBHOOK_INGEST_MODE,
+            "idempotency": webhook_idempotency.get_stats(),
+            "ingest_journal": IngestJournal.get_stats(),
             "environment_variables": {
                 "MANYCHAT_API_KEY": bool(os.getenv("MANYCHAT_API_KEY")),
                 "GEMINI_API_KEY": bool(os.getenv("GEMINI_API_KEY")),
@@ -277,9 +408,19 @@ if __name__ == "__main__":
     parser.add_argument("--reload", action="store_true",
                         help="Enable auto-reload")
     parser.add_argument("--log-level", default="info", help="Log level")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print an import-time tree and time-to-first-request, then exit")
+    parser.add_argument("--startup-budget-ms", type=float, default=None,
+                        help="Time-to-first-request budget for --profile-startup")
 
     args = parser.parse_args()
 
+    if args.profile_startup:
+        from services.startup_profiler import profile_startup, STARTUP_BUDGET_MS
+        within_budget = profile_startup(
+            args.startup_budget_ms or STARTUP_BUDGET_MS)
+        sys.exit(0 if within_budget else 1)
+
     logger.info(f"[Main] Starting Shanbot Webhook on {args.host}:{args.port}")
 
     # Suppress noisy uvicorn logs